@@ -1,42 +1,621 @@
-from httplib import BAD_REQUEST
+from http.client import BAD_REQUEST, NOT_ACCEPTABLE, SERVICE_UNAVAILABLE
 
-from flask.json import jsonify
+from flask.json import jsonify as flask_jsonify
 from flask_restful import reqparse, abort
-from flask import Flask, request
-from utils import init_db, get_db_cursor, get_where_statement
-from schemas import CreateDeviceReading
+from flask import Flask, Response, request, g
+from utils import init_db, get_db_cursor, get_filters, get_window, close_db_pools, encode_cursor, decode_cursor, \
+    PoolTimeout
+from queries import readings_page, export_readings
+from stats import get_histogram, get_device_histograms, merge_histograms, summarize, SUMMARY_METRICS, STATS_METRICS
+from series import parse_interval, get_series, get_series_rows
+from partitions import get_db_names, get_date_error, write_readings, fan_out, PartialWrite
+from columnar import get_store
+from schemas import CreateDeviceReading, CreateFleetReading, parse_reading, parse_readings_batch, load_reading, \
+    load_readings_batch
+from ingest import WriteBuffer, BufferFull, BufferStopped, WriteTimeout
+from cache import WriteVersions, ResponseCache
+from metrics import Metrics
+from guard import QueryBudget, QueryLimiter
+from latest import LatestReadings, load_latest_readings
+import export
+from stream import ReadingHub, STREAM_HEADERS, HEARTBEAT, format_events, format_reading_event
+from itertools import groupby
+from operator import itemgetter
+import atexit
+import functools
+import heapq
 import json
 import os
-
+import sqlite3
+import threading
 import time
 
 
 app = Flask(__name__)
 app.config['TESTING'] = os.environ.get('FLASK_ENV') == 'testing'
+# Database file, database.db by default and test_database.db when testing
+app.config['DB_NAME'] = os.environ.get('DB_NAME') or None
+app.config['BATCH_MAX_READINGS'] = int(os.environ.get('BATCH_MAX_READINGS', 10000))
+# Rows fetched from the database at a time when streaming readings
+app.config['READINGS_CHUNK_SIZE'] = int(os.environ.get('READINGS_CHUNK_SIZE', 1000))
+# Rows read and written out at a time by /readings/export/
+app.config['EXPORT_CHUNK_SIZE'] = int(os.environ.get('EXPORT_CHUNK_SIZE', 10000))
+# Reads without start/end cover the last QUERY_DEFAULT_WINDOW seconds and
+# may span at most QUERY_MAX_WINDOW seconds, 0 lifts either limit
+app.config['QUERY_DEFAULT_WINDOW'] = int(os.environ.get('QUERY_DEFAULT_WINDOW', 3600))
+app.config['QUERY_MAX_WINDOW'] = int(os.environ.get('QUERY_MAX_WINDOW', 183 * 86400))
+# Limits of single routes overriding the defaults, as JSON keyed by route rule, e.g.
+# {"/readings/summary/": {"max_window": 604800}, "/devices/<string:device_uuid>/readings/": {"max_rows": 10000}}
+# with default_window, max_window, max_rows (readings and summary pages) and max_seconds
+app.config['QUERY_LIMITS'] = json.loads(os.environ.get('QUERY_LIMITS') or '{}')
+# Seconds after the start of a GET its statements are interrupted with a 503, 0 lifts it
+app.config['QUERY_TIME_BUDGET'] = float(os.environ.get('QUERY_TIME_BUDGET', 30))
+# Time budget of /readings/export/, none by default as an export cut short can't be answered 503
+app.config['EXPORT_TIME_BUDGET'] = float(os.environ.get('EXPORT_TIME_BUDGET', 0))
+# Heavy fleet queries (summaries) running at once, and seconds one waits for its turn before a 503
+app.config['HEAVY_QUERY_CONCURRENCY'] = int(os.environ.get('HEAVY_QUERY_CONCURRENCY', 4))
+app.config['HEAVY_QUERY_WAIT'] = float(os.environ.get('HEAVY_QUERY_WAIT', 5))
+# Largest number of points a series request may return
+app.config['SERIES_MAX_POINTS'] = int(os.environ.get('SERIES_MAX_POINTS', 10000))
+# 'direct' commits every POST on its own, 'buffered' queues single POSTs for group commits
+app.config['INGEST_MODE'] = os.environ.get('INGEST_MODE', 'direct')
+app.config['INGEST_QUEUE_SIZE'] = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+app.config['INGEST_BATCH_SIZE'] = int(os.environ.get('INGEST_BATCH_SIZE', 1000))
+app.config['INGEST_FLUSH_INTERVAL'] = float(os.environ.get('INGEST_FLUSH_INTERVAL', 0.005))
+# 'flush' answers once the reading is committed, 'ack' as soon as it is queued
+app.config['INGEST_DURABILITY'] = os.environ.get('INGEST_DURABILITY', 'flush')
+# Seconds a 'flush' POST waits for its reading to be committed before a 503
+app.config['INGEST_WAIT_TIMEOUT'] = float(os.environ.get('INGEST_WAIT_TIMEOUT', 10))
+app.config['DB_JOURNAL_MODE'] = os.environ.get('DB_JOURNAL_MODE', 'wal')
+app.config['DB_SYNCHRONOUS'] = os.environ.get('DB_SYNCHRONOUS', 'normal')
+app.config['DB_CACHE_SIZE'] = int(os.environ.get('DB_CACHE_SIZE', -64000))
+app.config['DB_MMAP_SIZE'] = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['DB_READ_POOL_SIZE'] = int(os.environ.get('DB_READ_POOL_SIZE', 8))
+# 'day' or 'month' stores readings in a database file per period
+app.config['DB_PARTITION'] = os.environ.get('DB_PARTITION') or None
+# Seconds after which partitions are dropped, 0 keeps them forever
+app.config['DB_PARTITION_RETENTION'] = int(os.environ.get('DB_PARTITION_RETENTION', 0)) or None
+# Database files readings are spread over by a hash of their device_uuid
+app.config['DB_SHARDS'] = int(os.environ.get('DB_SHARDS', 1))
+app.config['DB_FANOUT_THREADS'] = int(os.environ.get('DB_FANOUT_THREADS', 8))
+# 'sqlite' or 'columnar', memory-mapped column files under COLUMNAR_PATH
+app.config['STORAGE_ENGINE'] = os.environ.get('STORAGE_ENGINE', 'sqlite')
+app.config['COLUMNAR_PATH'] = os.environ.get('COLUMNAR_PATH', 'columnar')
+# 'full' fsyncs every append, 'off' leaves it to the OS and may lose the last ones on a crash
+app.config['COLUMNAR_SYNC'] = os.environ.get('COLUMNAR_SYNC', 'full')
+# Executor threads running routes and largest request body of the asyncio server (server.py)
+app.config['SERVER_DB_THREADS'] = int(os.environ.get('SERVER_DB_THREADS', 32))
+app.config['SERVER_MAX_BODY_SIZE'] = int(os.environ.get('SERVER_MAX_BODY_SIZE', 64 * 1024 * 1024))
+# Bytes of metric, stats, series and summary responses kept in memory, 0 disables the cache.
+# Write versions are kept per process, so only enable it with a single worker process
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 0))
+# Readings kept for a stream subscriber too slow to keep up before the oldest are dropped
+app.config['STREAM_BUFFER_SIZE'] = int(os.environ.get('STREAM_BUFFER_SIZE', 1000))
+# Seconds between the heartbeats of an idle stream
+app.config['STREAM_HEARTBEAT'] = float(os.environ.get('STREAM_HEARTBEAT', 15))
+# Times routes and statements for /metrics
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+# Statements slower than this many seconds are logged with their query plan, 0 logs none
+app.config['DB_SLOW_QUERY_SECONDS'] = float(os.environ.get('DB_SLOW_QUERY_SECONDS', 0)) or None
+
+
+def log_slow_query(statement, seconds, rows, plan):
+    app.logger.warning('Slow query (%.3fs, %s rows): %s\n%s', seconds, rows, statement, '\n'.join(plan))
+
+
+app_metrics = Metrics(app.config['METRICS_ENABLED'], app.config['DB_SLOW_QUERY_SECONDS'], log_slow_query)
+if app_metrics.enabled:
+    # Read by the connection pools, whose statements are then timed
+    app.extensions['metrics'] = app_metrics
+# Read by the connection pools, whose read statements are interrupted past the deadline
+query_budget = app.extensions['query_budget'] = QueryBudget()
+heavy_queries = QueryLimiter(app.config['HEAVY_QUERY_CONCURRENCY'], app.config['HEAVY_QUERY_WAIT'])
 init_db(app)
+atexit.register(close_db_pools)
+
+write_versions = app.extensions['write_versions'] = WriteVersions()
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'])
+app_metrics.collectors.append(lambda: [
+    ('sensor_api_response_cache_total', [('result', result)], response_cache.get_stats()[result])
+    for result in ('hits', 'misses', 'not_modified', 'evictions')
+])
+latest_readings = app.extensions['latest_readings'] = LatestReadings()
+reading_hub = ReadingHub()
+
+write_buffer_lock = threading.Lock()
+
+
+def jsonify(*args, **kwargs):
+    with app_metrics.timed('serialization'):
+        return flask_jsonify(*args, **kwargs)
+
+
+@app.before_request
+def start_request_metrics():
+    if app_metrics.enabled:
+        g.request_started = time.time()
+        app_metrics.set_route(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Records the request once its response is closed, so the time spent
+    streaming its body counts too.
+    """
+    if 'request_started' not in g:
+        return response
+    method, route, started = request.method, app_metrics.get_route(), g.request_started
+    status = response.status_code
+    if response.is_streamed:
+        response.response = app_metrics.iter_with_route(response.response, route)
+    response.call_on_close(lambda: app_metrics.observe_request(method, route, status, time.time() - started))
+    app_metrics.set_route(None)
+    return response
+
+
+def get_limits():
+    """
+    Returns the QUERY_LIMITS of the route of the request.
+    """
+    if request.url_rule is None:
+        return {}
+    return app.config['QUERY_LIMITS'].get(request.url_rule.rule, {})
+
+
+@app.before_request
+def start_query_budget():
+    """
+    Starts the time budget of the statements of GETs, a route's own
+    max_seconds taking precedence over QUERY_TIME_BUDGET, or over
+    EXPORT_TIME_BUDGET for exports. Writes have none.
+    """
+    if request.method == 'GET':
+        if request.endpoint == 'request_readings_export':
+            seconds = app.config['EXPORT_TIME_BUDGET']
+        else:
+            seconds = app.config['QUERY_TIME_BUDGET']
+        query_budget.start(get_limits().get('max_seconds', seconds))
+    else:
+        query_budget.clear()
+
+
+@app.teardown_request
+def clear_query_budget(error=None):
+    """
+    Lifts the budget once the view returned. Streamed bodies carry what's
+    left of it with QueryBudget.bind_iterator.
+    """
+    query_budget.clear()
+
+
+@app.errorhandler(sqlite3.OperationalError)
+def handle_interrupted_query(error):
+    if not query_budget.is_exceeded():
+        raise error
+    return jsonify(message='The query ran out of its time budget, narrow it with start and end'), \
+        SERVICE_UNAVAILABLE
+
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(error):
+    app.logger.warning('%s', error)
+    return jsonify(message='Every database connection is busy, retry later'), SERVICE_UNAVAILABLE
+
+
+def limit_concurrency(streamed=False):
+    """
+    Runs a view once one of the HEAVY_QUERY_CONCURRENCY slots of heavy
+    queries is free, answering 503 when none is within HEAVY_QUERY_WAIT
+    seconds. The slot is freed once the view returns, its response being
+    formatted from results already read, or with streamed once the body
+    it reads the database for is exhausted or closed.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if not heavy_queries.acquire():
+                abort(SERVICE_UNAVAILABLE, message='Too many heavy queries are running, retry later')
+            try:
+                response = app.make_response(view(**kwargs))
+            except BaseException:
+                heavy_queries.release()
+                raise
+            if not streamed or not response.is_streamed:
+                heavy_queries.release()
+                return response
+            # A body never read is only closed
+            release, response.response = heavy_queries.hold(response.response)
+            response.call_on_close(release)
+            return response
+        return wrapper
+    return decorator
+
+
+def get_column_store():
+    return get_store(app.config['COLUMNAR_PATH'], app.config['COLUMNAR_SYNC'])
+
+
+def store_readings(readings):
+    """
+    Writes (device_uuid, type, value, date_created) tuples to the storage
+    engine, then to the latest readings and the stream subscribers of
+    their devices. The write versions of their
+    devices are bumped once they're stored, as a response computed in
+    between would be cached stale. On a PartialWrite the readings stored
+    are still published before it's raised.
+    """
+    stored, error = readings, None
+    try:
+        try:
+            if app.config['STORAGE_ENGINE'] == 'columnar':
+                get_column_store().append(readings)
+            else:
+                write_readings(app, readings)
+        except PartialWrite as e:
+            failed = set(e.failed)
+            stored, error = [reading for position, reading in enumerate(readings) if position not in failed], e
+        latest_readings.update(stored)
+        reading_hub.publish(stored)
+    finally:
+        write_versions.bump(set(reading[0] for reading in readings))
+    if error is not None:
+        raise error
+
+
+def load_latest():
+    """
+    Rebuilds the latest readings from the storage engine, a search per
+    device and type of every database file.
+    """
+    latest_readings.clear()
+    if app.config['STORAGE_ENGINE'] == 'columnar':
+        latest_readings.update(get_column_store().iter_latest_readings())
+        return
+    # Files are oldest first, the readings of newer partitions replace those of older ones
+    for db_name in get_db_names(app):
+        with get_db_cursor(app, readonly=True, db_name=db_name) as (cur, conn):
+            latest_readings.update(load_latest_readings(cur))
+
+
+load_latest()
+
+
+def log_flush_error(error, count):
+    app.logger.error('Failed to write %s buffered readings: %s', count, error)
+
+
+def get_write_buffer():
+    """
+    Returns the write buffer of the buffered ingest mode, starting its
+    writer thread on first use.
+    """
+    with write_buffer_lock:
+        write_buffer = app.extensions.get('write_buffer')
+        if write_buffer is None:
+            write_buffer = WriteBuffer(
+                store_readings,
+                max_size=app.config['INGEST_QUEUE_SIZE'],
+                batch_size=app.config['INGEST_BATCH_SIZE'],
+                flush_interval=app.config['INGEST_FLUSH_INTERVAL'],
+                on_error=log_flush_error
+            )
+            write_buffer.start()
+            atexit.register(write_buffer.stop)
+            app.extensions['write_buffer'] = write_buffer
+        return write_buffer
+
+
+def stop_write_buffer():
+    """
+    Drains and stops the write buffer, if one was started.
+    """
+    with write_buffer_lock:
+        write_buffer = app.extensions.pop('write_buffer', None)
+    if write_buffer is not None:
+        write_buffer.stop()
 
 
 @app.route('/devices/<string:device_uuid>/readings/', methods = ['POST'])
 def request_device_readings_post(device_uuid):
+    """
+    This endpoint allows clients to POST a reading as a JSON object, a
+    MessagePack map, a CSV row under its header or a 13 byte binary
+    reading, depending on the Content-Type.
+    """
     # Grab the post parameters
-    create_device_reading_schema = CreateDeviceReading()
-    unmarshal_result = create_device_reading_schema.load(request.data)
-    if unmarshal_result.errors:
-        abort(BAD_REQUEST, message=str(unmarshal_result.errors))
-    post_data = unmarshal_result.data
+    with app_metrics.timed('validation'):
+        try:
+            item = parse_reading(request.get_data(), request.mimetype)
+        except ValueError as e:
+            abort(BAD_REQUEST, message='Invalid body: {}'.format(e))
+        post_data, error = load_reading(item, CreateDeviceReading, functools.partial(get_date_error, app))
+    if error:
+        abort(BAD_REQUEST, message=error)
     sensor_type = post_data.get('type')
     value = post_data.get('value')
     date_created = post_data.get('date_created', int(time.time()))
-    # Insert data into db
-    cur, conn = get_db_cursor(app)
-    cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                (device_uuid, sensor_type, value, date_created))
+    if app.config['INGEST_MODE'] == 'buffered':
+        durable = app.config['INGEST_DURABILITY'] == 'flush'
+        try:
+            pending = get_write_buffer().put((device_uuid, sensor_type, value, date_created), wait=durable)
+        except BufferStopped:
+            abort(SERVICE_UNAVAILABLE, message='The write buffer is shutting down, retry later')
+        except BufferFull:
+            abort(429, message='Too many readings queued, retry later')
+        if not durable:
+            return 'accepted', 202
+        try:
+            pending.wait(app.config['INGEST_WAIT_TIMEOUT'])
+        except WriteTimeout:
+            abort(SERVICE_UNAVAILABLE, message='The reading was not written in time, it may still be')
+        return 'success', 201
 
-    conn.commit()
-    conn.close()
+    # Insert data into db
+    store_readings([(device_uuid, sensor_type, value, date_created)])
     # Return success
     return 'success', 201
 
+
+def insert_readings_batch(schema_class, device_uuid=None):
+    """
+    Validates a JSON array, NDJSON, MessagePack, CSV or binary body in one
+    pass and inserts the valid readings in a single transaction. Invalid
+    items are reported back by index and don't prevent the valid ones from
+    being stored. So are the readings of the database files that failed to
+    commit when others did, as nothing tells a client which were stored
+    otherwise.
+    """
+    with app_metrics.timed('validation'):
+        try:
+            items = parse_readings_batch(request.get_data(), request.mimetype)
+        except ValueError as e:
+            abort(BAD_REQUEST, message='Invalid batch body: {}'.format(e))
+        if len(items) > app.config['BATCH_MAX_READINGS']:
+            abort(413, message='A batch can hold at most {} readings'.format(app.config['BATCH_MAX_READINGS']))
+        valid, errors = load_readings_batch(items, schema_class, functools.partial(get_date_error, app))
+    now = int(time.time())
+    readings = [
+        (device_uuid or reading['device_uuid'], reading['type'], reading['value'], reading.get('date_created', now))
+        for reading in valid
+    ]
+    inserted = len(readings)
+    if readings:
+        try:
+            store_readings(readings)
+        except PartialWrite as e:
+            app.logger.error('%s', e)
+            rejected = set(error['index'] for error in errors)
+            indexes = [index for index in range(len(items)) if index not in rejected]
+            errors = sorted(errors + [dict(index=indexes[position], message='Not stored, retry it')
+                                      for position in e.failed], key=itemgetter('index'))
+            inserted -= len(e.failed)
+
+    if not errors:
+        status = 201
+    elif inserted:
+        status = 207
+    else:
+        status = BAD_REQUEST
+    return jsonify(dict(inserted=inserted, errors=errors)), status
+
+
+@app.route('/devices/<string:device_uuid>/readings/batch/', methods = ['POST'])
+def request_device_readings_batch_post(device_uuid):
+    """
+    This endpoint allows clients to POST many readings for one device
+    in a single request. The body is a JSON array or NDJSON of objects
+    with the same fields as a single POST (type, value, date_created), a
+    MessagePack array of maps, CSV with a header row or a sequence of
+    binary readings.
+    """
+    return insert_readings_batch(CreateDeviceReading, device_uuid)
+
+
+@app.route('/readings/batch/', methods = ['POST'])
+def request_readings_batch_post():
+    """
+    This endpoint allows gateways to POST readings for many devices in a
+    single request. Every item also carries its device_uuid, so the body
+    is JSON, NDJSON, MessagePack or CSV.
+    """
+    return insert_readings_batch(CreateFleetReading)
+
+
+def get_query_params(now=None):
+    """
+    Returns the type, start and end query parameters of a request reading
+    readings, with the default and maximum query windows of its route
+    applied, a missing end being now. The
+    window is resolved once per request, so every use of it agrees on now.
+    """
+    if 'query_params' not in g:
+        try:
+            start, end = get_window(app, request.args.get('start', type=int) or None,
+                                    request.args.get('end', type=int) or None, now=now, limits=get_limits())
+        except ValueError as e:
+            abort(BAD_REQUEST, message=str(e))
+        g.query_params = dict(sensor_type=request.args.get('type', type=str) or None, start=start, end=end)
+    return g.query_params
+
+
+def get_cache_now():
+    """
+    Returns now rounded up to a sixtieth of the default window of the
+    route, so requests defaulting their end share a window, and a cache
+    entry, for that long. Readings written meanwhile still bump the write
+    version, so an entry is never served without them.
+    """
+    now = int(time.time())
+    default_window = get_limits().get('default_window', app.config.get('QUERY_DEFAULT_WINDOW'))
+    if not default_window:
+        return now
+    step = max(1, default_window // 60)
+    return -(-now // step) * step
+
+
+def cached_response(fleet=False):
+    """
+    Serves the 200 responses of a view from the response cache, keyed by
+    path, query parameters and resolved window, while no readings of its
+    device, or of any device with fleet, were written since. A defaulted
+    window ends at get_cache_now, so polls share its entry. The ETag is
+    derived from the same key and write version, so an If-None-Match
+    request for an unchanged response gets a 304 without any query.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if not app.config['RESPONSE_CACHE_SIZE']:
+                return view(**kwargs)
+            params = get_query_params(now=get_cache_now())
+            args = sorted((name, value) for name, value in request.args.items(multi=True)
+                          if name not in ('start', 'end'))
+            key = (request.path, tuple(args), params['start'], params['end'])
+            # Read before running the view, a write meanwhile makes the entry stale rather than wrong
+            version = write_versions.get(None if fleet else kwargs.get('device_uuid'))
+            etag = response_cache.get_etag(key, version)
+            if request.if_none_match.contains(etag):
+                response_cache.count('not_modified')
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            cached = response_cache.get(key, version)
+            if cached is None:
+                response = app.make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+                cached = (response.get_data(), response.mimetype,
+                          [(name, value) for name, value in response.headers if name.startswith('X-')])
+                response_cache.put(key, version, *cached)
+            body, mimetype, headers = cached
+            response = Response(body, status=200, headers=headers, mimetype=mimetype)
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+
+def query_partitions(device_uuid, params, query):
+    """
+    Runs query(cur, filters) on every partition holding readings between
+    the start and end of params, oldest first, and returns the results of
+    those where the device and type were stored.
+    """
+    results = []
+    for db_name in get_db_names(app, params['start'], params['end'], device_uuid):
+        with get_db_cursor(app, readonly=True, db_name=db_name) as (cur, conn):
+            filters = get_filters(app, cur, device_uuid, db_name=db_name, **params)
+            if filters is not None:
+                results.append(query(cur, filters))
+    return results
+
+
+# Ids get_names looks up per statement, the last one repeated to fill a
+# batch so every lookup has the same statement shape
+NAMES_BATCH_SIZE = 256
+
+
+def get_names(db_name, table, column, ids=None):
+    """
+    Returns the names of the ids of a table of a database file, every id
+    of it with ids None.
+    """
+    with get_db_cursor(app, readonly=True, db_name=db_name) as (cur, conn):
+        if ids is None:
+            cur.execute('select id, {} from {}'.format(column, table))
+            return dict(cur.fetchall())
+        ids = sorted(ids)
+        names = {}
+        statement = 'select id, {} from {} where id in ({})'.format(column, table, ', '.join(['?'] * NAMES_BATCH_SIZE))
+        for offset in range(0, len(ids), NAMES_BATCH_SIZE):
+            batch = ids[offset:offset + NAMES_BATCH_SIZE]
+            cur.execute(statement, batch + batch[-1:] * (NAMES_BATCH_SIZE - len(batch)))
+            names.update(cur.fetchall())
+        return names
+
+
+def add_names(db_name, table, column, names, ids):
+    """
+    Adds to names the names of the ids it lacks, read from a table of a
+    database file.
+    """
+    missing = set(ids).difference(names)
+    if missing:
+        names.update(get_names(db_name, table, column, missing))
+
+
+def iter_keyset_chunks(db_name, get_query, get_key, after=None, limit=None, chunk_size=1000):
+    """
+    Yields the rows of get_query(after, size) a chunk at a time, after
+    being the (date_created, rowid) keyset get_key returns for the last
+    row read. Every chunk is read on a pooled connection returned before
+    the chunk is yielded, so a client reading slowly never holds one.
+    """
+    while limit is None or limit > 0:
+        size = chunk_size if limit is None else min(chunk_size, limit)
+        with get_db_cursor(app, readonly=True, db_name=db_name) as (cur, conn):
+            cur.execute(*get_query(after, size))
+            rows = cur.fetchall()
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = get_key(rows[-1])
+        if limit is not None:
+            limit -= len(rows)
+
+
+def iter_reading_rows(device_uuid, params, after=None, limit=None):
+    """
+    Yields chunks of (rowid, type_id, value, date_created) rows matching
+    the query params, ordered by date_created and rowid, starting after
+    the (date_created, rowid) of a keyset cursor, each with the JSON type
+    names of its partition. Partitions don't overlap in time, so the
+    cursor orders rows across them too. Every chunk is read with a query
+    of its own from the keyset of the previous one, so no connection is
+    held while a chunk is written to the client.
+    """
+    if app.config['STORAGE_ENGINE'] == 'columnar':
+        for chunk in get_column_store().iter_reading_rows(
+                device_uuid, after=after, limit=limit, chunk_size=app.config['READINGS_CHUNK_SIZE'], **params):
+            yield chunk
+        return
+
+    start = params['start']
+    if after is not None and (start is None or after[0] > start):
+        start = after[0]
+    for db_name in get_db_names(app, start, params['end'], device_uuid):
+        if limit is not None and limit <= 0:
+            return
+        with get_db_cursor(app, readonly=True, db_name=db_name) as (cur, conn):
+            filters = get_filters(app, cur, device_uuid, db_name=db_name, **params)
+        if filters is None:
+            continue
+        type_names = {}
+        for rows in iter_keyset_chunks(db_name, functools.partial(readings_page, filters), itemgetter(3, 0),
+                                       after, limit, app.config['READINGS_CHUNK_SIZE']):
+            # Types stored since the previous chunk was read
+            if any(row[1] not in type_names for row in rows):
+                type_names = dict((type_id, json.dumps(name))
+                                  for type_id, name in get_names(db_name, 'sensor_types', 'name').items())
+            after = itemgetter(3, 0)(rows[-1])
+            if limit is not None:
+                limit -= len(rows)
+            yield type_names, rows
+
+
+def get_page_limit(limit):
+    """
+    Returns the limit of a page, at most the max_rows of the route.
+    """
+    max_rows = get_limits().get('max_rows')
+    if max_rows and (limit is None or limit > max_rows):
+        return max_rows
+    return limit
+
+
 @app.route('/devices/<string:device_uuid>/readings/', methods = ['GET'])
 def request_device_readings_get(device_uuid):
     """
@@ -52,18 +631,151 @@ def request_device_readings_get(device_uuid):
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
+    * limit -> The maximum number of readings to return
+    * cursor -> The X-Next-Cursor header of the previous page
+    * format -> json (the default) or ndjson
+
+    Readings are sorted by date_created and read from the database a
+    chunk at a time as they are written out. With a limit, the X-Next-Cursor header holds the
+    cursor of the next page when more readings are left. The max_rows of
+    the route's QUERY_LIMITS caps the limit, and sets one when missing.
     """
-    # Execute the query
-    where_statement = get_where_statement(device_uuid, request.args)
-    cur, conn = get_db_cursor(app)
-    cur.execute('select * from readings where {}'.format(where_statement))
-    rows = cur.fetchall()
-    # Return the JSON
-    conn.close()
-    return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        abort(BAD_REQUEST, message='limit should be a positive integer')
+    limit = get_page_limit(limit)
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_cursor(request.args['cursor'], (int, int))
+        except ValueError:
+            abort(BAD_REQUEST, message='Invalid cursor')
+    ndjson = request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
+    params = get_query_params()
+
+    headers = {}
+    if limit is None:
+        chunks = iter_reading_rows(device_uuid, params, after)
+    else:
+        # A page is small, read it first to know whether another one follows
+        chunks = list(iter_reading_rows(device_uuid, params, after, limit + 1))
+        if sum(len(rows) for type_names, rows in chunks) > limit:
+            type_names, rows = chunks.pop()
+            if len(rows) > 1:
+                chunks.append((type_names, rows[:-1]))
+            last = chunks[-1][1][-1]
+            headers['X-Next-Cursor'] = encode_cursor([last[3], last[0]])
+
+    # Readings are written out straight from the rows, with the keys sorted like jsonify does
+    device_json = json.dumps(device_uuid)
+    template = '{{"date_created": {}, "device_uuid": ' + device_json.replace('{', '{{').replace('}', '}}') + \
+        ', "type": {}, "value": {}}}'
+
+    def format_row(type_names, row):
+        return template.format(
+            'null' if row[3] is None else row[3],
+            type_names[row[1]],
+            'null' if row[2] is None else row[2]
+        )
+
+    def format_rows(type_names, rows):
+        with app_metrics.timed('serialization'):
+            if ndjson:
+                return ''.join(format_row(type_names, row) + '\n' for row in rows)
+            return ','.join(format_row(type_names, row) for row in rows)
+
+    def generate():
+        if ndjson:
+            for type_names, rows in chunks:
+                yield format_rows(type_names, rows)
+            return
+        yield '['
+        separator = ''
+        for type_names, rows in chunks:
+            if rows:
+                yield separator + format_rows(type_names, rows)
+                separator = ','
+        yield ']'
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(query_budget.bind_iterator(generate()), status=200, headers=headers, mimetype=mimetype)
+
+
+def get_device_stats(device_uuid, metrics):
+    """
+    Computes metrics of a device's readings matching the type/start/end
+    query parameters, all of them from a single histogram of the readings.
+    """
+    params = get_query_params()
+    if app.config['STORAGE_ENGINE'] == 'columnar':
+        return summarize(get_column_store().get_histogram(device_uuid, **params), metrics)
+    histograms = query_partitions(device_uuid, params, get_histogram)
+    return summarize(merge_histograms(histograms) if histograms else [], metrics)
+
+
+@app.route('/devices/<string:device_uuid>/readings/stats/', methods = ['GET'])
+@cached_response()
+def request_device_readings_stats(device_uuid):
+    """
+    This endpoint allows clients to GET several metrics of a device's
+    sensor readings at once.
+
+    Optional Query Parameters
+    * metrics -> Comma separated metrics among number_of_readings, min,
+        max, mean, median, mode and quartiles. Defaults to all of them.
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    """
+    metrics = []
+    for metric in request.args.get('metrics', ','.join(STATS_METRICS)).split(','):
+        metric = metric.strip()
+        if metric not in STATS_METRICS:
+            abort(BAD_REQUEST, message='Invalid metric {}, should be one of {}'.format(metric, ', '.join(STATS_METRICS)))
+        metrics.extend(['quartile_1', 'quartile_3'] if metric == 'quartiles' else [metric])
+
+    data = dict((metric, None) for metric in metrics)
+    data.update(get_device_stats(device_uuid, metrics))
+    return jsonify(data), 200
+
+
+@app.route('/devices/<string:device_uuid>/readings/series/', methods = ['GET'])
+@cached_response()
+def request_device_readings_series(device_uuid):
+    """
+    This endpoint allows clients to GET a device's sensor readings
+    downsampled to one point per interval, each with its start,
+    number_of_readings, min, max and mean.
+
+    Optional Query Parameters
+    * interval -> The length of a point, like 5m, 1h or 1d. Defaults to 1h
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    """
+    try:
+        interval = parse_interval(request.args.get('interval', '1h'))
+    except ValueError as e:
+        abort(BAD_REQUEST, message=str(e))
+
+    params = get_query_params()
+    if params['start'] is not None and params['end'] is not None:
+        points = (params['end'] // interval) - (params['start'] // interval) + 1
+        if points > app.config['SERIES_MAX_POINTS']:
+            abort(BAD_REQUEST, message='Too many points ({}), should be at most {}, use a larger interval'.format(
+                points, app.config['SERIES_MAX_POINTS']))
+
+    if app.config['STORAGE_ENGINE'] == 'columnar':
+        rows = get_column_store().get_series_rows(device_uuid, interval, **params)
+    else:
+        # Partitions are oldest first, chaining their rows keeps them ordered by date
+        rows = sum(query_partitions(
+            device_uuid, params, lambda cur, filters: get_series_rows(cur, filters, interval)), [])
+    return jsonify(get_series(rows, interval)), 200
 
 
 @app.route('/devices/<string:device_uuid>/readings/quartiles/', methods = ['GET'])
+@cached_response()
 def request_device_readings_quartiles(device_uuid):
     """
     This endpoint allows clients to GET the 1st and 3rd quartile
@@ -73,29 +785,12 @@ def request_device_readings_quartiles(device_uuid):
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
-    # TODO: implement a better database to be able to calculate quartiles properly
-    #
-    """
-    where_statement = get_where_statement(device_uuid, request.args)
-    where_statement = where_statement if where_statement else 'where 1'
-
-    cur, conn = get_db_cursor(app)
-    query = '''
-    select value, NTILE(4) OVER(ORDER BY value) as quartile from readings where {}
-    '''.format(where_statement)
-    cur.execute(query)
-    rows = cur.fetchall()
-    data = {}
-    for row in rows:
-        if row['quartile'] == 1:
-            data['quartile_1'] = row['value']
-        if row['quartile'] == 3:
-            data['quartile_3'] = row['value']
-    conn.close()
-    return jsonify(data), 200
+    """
+    return jsonify(get_device_stats(device_uuid, ['quartile_1', 'quartile_3'])), 200
 
 
 @app.route('/devices/<string:device_uuid>/readings/<string:metric>/', methods = ['GET'])
+@cached_response()
 def request_device_readings_min(device_uuid, metric):
     """
     This endpoint allows clients to GET the max sensor reading for a device.
@@ -110,41 +805,194 @@ def request_device_readings_min(device_uuid, metric):
     if metric not in ['min', 'max', 'mean', 'median', 'mode']:
         return 'Invalid value for metric', 404
 
-    where_statement = get_where_statement(device_uuid, request.args)
-
-    cur, conn = get_db_cursor(app)
-    if metric == 'median':
-        query = '''
-        SELECT AVG(value) as total
-            FROM (
-            SELECT value
-                  FROM readings where {}
-                  ORDER BY value
-                  LIMIT 2 - (SELECT COUNT(*) FROM readings where {}) % 2    -- odd 1, even 2
-                  OFFSET (SELECT (COUNT(*) - 1) / 2 FROM readings where {}))
-        '''.format(where_statement, where_statement, where_statement)
-        cur.execute(query)
-        row = cur.fetchone()
-        total = row['total']
-        response = jsonify(dict(value=total)), 200
-    elif metric == 'mode':
-        cur.execute('select `value`, count(*) as n from readings where {} group by value order by 2 DESC limit 1'.format(where_statement))
-        row = cur.fetchone()
-        total = row['value']
-        response = jsonify(dict(value=total)), 200
+    # Return the JSON
+    return jsonify(dict(value=get_device_stats(device_uuid, [metric])[metric])), 200
+
+
+def parse_devices(devices):
+    """
+    Returns the sorted uuids of a comma separated devices parameter, None
+    when there are none.
+    """
+    device_uuids = sorted(set(uuid.strip() for uuid in (devices or '').split(',') if uuid.strip()))
+    return device_uuids or None
+
+
+@app.route('/devices/<string:device_uuid>/readings/latest/', methods = ['GET'])
+def request_device_readings_latest(device_uuid):
+    """
+    This endpoint allows clients to GET the last reading of a device for
+    each sensor type, answered from memory.
+
+    Optional Query Parameters
+    * type -> The type of sensor value a client is looking for
+    """
+    return jsonify(latest_readings.get(device_uuid, request.args.get('type', type=str) or None)), 200
+
+
+@app.route('/readings/latest/', methods = ['GET'])
+def request_readings_latest():
+    """
+    This endpoint allows clients to GET the last reading of many devices
+    for each sensor type in one call, answered from memory.
+
+    Optional Query Parameters
+    * devices -> Comma separated device uuids. Defaults to every device.
+    * type -> The type of sensor value a client is looking for
+    """
+    device_uuids = parse_devices(request.args.get('devices')) or latest_readings.list_devices()
+    sensor_type = request.args.get('type', type=str) or None
+    return jsonify([reading for device_uuid in device_uuids
+                    for reading in latest_readings.get(device_uuid, sensor_type)]), 200
+
+
+def get_stream_params(args, last_event_id=None, device_uuid=None, now=None):
+    """
+    Returns the device uuids (None for the whole fleet), type, resume date
+    and current date of a stream request from its query parameters, which
+    may be those of a Flask or an aiohttp request, and Last-Event-ID
+    header. Raises ValueError when they're invalid.
+    """
+    if device_uuid is not None:
+        device_uuids = [device_uuid]
     else:
-        if metric == 'mean':
-            metric = 'avg'
-        cur.execute('select {}(value) as value from readings where {}'.format(metric, where_statement))
-        row = cur.fetchone()
-        # Return the JSON
-        response = jsonify(dict(zip(['value'], row))), 200
-
-    conn.close()
+        device_uuids = parse_devices(args.get('devices'))
+    until = int(time.time()) if now is None else now
+    # The Last-Event-ID of a reconnecting client is more recent than the since it first connected with
+    since = last_event_id or args.get('since') or None
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            raise ValueError('since should be an epoch date')
+        get_window(app, since, until)
+    return device_uuids, args.get('type') or None, since, until
+
+
+def iter_backfill(device_uuids, sensor_type, since, until):
+    """
+    Yields the events of the readings stored from since to until, device
+    by device. They aren't ordered across devices so they carry no id, an
+    event with the until id follows them: a client disconnected meanwhile
+    resumes from since again.
+    """
+    params = dict(sensor_type=sensor_type, start=since, end=until)
+    for device_uuid in device_uuids:
+        for type_names, rows in iter_reading_rows(device_uuid, params):
+            names = dict((type_id, json.loads(name)) for type_id, name in type_names.items())
+            yield ''.join(format_reading_event((device_uuid, names[row[1]], row[2], row[3]), with_id=False)
+                          for row in rows)
+    yield 'id: {}\n\n'.format(until)
+
+
+def open_stream(device_uuid=None):
+    """
+    Subscribes to the readings of the stream request's devices and returns
+    its response: the readings stored since the resume date, then those
+    published as they're written, with heartbeats while there are none.
+    """
+    try:
+        device_uuids, sensor_type, since, until = get_stream_params(
+            request.args, request.headers.get('Last-Event-ID'), device_uuid)
+    except ValueError as e:
+        abort(BAD_REQUEST, message=str(e))
+    # Subscribed before reading the stored readings so none falls in between
+    subscription = reading_hub.subscribe(device_uuids, sensor_type, app.config['STREAM_BUFFER_SIZE'])
+    backfill = iter_backfill(device_uuids, sensor_type, since, until) if since is not None and device_uuids else []
+
+    def generate():
+        try:
+            for events in backfill:
+                yield events
+            while True:
+                readings, dropped = subscription.get(app.config['STREAM_HEARTBEAT'])
+                yield format_events(readings, dropped) if readings or dropped else HEARTBEAT
+        finally:
+            subscription.close()
+
+    response = Response(generate(), status=200, headers=STREAM_HEADERS, mimetype='text/event-stream')
+    # The generator's finally doesn't run when it's never started
+    response.call_on_close(subscription.close)
     return response
 
 
+@app.route('/devices/<string:device_uuid>/readings/stream/', methods = ['GET'])
+def request_device_readings_stream(device_uuid):
+    """
+    This endpoint allows clients to follow a device's readings as they're
+    written, as Server-Sent Events.
+
+    Optional Query Parameters
+    * type -> The type of sensor value a client is looking for
+    * since -> The epoch date to send the stored readings from first. The
+        Last-Event-ID header of a reconnecting client takes precedence.
+    """
+    return open_stream(device_uuid)
+
+
+@app.route('/readings/stream/', methods = ['GET'])
+def request_readings_stream():
+    """
+    This endpoint allows clients to follow the readings of many devices
+    as they're written, as Server-Sent Events.
+
+    Optional Query Parameters
+    * devices -> Comma separated device uuids. Defaults to every device.
+    * type -> The type of sensor value a client is looking for
+    * since -> The epoch date to send the stored readings of the devices
+        from first, only with devices.
+    """
+    return open_stream()
+
+
+def load_device_histograms(db_name, params):
+    """
+    Returns the (device_uuid, histogram) pairs of the devices of a
+    database file with readings matching the query params, sorted by uuid.
+    """
+    with get_db_cursor(app, readonly=True, db_name=db_name) as (cur, conn):
+        filters = get_filters(app, cur, db_name=db_name, **params)
+        if filters is None:
+            return []
+        cur.execute('select id, uuid from devices')
+        device_uuids = dict(cur.fetchall())
+        return sorted((device_uuids[device_id], histogram)
+                      for device_id, histogram in get_device_histograms(conn, filters))
+
+
+def iter_device_histograms(params):
+    """
+    Yields (device_uuid, histogram) for every device with readings
+    matching the query params. A single database file is streamed device
+    by device. Shards and partitions are read in parallel and their
+    devices merged by uuid, a device spanning partitions getting the
+    merged histogram of all of them.
+    """
+    if app.config['STORAGE_ENGINE'] == 'columnar':
+        for device_histogram in get_column_store().iter_device_histograms(**params):
+            yield device_histogram
+        return
+
+    db_names = get_db_names(app, params['start'], params['end'])
+    if len(db_names) == 1:
+        with get_db_cursor(app, readonly=True, db_name=db_names[0]) as (cur, conn):
+            filters = get_filters(app, cur, db_name=db_names[0], **params)
+            if filters is None:
+                return
+            cur.execute('select id, uuid from devices')
+            device_uuids = dict(cur.fetchall())
+            for device_id, histogram in get_device_histograms(conn, filters):
+                yield device_uuids[device_id], histogram
+        return
+
+    parts = fan_out(app, lambda db_name: load_device_histograms(db_name, params), db_names)
+    for device_uuid, rows in groupby(heapq.merge(*parts), key=itemgetter(0)):
+        yield device_uuid, merge_histograms([histogram for _device_uuid, histogram in rows])
+
+
 @app.route('/readings/summary/', methods = ['GET'])
+@cached_response(fleet=True)
+@limit_concurrency()
 def request_readings_summary():
     """
     This endpoint allows clients to GET a full summary
@@ -154,70 +1002,145 @@ def request_readings_summary():
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * limit -> The maximum number of device summaries to return
+    * cursor -> The X-Next-Cursor header of the previous page
+
+    Summaries are sorted by number_of_readings, descending. When more
+    devices are left, the X-Next-Cursor header holds the cursor of the
+    next page. The max_rows of the route's QUERY_LIMITS caps the limit.
+    Only HEAVY_QUERY_CONCURRENCY summaries are computed at once.
     """
-    where_statement = get_where_statement(args=request.args)
-    where_statement = where_statement if where_statement else '1=1'
-    cur, conn = get_db_cursor(app)
-    query = '''
-    select 
-        device_uuid,
-        min(value) as `min`,
-        max(value) as `max`,
-        avg(value) as `mean`,
-        (
-        select value from (select value, ntile(4) over (order by value) as q from readings where {} and device_uuid=main_readings.device_uuid) as q1 where q = 1
-        ) as quartile_1,
-        (
-        select value from (select value, ntile(4) over (order by value) as q from readings where {} and device_uuid=main_readings.device_uuid) as q1 where q = 3
-        ) as quartile_3,  
-        (
-        SELECT AVG(value) 
-        FROM (
-        SELECT value
-              FROM readings where {} and device_uuid=main_readings.device_uuid
-              ORDER BY value
-              LIMIT 2 - (SELECT COUNT(*) FROM readings where {}) % 2    -- odd 1, even 2
-              OFFSET (SELECT (COUNT(*) - 1) / 2 FROM readings where {}))
-        ) as median,
-        (
-            select value from (select `value`, count(*) as n from readings where {} and device_uuid=main_readings.device_uuid group by value order by 2 DESC limit 1)
-        ) as `mode`       
-    from readings as main_readings where {} group by device_uuid
-    '''.format(
-        where_statement,
-        where_statement,
-        where_statement,
-        where_statement,
-        where_statement,
-        where_statement,
-        where_statement
-    )
-    cur.execute(query)
-    rows = cur.fetchall()
-    data = []
-    for row in rows:
-        min = row['min']
-        max = row['max']
-        mean = row['mean']
-        quartile_1 = row['quartile_1']
-        quartile_3 = row['quartile_3']
-        median = row['median']
-        mode = row['mode']
-        data.append(dict(
-            device_uuid=row['device_uuid'],
-            min=min,
-            max=max,
-            mean=mean,
-            quartile_1=quartile_1,
-            quartile_3=quartile_3,
-            median=median,
-            mode=mode
-        ))
-
-
-    conn.close()
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        abort(BAD_REQUEST, message='limit should be a positive integer')
+    limit = get_page_limit(limit)
+    after = None
+    if request.args.get('cursor'):
+        try:
+            number_of_readings, device_uuid = decode_cursor(request.args['cursor'], (int, str))
+        except ValueError:
+            abort(BAD_REQUEST, message='Invalid cursor')
+        after = (-number_of_readings, device_uuid)
+
+    params = get_query_params()
+
+    def iter_summaries():
+        # One pass over the histograms ordered by device, a summary per device
+        for device_uuid, histogram in iter_device_histograms(params):
+            summary = dict((metric, None) for metric in SUMMARY_METRICS)
+            summary.update(summarize(histogram, SUMMARY_METRICS))
+            summary['device_uuid'] = device_uuid
+            key = (-summary['number_of_readings'], summary['device_uuid'])
+            if after is None or key > after:
+                yield key, summary
+
+    if limit is None:
+        page = sorted(iter_summaries(), key=itemgetter(0))
+    else:
+        # A heap of the limit + 1 first summaries, whatever the number of devices
+        page = heapq.nsmallest(limit + 1, iter_summaries(), key=itemgetter(0))
+    headers = {}
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        headers['X-Next-Cursor'] = encode_cursor([-page[-1][0][0], page[-1][0][1]])
+
+    def generate():
+        yield '['
+        for index, (key, summary) in enumerate(page):
+            yield (',' if index else '') + json.dumps(summary)
+        yield ']'
+
+    return Response(generate(), status=200, headers=headers, mimetype='application/json')
+
+
+def iter_export_chunks(device_uuids, params):
+    """
+    Yields the readings matching the query params of devices, or of every
+    device with device_uuids None, in the chunks of export.py. Every
+    chunk of EXPORT_CHUNK_SIZE rows of a database file is read over a
+    covering index from the keyset of the previous one, so no connection
+    is held while a chunk is written to the client. Readings are ordered
+    by date within a database file, or a device with device_uuids. Only
+    the names of the devices and types a chunk adds are read.
+    """
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+    if app.config['STORAGE_ENGINE'] == 'columnar':
+        for chunk in get_column_store().iter_export_chunks(device_uuids, chunk_size=chunk_size, **params):
+            yield chunk
+        return
+
+    if device_uuids is None:
+        sources = [(None, db_name) for db_name in get_db_names(app, params['start'], params['end'])]
+    else:
+        sources = [(device_uuid, db_name) for device_uuid in device_uuids
+                   for db_name in get_db_names(app, params['start'], params['end'], device_uuid)]
+    db_type_names = {}
+    for device_uuid, db_name in sources:
+        with get_db_cursor(app, readonly=True, db_name=db_name) as (cur, conn):
+            filters = get_filters(app, cur, device_uuid, db_name=db_name, **params)
+        if filters is None:
+            continue
+        type_names = db_type_names.setdefault(db_name, {})
+        device_names = {} if device_uuid is None else {filters['device_id']: device_uuid}
+        for rows in iter_keyset_chunks(db_name, functools.partial(export_readings, filters), itemgetter(3, 4),
+                                       chunk_size=chunk_size):
+            device_ids, type_ids, values, dates, rowids = zip(*rows)
+            add_names(db_name, 'sensor_types', 'name', type_names, type_ids)
+            add_names(db_name, 'devices', 'uuid', device_names, device_ids)
+            yield device_names, type_names, (device_ids, type_ids, values, dates)
+
+
+@app.route('/readings/export/', methods = ['GET'])
+@limit_concurrency(streamed=True)
+def request_readings_export():
+    """
+    This endpoint allows clients to GET the readings of the fleet, or of
+    many devices, in bulk as NDJSON, CSV or Arrow IPC record batches.
+
+    Optional Query Parameters
+    * devices -> Comma separated device uuids. Defaults to every device.
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * format -> ndjson (the default), csv or arrow, or the Accept header's
+
+    Readings are streamed as they're read, in chunks of EXPORT_CHUNK_SIZE.
+    An export holds one of the HEAVY_QUERY_CONCURRENCY slots until its
+    body is written. It has no time budget unless EXPORT_TIME_BUDGET or
+    the max_seconds of the route sets one, since a body cut short after
+    its 200 would leave the client a truncated file.
+    """
+    export_format = request.args.get('format')
+    if export_format is None:
+        best = request.accept_mimetypes.best_match(list(export.FORMATS.values()))
+        export_format = dict((mimetype, name) for name, mimetype in export.FORMATS.items()).get(best, 'ndjson')
+    if export_format not in export.FORMATS:
+        abort(BAD_REQUEST, message='format should be one of {}'.format(', '.join(sorted(export.FORMATS))))
+    if export_format == 'arrow' and export.pyarrow is None:
+        abort(NOT_ACCEPTABLE, message='Arrow exports need the pyarrow package')
+    params = get_query_params()
+    chunks = iter_export_chunks(parse_devices(request.args.get('devices')), params)
+    return Response(query_budget.bind_iterator(export.WRITERS[export_format](chunks)), status=200,
+                    mimetype=export.FORMATS[export_format])
+
+
+@app.route('/cache/stats/', methods = ['GET'])
+def request_cache_stats():
+    """
+    This endpoint allows clients to GET the hits, misses, 304s and
+    evictions of the response cache, with its entries and bytes.
+    """
+    return jsonify(response_cache.get_stats()), 200
+
+
+@app.route('/metrics', methods = ['GET'])
+def request_metrics():
+    """
+    This endpoint allows Prometheus to scrape the request, phase and
+    statement metrics of the process.
+    """
+    return Response(app_metrics.render(), status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
 
-    return jsonify(data), 200
 
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,9 @@
+"""
+Load benchmarks of the API on a synthetic fleet:
+
+    python -m benchmarks run --devices 1000 --readings 1000000 --output before.json
+    python -m benchmarks compare before.json after.json
+
+fleet.py generates and bulk-loads readings, load.py sends open-loop load
+to the Flask test client or a live server and measures its latencies.
+"""
@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks.fleet import get_device_uuids, generate_fleet, load_fleet
+from benchmarks.load import ClientTarget, HttpTarget, run_open_loop, ingest_scenario, device_query_scenario, \
+    summary_scenario
+
+SCENARIOS = ['ingest', 'device_query', 'summary']
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_target(args):
+    if args.url:
+        return HttpTarget(args.url)
+    # Read by app.py when it's imported, so the benchmark never touches database.db
+    os.environ['DB_NAME'] = args.database
+    from app import app
+    from utils import reset_db
+    reset_db(app)
+    return ClientTarget(app)
+
+
+def run(args):
+    target = get_target(args)
+    end = int(time.time())
+    start = end - int(args.days * 86400)
+    device_uuids = get_device_uuids(args.devices)
+    results = dict(
+        commit=get_commit(),
+        created=end,
+        target=args.url or 'test-client',
+        config=dict(devices=args.devices, readings=args.readings, days=args.days, rate=args.rate,
+                    duration=args.duration, workers=args.workers, window=args.window, seed=args.seed),
+        scenarios={}
+    )
+    if args.readings:
+        count, seconds = load_fleet(target, generate_fleet(args.devices, args.readings, start, end, args.seed),
+                                    args.batch_size)
+        results['load'] = dict(readings=count, seconds=round(seconds, 3),
+                               readings_per_second=round(count / seconds, 1) if seconds else None)
+        print('load: {} readings in {:.1f}s'.format(count, seconds), file=sys.stderr)
+
+    scenarios = dict(
+        ingest=ingest_scenario(device_uuids),
+        device_query=device_query_scenario(device_uuids, start, end, args.window),
+        summary=summary_scenario(start, end, args.window),
+    )
+    for name in args.scenarios:
+        result = run_open_loop(target, scenarios[name], args.rate, args.duration, args.workers,
+                               random.Random(args.seed))
+        results['scenarios'][name] = result
+        print('{}: {} requests, {} errors, {} req/s, p50 {p50}ms p95 {p95}ms p99 {p99}ms'.format(
+            name, result['requests'], result['errors'], result['throughput'], **result['latency_ms']),
+            file=sys.stderr)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+def get_regressions(before, after, threshold):
+    """
+    Returns descriptions of the latencies of after more than threshold
+    (a fraction) above those of before, and of its throughputs more than
+    threshold below.
+    """
+    regressions = []
+    for name, result in sorted(after.get('scenarios', {}).items()):
+        previous = before.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        for percentile in ('p50', 'p95', 'p99'):
+            old, new = previous['latency_ms'][percentile], result['latency_ms'][percentile]
+            if old and new and new > old * (1 + threshold):
+                regressions.append('{} {}: {}ms -> {}ms'.format(name, percentile, old, new))
+        old, new = previous['throughput'], result['throughput']
+        if old and new and new < old * (1 - threshold):
+            regressions.append('{} throughput: {} -> {} req/s'.format(name, old, new))
+    old = before.get('load', {}).get('readings_per_second')
+    new = after.get('load', {}).get('readings_per_second')
+    if old and new and new < old * (1 - threshold):
+        regressions.append('load: {} -> {} readings/s'.format(old, new))
+    return regressions
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before.get('config') != after.get('config'):
+        print('The runs have different configs, comparing them anyway', file=sys.stderr)
+    regressions = get_regressions(before, after, args.threshold)
+    for regression in regressions:
+        print(regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmarks the API on a synthetic fleet.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='Loads a fleet, runs the load scenarios and reports them as JSON')
+    run_parser.add_argument('--url', help='Base URL of a live server, e.g. http://127.0.0.1:5000. '
+                                          'Defaults to the Flask test client')
+    run_parser.add_argument('--database', default='benchmark.db',
+                            help='Database file of the test client, emptied first')
+    run_parser.add_argument('--devices', type=int, default=100)
+    run_parser.add_argument('--readings', type=int, default=10000, help='Readings to load first, 0 loads none')
+    run_parser.add_argument('--days', type=float, default=7, help='Days the loaded readings span, up to now')
+    run_parser.add_argument('--batch-size', type=int, default=10000)
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    run_parser.add_argument('--rate', type=float, default=50, help='Requests a second of every scenario')
+    run_parser.add_argument('--duration', type=float, default=10, help='Seconds of every scenario')
+    run_parser.add_argument('--workers', type=int, default=32, help='Requests in flight at most')
+    run_parser.add_argument('--window', type=int, default=86400, help='Seconds of readings a query reads')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='JSON file of the results, printed by default')
+
+    compare_parser = commands.add_parser('compare', help='Lists the regressions between two runs, exits 1 on any')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='Fraction of change reported, 0.2 by default')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
@@ -0,0 +1,66 @@
+import bisect
+import json
+import math
+import random
+import time
+
+SENSOR_TYPES = ['temperature', 'humidity']
+
+
+def get_device_uuids(devices):
+    return ['bench-{:06d}'.format(i) for i in range(devices)]
+
+
+def generate_fleet(devices, readings, start, end, seed=0):
+    """
+    Yields readings dicts of a synthetic fleet, ordered by date_created
+    from start to end. Devices report at very different rates, a few of
+    them a lot and most rarely (a Zipf-like law), and each device has its
+    own baseline per sensor type around which values follow the time of
+    day with some noise, clipped to the valid 0 to 100.
+    """
+    rand = random.Random(seed)
+    device_uuids = get_device_uuids(devices)
+    weights = []
+    total = 0.0
+    for rank in range(devices):
+        total += 1.0 / (rank + 1) ** 0.8
+        weights.append(total)
+    baselines = dict((device_uuid, dict(temperature=rand.gauss(45, 12), humidity=rand.gauss(55, 15)))
+                     for device_uuid in device_uuids)
+
+    for i in range(readings):
+        date_created = start + (end - start) * i // readings
+        device_uuid = device_uuids[bisect.bisect(weights, rand.random() * total)]
+        sensor_type = SENSOR_TYPES[0] if rand.random() < 0.6 else SENSOR_TYPES[1]
+        # Temperature peaks in the afternoon, humidity at night
+        daily = math.sin(2 * math.pi * ((date_created % 86400) / 86400.0 - 0.375))
+        swing = 8 if sensor_type == 'temperature' else -10
+        value = baselines[device_uuid][sensor_type] + swing * daily + rand.gauss(0, 3)
+        yield dict(device_uuid=device_uuid, type=sensor_type, value=int(min(100, max(0, round(value)))),
+                   date_created=date_created)
+
+
+def load_fleet(target, readings, batch_size=10000):
+    """
+    Posts readings to /readings/batch/ of a target batch by batch and
+    returns their number and the seconds it took.
+    """
+    count = 0
+    started = time.time()
+    batch = []
+    for reading in readings:
+        batch.append(reading)
+        if len(batch) == batch_size:
+            count += post_batch(target, batch)
+            batch = []
+    if batch:
+        count += post_batch(target, batch)
+    return count, time.time() - started
+
+
+def post_batch(target, batch):
+    status = target.request('POST', '/readings/batch/', json.dumps(batch))
+    if status != 201:
+        raise RuntimeError('Loading a batch of readings failed with {}'.format(status))
+    return len(batch)
@@ -0,0 +1,155 @@
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from urllib.parse import urlsplit
+
+from benchmarks.fleet import SENSOR_TYPES
+
+DEVICE_QUERIES = ['max', 'mean', 'median', 'mode', 'quartiles', 'stats']
+
+
+class ClientTarget(object):
+    """
+    Serves requests in process with the Flask test client, measuring the
+    app without any network or server in between.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=None):
+        response = self.app.test_client().open(path, method=method, data=body, content_type='application/json')
+        response.get_data()
+        return response.status_code
+
+
+class HttpTarget(object):
+    """
+    Sends requests to a live server, over a keep-alive connection per
+    thread.
+    """
+
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request(method, path, body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except Exception:
+            conn.close()
+            self.local.conn = None
+            raise
+
+
+def get_percentile(values, percent):
+    """
+    Returns the nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def summarize_latencies(latencies, errors, seconds, rate):
+    latencies = sorted(latencies)
+    milliseconds = lambda value: None if value is None else round(value * 1000, 3)
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        seconds=round(seconds, 3),
+        offered_rate=rate,
+        throughput=round(len(latencies) / seconds, 2) if seconds else None,
+        latency_ms=dict(
+            mean=milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+            p50=milliseconds(get_percentile(latencies, 50)),
+            p95=milliseconds(get_percentile(latencies, 95)),
+            p99=milliseconds(get_percentile(latencies, 99)),
+            max=milliseconds(latencies[-1]) if latencies else None,
+        )
+    )
+
+
+def run_open_loop(target, make_request, rate, duration, workers=32, rand=None):
+    """
+    Sends rate requests a second for duration seconds on a fixed schedule,
+    however long the responses take, and summarizes their latencies.
+    Latencies count from when each request was due rather than sent, so
+    requests held up behind slow ones aren't left out of the tail (no
+    coordinated omission). Requests are built before the clock starts.
+    """
+    requests = [make_request(rand) for i in range(int(rate * duration))]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def send(due, request):
+        try:
+            status = target.request(*request)
+        except Exception:
+            status = None
+        latency = time.time() - due
+        with lock:
+            latencies.append(latency)
+            if status is None or status >= 400:
+                errors[0] += 1
+
+    executor = ThreadPoolExecutor(workers)
+    started = time.time()
+    for index, request in enumerate(requests):
+        due = started + index / float(rate)
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        executor.submit(send, due, request)
+    executor.shutdown(wait=True)
+    return summarize_latencies(latencies, errors[0], time.time() - started, rate)
+
+
+def ingest_scenario(device_uuids):
+    """
+    Single reading POSTs of random devices, dated now.
+    """
+    def make_request(rand):
+        body = json.dumps(dict(type=rand.choice(SENSOR_TYPES), value=rand.randint(0, 100)))
+        return 'POST', '/devices/{}/readings/'.format(rand.choice(device_uuids)), body
+    return make_request
+
+
+def get_window(rand, start, end, window):
+    first = rand.randint(start, max(start, end - window))
+    return first, first + window
+
+
+def device_query_scenario(device_uuids, start, end, window):
+    """
+    Metric, quartiles and stats requests of random devices over a random
+    window of the loaded readings.
+    """
+    def make_request(rand):
+        first, last = get_window(rand, start, end, window)
+        return 'GET', '/devices/{}/readings/{}/?start={}&end={}'.format(
+            rand.choice(device_uuids), rand.choice(DEVICE_QUERIES), first, last), None
+    return make_request
+
+
+def summary_scenario(start, end, window):
+    """
+    Fleet summaries over a random window of the loaded readings.
+    """
+    def make_request(rand):
+        first, last = get_window(rand, start, end, window)
+        return 'GET', '/readings/summary/?start={}&end={}'.format(first, last), None
+    return make_request
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+class WriteVersions(object):
+    """
+    Versions of the readings of every device and of the whole fleet,
+    bumped by every write, so cached responses can tell whether readings
+    were stored since they were computed. Versions come from one counter
+    and never repeat, clearing them invalidates every cached response.
+    Counters only live in this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.counter = 0
+        self.floor = 0
+
+    def get(self, device_uuid=None):
+        if device_uuid is None:
+            return self.counter
+        return self.versions.get(device_uuid, self.floor)
+
+    def bump(self, device_uuids):
+        with self.lock:
+            self.counter += 1
+            for device_uuid in device_uuids:
+                self.versions[device_uuid] = self.counter
+
+    def clear(self):
+        with self.lock:
+            self.counter += 1
+            self.floor = self.counter
+            self.versions.clear()
+
+
+class ResponseCache(object):
+    """
+    LRU cache of response bodies holding at most max_bytes of them. An
+    entry is stored with the write version it was computed at and is only
+    served while the version is still the current one.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        # Tells apart the ETags of this process from those of a previous one with the same versions
+        self.nonce = hashlib.sha1(os.urandom(16)).hexdigest()[:8]
+        self.counters = dict(hits=0, misses=0, not_modified=0, evictions=0)
+
+    def get_etag(self, key, version):
+        return '{}-{:d}-{}'.format(self.nonce, version, hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16])
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get(self, key, version):
+        """
+        Returns the (body, mimetype, headers) cached for a key at a write
+        version, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[1]
+
+    def put(self, key, version, body, mimetype, headers):
+        size = len(body) + len(repr(key))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self.entries[key] = (version, (body, mimetype, headers), size)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, (evicted_version, response, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.counters['evictions'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes)
+            return stats
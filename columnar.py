@@ -0,0 +1,533 @@
+"""
+Append-only columnar storage engine for readings.
+
+Every device and sensor type gets a directory of two column files sorted
+by date: the timestamps as int64 and the values as uint8 for the types
+schemas.get_range_error keeps within 0 - 100, int64 for the others. The
+columns are memory-mapped and read as NumPy arrays, date ranges are
+binary searches on the timestamps and metrics are computed over zero-copy
+slices.
+
+    <path>/<hex device_uuid>/<hex type>/CURRENT    generation of the files
+    <path>/<hex device_uuid>/<hex type>/<generation>.ts
+    <path>/<hex device_uuid>/<hex type>/<generation>.val
+    <path>/<hex device_uuid>/<hex type>/<generation>.late  late readings
+
+Names whose hex is longer than a directory name may be are stored in a
+directory named ~<SHA-1 of the name> instead, with the name in its NAME
+file.
+
+Readings dated after the last one of their series are appended. Values
+go first and timestamps last, so a series holds as many readings as both
+files have whole records and a torn append is cut off the next time the
+series is written to. With sync 'full' values are fsynced before their
+timestamps are written and timestamps before the append returns. Readings
+dated before the last one go to the late file of the generation instead,
+a sorted (date_created, value) array replaced whole and merged into the
+columns when they're read. Once it holds LATE_READINGS readings the
+series is rewritten with them into the next generation, which CURRENT
+only names once it's complete, so a late reading costs a rewrite of the
+late file rather than of the series.
+
+    python columnar.py database.db columnar/
+
+converts a SQLite database into a column store.
+"""
+import argparse
+import binascii
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from operator import itemgetter
+
+import numpy as np
+
+
+TIMESTAMP_DTYPE = np.dtype('<i8')
+# Types whose values get_range_error keeps within 0 - 100
+BYTE_TYPES = ('temperature', 'humidity')
+# Rowids of the readings endpoint are the index of the type, then the position in the series
+POSITION_BITS = 40
+# Readings dated before the last one of their series kept apart before the series is rewritten
+LATE_READINGS = 4096
+LATE_DTYPE = np.dtype([('timestamp', '<i8'), ('value', '<i8')])
+# Longest directory name most file systems allow, longer hex names are hashed
+MAX_NAME_LENGTH = 255
+NAME_FILE = 'NAME'
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def encode_name(name):
+    encoded = binascii.hexlify(name.encode('utf-8')).decode('ascii')
+    if len(encoded) <= MAX_NAME_LENGTH:
+        return encoded
+    return '~' + hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+
+def decode_name(path, name):
+    """
+    Returns the name of the directory name in path, None for a hashed one
+    whose NAME file isn't written yet.
+    """
+    if not name.startswith('~'):
+        return binascii.unhexlify(name.encode('ascii')).decode('utf-8')
+    try:
+        with open(os.path.join(path, name, NAME_FILE), 'rb') as f:
+            return f.read().decode('utf-8')
+    except (IOError, OSError):
+        return None
+
+
+def make_directory(path, name):
+    """
+    Creates the directory of a name, writing the NAME file of a hashed one
+    in full before it's read.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    name_file = os.path.join(path, NAME_FILE)
+    if os.path.basename(path).startswith('~') and not os.path.exists(name_file):
+        with open(name_file + '.tmp', 'wb') as f:
+            f.write(name.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(name_file + '.tmp', name_file)
+
+
+def get_value_dtype(sensor_type):
+    return np.dtype('u1') if sensor_type in BYTE_TYPES else np.dtype('<i8')
+
+
+def merge_late(timestamps, values, late):
+    """
+    Returns the columns of a series with its late readings inserted,
+    after the readings of the series dated the same.
+    """
+    positions = np.searchsorted(timestamps, late['timestamp'], 'right')
+    return (np.insert(timestamps, positions, late['timestamp']),
+            np.insert(values, positions, late['value'].astype(values.dtype)))
+
+
+def iter_series_rows(index, timestamps, values, first, skip, window):
+    """
+    Yields the (date_created, rowid, type index, value) rows of a series
+    from position skip on, reading window rows of its columns at a time.
+    """
+    for offset in range(skip, len(timestamps), window):
+        count = min(window, len(timestamps) - offset)
+        rowids = (index << POSITION_BITS) | np.arange(first + offset, first + offset + count, dtype=np.int64)
+        for date_created, rowid, value in zip(timestamps[offset:offset + count].tolist(), rowids.tolist(),
+                                              values[offset:offset + count].tolist()):
+            yield date_created, rowid, index, value
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Series(object):
+    """
+    The timestamp and value columns of one device and sensor type.
+    Writers in this and other processes are serialized by a lock file,
+    readers never wait.
+    """
+
+    def __init__(self, path, sensor_type, sync):
+        self.path = path
+        self.dtype = get_value_dtype(sensor_type)
+        self.sync = sync
+        self.lock = threading.Lock()
+        # (generation, count, late count, timestamps, values) of the last read
+        self.mapped = None
+
+    def get_generation(self):
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                return int(f.read())
+        except (IOError, OSError):
+            return 0
+
+    def get_files(self, generation):
+        return (os.path.join(self.path, '{:d}.ts'.format(generation)),
+                os.path.join(self.path, '{:d}.val'.format(generation)))
+
+    def get_late_file(self, generation):
+        return os.path.join(self.path, '{:d}.late'.format(generation))
+
+    def read_late(self, generation):
+        try:
+            return np.fromfile(self.get_late_file(generation), dtype=LATE_DTYPE)
+        except (IOError, OSError):
+            return np.empty(0, LATE_DTYPE)
+
+    def get_sizes(self, generation):
+        sizes = []
+        for name in self.get_files(generation):
+            try:
+                sizes.append(os.path.getsize(name))
+            except OSError:
+                sizes.append(0)
+        return sizes
+
+    def get_count(self, generation):
+        ts_size, val_size = self.get_sizes(generation)
+        return min(ts_size // TIMESTAMP_DTYPE.itemsize, val_size // self.dtype.itemsize)
+
+    def map_columns(self, generation, count):
+        """
+        Returns the (timestamps, values) arrays of the first count readings
+        of the column files of a generation, memory-mapped read-only.
+        """
+        if not count:
+            return np.empty(0, TIMESTAMP_DTYPE), np.empty(0, self.dtype)
+        ts_file, val_file = self.get_files(generation)
+        return (np.memmap(ts_file, dtype=TIMESTAMP_DTYPE, mode='r', shape=(count,)),
+                np.memmap(val_file, dtype=self.dtype, mode='r', shape=(count,)))
+
+    def read(self):
+        """
+        Returns the (timestamps, values) arrays of the readings committed
+        so far, memory-mapped read-only, or merged with the late readings
+        of the series when it has some.
+        """
+        for attempt in range(3):
+            generation = self.get_generation()
+            count = self.get_count(generation)
+            late = self.read_late(generation)
+            mapped = self.mapped
+            if mapped is not None and mapped[:3] == (generation, count, len(late)):
+                return mapped[3], mapped[4]
+            try:
+                timestamps, values = self.map_columns(generation, count)
+            except (IOError, OSError):
+                # A rewrite replaced the generation in between, read the new one
+                continue
+            if self.get_generation() != generation:
+                # Its late readings may have been removed with it
+                continue
+            if len(late):
+                timestamps, values = merge_late(timestamps, values, late)
+            self.mapped = (generation, count, len(late), timestamps, values)
+            return timestamps, values
+        raise IOError('Series {} keeps being rewritten'.format(self.path))
+
+    def append(self, readings):
+        """
+        Adds (date_created, value) pairs, appending those dated after the
+        series' last reading and adding the others to its late readings,
+        rewriting it once they're LATE_READINGS.
+        """
+        readings = sorted(readings, key=itemgetter(0))
+        timestamps = np.array([reading[0] for reading in readings], TIMESTAMP_DTYPE)
+        values = np.array([reading[1] for reading in readings], self.dtype)
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(os.path.join(self.path, 'LOCK'), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                generation = self.get_generation()
+                self.recover(generation)
+                current_timestamps = self.map_columns(generation, self.get_count(generation))[0]
+                split = 0
+                if len(current_timestamps):
+                    split = int(np.searchsorted(timestamps, current_timestamps[-1], 'left'))
+                if split:
+                    late = np.empty(split, LATE_DTYPE)
+                    late['timestamp'], late['value'] = timestamps[:split], values[:split]
+                    late = np.concatenate([self.read_late(generation), late])
+                    late = late[np.argsort(late['timestamp'], kind='stable')]
+                    if len(late) >= LATE_READINGS:
+                        self.rewrite(generation, late, timestamps[split:], values[split:])
+                        return
+                    self.write_late(generation, late)
+                if split < len(timestamps):
+                    self.write_tail(generation, timestamps[split:], values[split:])
+
+    def recover(self, generation):
+        """
+        Cuts the torn records an interrupted append left at the end of the
+        column files.
+        """
+        count = self.get_count(generation)
+        sizes = [count * TIMESTAMP_DTYPE.itemsize, count * self.dtype.itemsize]
+        for name, size, expected in zip(self.get_files(generation), self.get_sizes(generation), sizes):
+            if size > expected:
+                with open(name, 'r+b') as f:
+                    f.truncate(expected)
+
+    def write_column(self, name, data, mode):
+        created = not os.path.exists(name)
+        with open(name, mode) as f:
+            f.write(data.tobytes())
+            if self.sync == 'full':
+                f.flush()
+                os.fsync(f.fileno())
+        if created and self.sync == 'full':
+            fsync_path(self.path)
+
+    def write_tail(self, generation, timestamps, values):
+        ts_file, val_file = self.get_files(generation)
+        self.write_column(val_file, values, 'ab')
+        self.write_column(ts_file, timestamps, 'ab')
+
+    def write_late(self, generation, late):
+        late_file = self.get_late_file(generation)
+        with open(late_file + '.tmp', 'wb') as f:
+            f.write(late.tobytes())
+            if self.sync == 'full':
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(late_file + '.tmp', late_file)
+        if self.sync == 'full':
+            fsync_path(self.path)
+
+    def rewrite(self, generation, late, timestamps, values):
+        """
+        Writes the series merged with its late readings, followed by the
+        readings dated after its last one, into the next generation.
+        """
+        current_timestamps, current_values = self.map_columns(generation, self.get_count(generation))
+        merged_timestamps, merged_values = merge_late(current_timestamps, current_values, late)
+        ts_file, val_file = self.get_files(generation + 1)
+        self.write_column(val_file, np.concatenate([merged_values, values]), 'wb')
+        self.write_column(ts_file, np.concatenate([merged_timestamps, timestamps]), 'wb')
+
+        current = os.path.join(self.path, 'CURRENT')
+        with open(current + '.tmp', 'w') as f:
+            f.write('{:d}'.format(generation + 1))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(current + '.tmp', current)
+        fsync_path(self.path)
+        for name in self.get_files(generation) + (self.get_late_file(generation),):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+class ColumnStore(object):
+    """
+    The series of every device and sensor type under a directory, with
+    the queries the readings endpoints need.
+    """
+
+    def __init__(self, path, sync='full'):
+        self.path = path
+        self.sync = sync
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def get_series(self, device_uuid, sensor_type):
+        key = (device_uuid, sensor_type)
+        series = self.series.get(key)
+        if series is None:
+            path = os.path.join(self.path, encode_name(device_uuid), encode_name(sensor_type))
+            with self.lock:
+                series = self.series.setdefault(key, Series(path, sensor_type, self.sync))
+        return series
+
+    def list_names(self, path):
+        if not os.path.isdir(path):
+            return []
+        names = (decode_name(path, name) for name in os.listdir(path) if not name.startswith(NAME_FILE))
+        return sorted(name for name in names if name is not None)
+
+    def list_devices(self):
+        return self.list_names(self.path)
+
+    def list_types(self, device_uuid):
+        return self.list_names(os.path.join(self.path, encode_name(device_uuid)))
+
+    def append(self, readings):
+        """
+        Adds (device_uuid, type, value, date_created) tuples, one append per
+        series they belong to.
+        """
+        groups = {}
+        for device_uuid, sensor_type, value, date_created in readings:
+            groups.setdefault((device_uuid, sensor_type), []).append((date_created, value))
+        for (device_uuid, sensor_type), series_readings in sorted(groups.items()):
+            series = self.get_series(device_uuid, sensor_type)
+            make_directory(os.path.dirname(series.path), device_uuid)
+            make_directory(series.path, sensor_type)
+            series.append(series_readings)
+
+    def get_columns(self, device_uuid, sensor_type=None, start=None, end=None):
+        """
+        Yields (type index, timestamps, values, first position) for the
+        readings of a device from start to end, either of them None when
+        unbounded, of one type or all of them. The arrays are slices of the
+        memory maps. Type indexes are the position in list_types.
+        """
+        for index, name in enumerate(self.list_types(device_uuid)):
+            if sensor_type and name != sensor_type:
+                continue
+            timestamps, values = self.get_series(device_uuid, name).read()
+            first = 0 if start is None else int(np.searchsorted(timestamps, start, 'left'))
+            last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, 'right'))
+            yield index, timestamps[first:last], values[first:last], first
+
+    def get_histogram(self, device_uuid, sensor_type=None, start=None, end=None):
+        """
+        Returns the sorted (value, count) pairs of a device's readings.
+        """
+        counts = {}
+        for index, timestamps, values, first in self.get_columns(device_uuid, sensor_type, start, end):
+            if not len(values):
+                continue
+            if values.dtype == np.uint8:
+                value_counts = np.bincount(values)
+                present = np.flatnonzero(value_counts)
+                pairs = zip(present.tolist(), value_counts[present].tolist())
+            else:
+                present, value_counts = np.unique(values, return_counts=True)
+                pairs = zip(present.tolist(), value_counts.tolist())
+            for value, count in pairs:
+                counts[value] = counts.get(value, 0) + count
+        return sorted(counts.items())
+
+    def get_series_rows(self, device_uuid, interval, sensor_type=None, start=None, end=None):
+        """
+        Returns (date, count, sum, min, max) rows of a device's readings,
+        one per interval (in seconds) and type, ordered by date like
+        series.get_series_rows.
+        """
+        parts = []
+        for index, timestamps, values, first in self.get_columns(device_uuid, sensor_type, start, end):
+            if not len(timestamps):
+                continue
+            buckets = timestamps // interval
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(buckets)) + 1])
+            counts = np.diff(np.append(starts, len(timestamps)))
+            values = values.astype(np.int64)
+            parts.append(list(zip(
+                (buckets[starts] * interval).tolist(),
+                counts.tolist(),
+                np.add.reduceat(values, starts).tolist(),
+                np.minimum.reduceat(values, starts).tolist(),
+                np.maximum.reduceat(values, starts).tolist(),
+            )))
+        return list(heapq.merge(*parts))
+
+    def iter_reading_rows(self, device_uuid, sensor_type=None, start=None, end=None, after=None, limit=None,
+                          chunk_size=1000):
+        """
+        Yields chunks of (rowid, type index, value, date_created) rows of a
+        device ordered by date_created and rowid, starting after the
+        (date_created, rowid) of a keyset cursor, each with the JSON names
+        of the type indexes, like the SQLite storage. The series are merged
+        as they're read, so a page reads about limit rows of each of them.
+        """
+        type_names = dict((index, json.dumps(name)) for index, name in enumerate(self.list_types(device_uuid)))
+        window = chunk_size if limit is None else max(min(chunk_size, limit), 1)
+        series = []
+        for index, timestamps, values, first in self.get_columns(device_uuid, sensor_type, start, end):
+            skip = 0
+            if after is not None:
+                date_created, rowid = after
+                lower = int(np.searchsorted(timestamps, date_created, 'left'))
+                upper = int(np.searchsorted(timestamps, date_created, 'right'))
+                if index < rowid >> POSITION_BITS:
+                    skip = upper
+                elif index == rowid >> POSITION_BITS:
+                    skip = min(max(lower, (rowid & ((1 << POSITION_BITS) - 1)) + 1 - first), upper)
+                else:
+                    skip = lower
+            series.append(iter_series_rows(index, timestamps, values, first, skip, window))
+
+        rows = heapq.merge(*series)
+        if limit is not None:
+            rows = itertools.islice(rows, limit)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield type_names, [(rowid, index, value, date_created) for date_created, rowid, index, value in chunk]
+
+    def iter_export_chunks(self, device_uuids=None, sensor_type=None, start=None, end=None, chunk_size=10000):
+        """
+        Yields the readings of devices, every device by default, in the
+        chunks of export.py, series by series. The values and timestamps
+        are slices of the memory maps.
+        """
+        for device_uuid in self.list_devices() if device_uuids is None else device_uuids:
+            type_names = dict(enumerate(self.list_types(device_uuid)))
+            for index, timestamps, values, first in self.get_columns(device_uuid, sensor_type, start, end):
+                for offset in range(0, len(timestamps), chunk_size):
+                    count = min(chunk_size, len(timestamps) - offset)
+                    yield {0: device_uuid}, type_names, (np.zeros(count, np.int64), np.full(count, index, np.int64),
+                                                         values[offset:offset + count],
+                                                         timestamps[offset:offset + count])
+
+    def iter_device_histograms(self, sensor_type=None, start=None, end=None):
+        """
+        Yields (device_uuid, histogram) for every device with readings,
+        ordered by uuid.
+        """
+        for device_uuid in self.list_devices():
+            histogram = self.get_histogram(device_uuid, sensor_type, start, end)
+            if histogram:
+                yield device_uuid, histogram
+
+    def iter_latest_readings(self):
+        """
+        Yields the (device_uuid, type, value, date_created) of the last
+        reading of every series.
+        """
+        for device_uuid in self.list_devices():
+            for sensor_type in self.list_types(device_uuid):
+                timestamps, values = self.get_series(device_uuid, sensor_type).read()
+                if len(timestamps):
+                    yield device_uuid, sensor_type, int(values[-1]), int(timestamps[-1])
+
+
+def get_store(path, sync='full'):
+    """
+    Returns the process' column store of a directory.
+    """
+    with stores_lock:
+        store = stores.get((path, sync))
+        if store is None:
+            store = stores[(path, sync)] = ColumnStore(path, sync)
+        return store
+
+
+def convert_database(db_name, store, batch_size=100000):
+    """
+    Copies the readings of a SQLite database file into a column store,
+    series by series, and returns how many were copied. Readings without
+    a value can't be stored in the columns and are left out.
+    """
+    conn = sqlite3.connect(db_name)
+    try:
+        cur = conn.execute('select device_uuid, type, value, date_created from readings '
+                           'where value is not null and date_created is not null '
+                           'order by device_uuid, type, date_created')
+        copied = 0
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            store.append(rows)
+            copied += len(rows)
+        return copied
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a SQLite database of readings into a column store.')
+    parser.add_argument('database', help='SQLite database file, e.g. database.db')
+    parser.add_argument('path', help='Directory of the column store, e.g. columnar/')
+    args = parser.parse_args()
+    print('Copied {} readings'.format(convert_database(args.database, ColumnStore(args.path))))
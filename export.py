@@ -0,0 +1,118 @@
+"""
+Writers of the readings export. They take chunks of readings as columns,
+(device_names, type_names, (device_ids, type_ids, values, dates)) with the
+names of the ids of the chunk, and yield the NDJSON, CSV or Arrow IPC
+stream bytes of every chunk as soon as it's read, so an export of any size
+is written in the memory of a single chunk.
+"""
+import csv
+import io
+import json
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+COLUMNS = ('device_uuid', 'type', 'value', 'date_created')
+
+
+def get_rows(columns):
+    """
+    Returns the rows of the columns of a chunk, which may be NumPy arrays.
+    """
+    return zip(*[column.tolist() if hasattr(column, 'tolist') else column for column in columns])
+
+
+def encode_names(names, ids, encoded):
+    """
+    Returns the (names, JSON by id) pair of names, encoded when it's the
+    pair of the same names, with the JSON of the ids it lacks added.
+    Chunks of the same database file share their names, which only grow.
+    """
+    if encoded is None or encoded[0] is not names:
+        encoded = (names, {})
+    for name_id in set(ids.tolist() if hasattr(ids, 'tolist') else ids).difference(encoded[1]):
+        encoded[1][name_id] = json.dumps(names[name_id])
+    return encoded
+
+
+def write_ndjson(chunks):
+    """
+    Yields a line per reading, with the keys sorted like jsonify does.
+    """
+    devices = types = None
+    for device_names, type_names, columns in chunks:
+        devices = encode_names(device_names, columns[0], devices)
+        types = encode_names(type_names, columns[1], types)
+        device_json, type_json = devices[1], types[1]
+        yield ''.join('{{"date_created": {}, "device_uuid": {}, "type": {}, "value": {}}}\n'.format(
+            'null' if date_created is None else date_created, device_json[device_id], type_json[type_id],
+            'null' if value is None else value) for device_id, type_id, value, date_created in get_rows(columns))
+
+
+def write_csv(chunks):
+    """
+    Yields a header row, then a row per reading, readings without a value
+    having an empty one.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    yield output.getvalue()
+    for device_names, type_names, columns in chunks:
+        output.seek(0)
+        output.truncate()
+        writer.writerows((device_names[device_id], type_names[type_id], value, date_created)
+                         for device_id, type_id, value, date_created in get_rows(columns))
+        yield output.getvalue()
+
+
+def take_names(names, ids):
+    """
+    Returns the string array of the names of an array of ids, only the
+    names of the distinct ids of the array being looked up.
+    """
+    unique, inverse = np.unique(np.asarray(ids, np.int64), return_inverse=True)
+    return pyarrow.array([names[name_id] for name_id in unique.tolist()], pyarrow.string()).take(
+        pyarrow.array(inverse, pyarrow.int64()))
+
+
+def write_arrow(chunks):
+    """
+    Yields an Arrow IPC stream with a record batch per chunk. Every column
+    is built from the arrays of the chunk at once, the names by taking
+    them from their ids.
+    """
+    schema = pyarrow.schema([('device_uuid', pyarrow.string()), ('type', pyarrow.string()),
+                             ('value', pyarrow.int64()), ('date_created', pyarrow.int64())])
+    sink = io.BytesIO()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    for device_names, type_names, (device_ids, type_ids, values, dates) in chunks:
+        writer.write_batch(pyarrow.record_batch([
+            take_names(device_names, device_ids),
+            take_names(type_names, type_ids),
+            pyarrow.array(values, pyarrow.int64()),
+            pyarrow.array(dates, pyarrow.int64()),
+        ], schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+WRITERS = {
+    'ndjson': write_ndjson,
+    'csv': write_csv,
+    'arrow': write_arrow,
+}
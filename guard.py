@@ -0,0 +1,128 @@
+"""
+Limits on the cost of the queries of a request. A time budget interrupts
+the statements of a request still running past its deadline, and a
+limiter bounds the heavy fleet queries running at once, so a few
+expensive reads can't hold every connection and starve ingestion.
+"""
+import threading
+import time
+
+
+class QueryBudget(object):
+    """
+    Deadlines of the requests served by every thread. The progress
+    handler of the read connections calls is_exceeded, so SQLite aborts
+    a statement running past the deadline of its thread with an
+    OperationalError('interrupted').
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get_deadline(self):
+        return getattr(self.local, 'deadline', None)
+
+    def start(self, seconds):
+        """
+        Sets the deadline of the thread seconds from now, None or 0 for
+        none.
+        """
+        self.local.deadline = time.time() + seconds if seconds else None
+
+    def clear(self):
+        self.local.deadline = None
+
+    def is_exceeded(self):
+        deadline = self.get_deadline()
+        return deadline is not None and time.time() > deadline
+
+    def bind(self, function):
+        """
+        Returns function running under the deadline of the calling thread,
+        for the worker threads of a request.
+        """
+        deadline = self.get_deadline()
+
+        def bound(*args):
+            previous = self.get_deadline()
+            self.local.deadline = deadline
+            try:
+                return function(*args)
+            finally:
+                self.local.deadline = previous
+        return bound
+
+    def bind_iterator(self, iterable):
+        """
+        Returns an iterator over iterable producing its items under what's
+        left of the budget of the calling thread, for streamed response
+        bodies. Only the time spent producing items is counted, not the
+        time a client takes to read them.
+        """
+        deadline = self.get_deadline()
+        if deadline is None:
+            return iterable
+
+        def generate(remaining):
+            iterator = iter(iterable)
+            try:
+                while True:
+                    previous = self.get_deadline()
+                    started = time.time()
+                    self.local.deadline = started + remaining
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        self.local.deadline = previous
+                        remaining -= time.time() - started
+                    yield item
+            finally:
+                close = getattr(iterable, 'close', None)
+                if close is not None:
+                    close()
+        return generate(deadline - time.time())
+
+
+class QueryLimiter(object):
+    """
+    Slots of the heavy queries allowed to run at once. A query waits at
+    most wait seconds for a slot.
+    """
+
+    def __init__(self, slots, wait):
+        self.slots = slots
+        self.wait = wait
+        self.semaphore = threading.BoundedSemaphore(slots)
+
+    def acquire(self):
+        return self.semaphore.acquire(timeout=self.wait)
+
+    def release(self):
+        self.semaphore.release()
+
+    def hold(self, iterable):
+        """
+        Returns a function releasing the slot acquired by the caller the
+        first time it's called, and an iterator over iterable calling it
+        once iterable is exhausted or closed, so a streamed response body
+        keeps its slot while it's read.
+        """
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.release()
+
+        def generate():
+            try:
+                for item in iterable:
+                    yield item
+            finally:
+                release()
+                close = getattr(iterable, 'close', None)
+                if close is not None:
+                    close()
+        return release, generate()
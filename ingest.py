@@ -0,0 +1,141 @@
+import threading
+import time
+
+from queue import Queue, Full, Empty
+
+
+class BufferFull(Exception):
+    pass
+
+
+class BufferStopped(BufferFull):
+    pass
+
+
+class WriteTimeout(Exception):
+    pass
+
+
+class PendingWrite(object):
+    """
+    Handed back to a producer that wants to wait for its reading to be
+    committed. The writer thread sets it once the group commit holding
+    the reading finished, with the exception if the commit failed.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def done(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise WriteTimeout('Timed out waiting for the reading to be written')
+        if self.error is not None:
+            raise self.error
+
+
+class WriteBuffer(object):
+    """
+    Bounded in-process queue of readings drained by a background writer
+    thread. The writer groups whatever is queued into one flush call (one
+    transaction) as soon as batch_size readings are waiting or
+    flush_interval seconds passed since the first one of the group.
+    """
+
+    def __init__(self, flush, max_size=10000, batch_size=1000, flush_interval=0.005, on_error=None):
+        self.flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.queue = Queue(maxsize=max_size)
+        self.thread = None
+        # Held while checking stopping and queuing, so nothing is queued after the stop marker
+        self.lock = threading.Lock()
+        self.stopping = False
+        self._stop_marker = object()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='readings-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, reading, wait=False):
+        """
+        Queues a reading, raising BufferFull when the queue is at capacity
+        and BufferStopped once the buffer is stopped. With wait=True a
+        PendingWrite is returned to wait on the commit.
+        """
+        pending = PendingWrite() if wait else None
+        with self.lock:
+            if self.stopping:
+                raise BufferStopped('The write buffer is shutting down')
+            try:
+                self.queue.put_nowait((reading, pending))
+            except Full:
+                raise BufferFull('The write buffer is full')
+        return pending
+
+    def stop(self, timeout=None):
+        """
+        Stops accepting readings and waits for the writer to drain the
+        queue. Blocks while the queue is full rather than dropping readings.
+        """
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+        if self.thread is None:
+            return
+        self.queue.put(self._stop_marker)
+        self.thread.join(timeout)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            item = self.queue.get()
+            if item is self._stop_marker:
+                break
+            batch = [item]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except Empty:
+                    break
+                if item is self._stop_marker:
+                    stopped = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+        # Drain whatever producers queued before they saw the buffer stopping
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item is not self._stop_marker:
+                batch.append(item)
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        error = None
+        # Positions of the readings not written, all of them unless the error has its failed ones
+        failed = ()
+        try:
+            self.flush([reading for reading, pending in batch])
+        except Exception as e:
+            error = e
+            failed = set(getattr(e, 'failed', range(len(batch))))
+            if self.on_error:
+                self.on_error(e, len(failed))
+        for position, (reading, pending) in enumerate(batch):
+            if pending is not None:
+                pending.done(error if position in failed else None)
@@ -0,0 +1,64 @@
+import threading
+
+from queries import latest_readings
+
+
+class LatestReadings(object):
+    """
+    The last (date_created, value) of every device and sensor type, kept
+    in memory by the write path so the current readings of devices are
+    answered without a query. Of readings with the same date_created, the
+    one written last wins.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def update(self, readings):
+        """
+        Takes (device_uuid, type, value, date_created) tuples in the order
+        they were written.
+        """
+        with self.lock:
+            for device_uuid, sensor_type, value, date_created in readings:
+                types = self.devices.get(device_uuid)
+                if types is None:
+                    types = self.devices[device_uuid] = {}
+                latest = types.get(sensor_type)
+                if latest is None or date_created >= latest[0]:
+                    types[sensor_type] = (date_created, value)
+
+    def get(self, device_uuid, sensor_type=None):
+        """
+        Returns the latest readings of a device as dicts, one per type
+        sorted by type, or only the one of sensor_type.
+        """
+        types = self.devices.get(device_uuid)
+        if not types:
+            return []
+        # Copied under the lock as writers may add types meanwhile
+        with self.lock:
+            items = sorted(types.items())
+        return [
+            dict(device_uuid=device_uuid, type=name, value=value, date_created=date_created)
+            for name, (date_created, value) in items
+            if sensor_type is None or name == sensor_type
+        ]
+
+    def list_devices(self):
+        with self.lock:
+            return sorted(self.devices)
+
+    def clear(self):
+        with self.lock:
+            self.devices.clear()
+
+
+def load_latest_readings(cur):
+    """
+    Returns the (device_uuid, type, value, date_created) of the last
+    reading of every device and type of a database file.
+    """
+    cur.execute(*latest_readings())
+    return [tuple(row) for row in cur.fetchall()]
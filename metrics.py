@@ -0,0 +1,308 @@
+"""
+Request and SQL instrumentation, served in the Prometheus text format.
+
+Routes record their latency and the time of each phase of their work:
+lending a pooled connection, running statements, validating readings and
+serializing responses. Statements are timed from execute to their last
+fetch, as SQLite steps through them while rows are fetched, and grouped by
+shape, the statement text with its bound parameters left out. Every shape
+also counts the rows it returned and the SQLite VM instructions it ran,
+the work of the rows it scanned.
+"""
+import bisect
+import hashlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# VM instructions between two calls of the progress handler counting them
+PROGRESS_STEPS = 1000
+
+# Rows an iterated cursor fetches at once, so it's timed per batch rather than per row
+ITERATION_ROWS = 256
+
+DESCRIPTIONS = {
+    'sensor_api_requests_total': ('counter', 'Requests answered, by route and status'),
+    'sensor_api_request_seconds': ('histogram', 'Time to answer requests, streaming their body included'),
+    'sensor_api_phase_seconds': ('histogram', 'Time spent in each phase of the requests, by route'),
+    'sensor_api_sql_seconds': ('histogram', 'Time of statements from execute to their last fetch, by shape'),
+    'sensor_api_sql_rows_returned_total': ('counter', 'Rows returned by statements, by shape'),
+    'sensor_api_sql_vm_instructions_total': ('counter', 'SQLite VM instructions run by statements, by shape'),
+    'sensor_api_sql_shape_info': ('gauge', 'Statement text of every shape'),
+    'sensor_api_response_cache_total': ('counter', 'Response cache lookups, by result'),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+def get_shape(sql):
+    """
+    Returns the shape id and normalized text of a statement.
+    """
+    statement = ' '.join(sql.split())
+    return hashlib.sha1(statement.encode('utf-8')).hexdigest()[:12], statement
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    Counters and histograms of the process, by name and labels. A route
+    is attached to the thread serving a request, so the phases and
+    statements it runs are recorded under it.
+    """
+
+    def __init__(self, enabled=True, slow_query_seconds=None, on_slow_query=None):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.shapes = {}
+        self.collectors = []
+        self.slow_query_seconds = slow_query_seconds
+        self.on_slow_query = on_slow_query
+        self.local = threading.local()
+
+    def get_route(self):
+        return getattr(self.local, 'route', None) or ''
+
+    def set_route(self, route):
+        self.local.route = route
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def observe_phase(self, phase, seconds):
+        self.observe('sensor_api_phase_seconds', (('route', self.get_route()), ('phase', phase)), seconds)
+
+    @contextmanager
+    def timed(self, phase):
+        if not self.enabled:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.time() - started)
+
+    def iter_with_route(self, iterable, route):
+        """
+        Yields the chunks of a streamed response body, with its route
+        attached to the thread while each of them is produced.
+        """
+        iterator = iter(iterable)
+        try:
+            while True:
+                previous = self.get_route()
+                self.set_route(route)
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.set_route(previous)
+                yield chunk
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    def observe_request(self, method, route, status, seconds):
+        self.inc('sensor_api_requests_total', (('method', method), ('route', route), ('status', status)))
+        self.observe('sensor_api_request_seconds', (('method', method), ('route', route)), seconds)
+
+    def observe_statement(self, conn, sql, params, seconds, rows, steps):
+        shape, statement = get_shape(sql)
+        labels = (('shape', shape),)
+        with self.lock:
+            self.shapes[shape] = statement
+        self.observe('sensor_api_sql_seconds', labels, seconds)
+        self.inc('sensor_api_sql_rows_returned_total', labels, rows)
+        self.inc('sensor_api_sql_vm_instructions_total', labels, steps * PROGRESS_STEPS)
+        self.observe_phase('sql', seconds)
+        if self.slow_query_seconds and seconds >= self.slow_query_seconds and self.on_slow_query:
+            try:
+                cur = sqlite3.Cursor(conn)
+                cur.execute('EXPLAIN QUERY PLAN {}'.format(sql), params)
+                plan = [row[-1] for row in cur.fetchall()]
+            except sqlite3.Error as e:
+                plan = ['EXPLAIN QUERY PLAN failed: {}'.format(e)]
+            self.on_slow_query(statement, seconds, rows, plan)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((key, (list(histogram.counts), histogram.sum, histogram.buckets))
+                              for key, histogram in self.histograms.items())
+            shapes = dict(self.shapes)
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                counters[(name, tuple(labels))] = value
+
+        samples = {}
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), (counts, total, buckets) in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+        for shape, statement in sorted(shapes.items()):
+            samples.setdefault('sensor_api_sql_shape_info', []).append('sensor_api_sql_shape_info{} 1'.format(
+                format_labels((('shape', shape), ('statement', statement)))))
+
+        output = []
+        for name in sorted(samples):
+            metric_type, description = DESCRIPTIONS.get(name, ('untyped', name))
+            output.append('# HELP {} {}'.format(name, description))
+            output.append('# TYPE {} {}'.format(name, metric_type))
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor timing each statement over its execute and fetches and
+    counting the rows it returns. A statement is recorded once its rows
+    are exhausted, another one is executed or the connection is returned
+    to its pool. Iterating the cursor fetches ITERATION_ROWS rows at a
+    time, so timing costs about as much as with fetchall.
+    """
+
+    def __init__(self, conn):
+        super(InstrumentedCursor, self).__init__(conn)
+        self.statement = None
+        conn.cursors.append(self)
+
+    def start(self, sql, params):
+        self.finish()
+        self.statement = (sql, params)
+        self.elapsed = 0.0
+        self.rows = 0
+        self.steps = 0
+
+    def run(self, method, *args):
+        steps = self.connection.steps
+        started = time.time()
+        try:
+            return method(self, *args)
+        finally:
+            self.elapsed += time.time() - started
+            self.steps += self.connection.steps - steps
+
+    def execute(self, sql, params=()):
+        self.start(sql, params)
+        self.run(sqlite3.Cursor.execute, sql, params)
+        if self.description is None:
+            self.finish()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self.start(sql, seq_of_params[0] if seq_of_params else ())
+        self.run(sqlite3.Cursor.executemany, sql, seq_of_params)
+        self.finish()
+        return self
+
+    def fetchone(self):
+        row = self.run(sqlite3.Cursor.fetchone)
+        if row is None:
+            self.finish()
+        else:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.run(sqlite3.Cursor.fetchmany, self.arraysize if size is None else size)
+        self.rows += len(rows)
+        if not rows:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = self.run(sqlite3.Cursor.fetchall)
+        self.rows += len(rows)
+        self.finish()
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(ITERATION_ROWS)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def finish(self):
+        if self.statement is None:
+            return
+        (sql, params), self.statement = self.statement, None
+        self.connection.metrics.observe_statement(self.connection, sql, params, self.elapsed, self.rows, self.steps)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors record their statements in metrics. A
+    progress handler counts the VM instructions it runs, and interrupts
+    them once the guard.QueryBudget in budget is exceeded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedConnection, self).__init__(*args, **kwargs)
+        self.metrics = None
+        self.budget = None
+        self.steps = 0
+        self.cursors = []
+        self.set_progress_handler(self.count_steps, PROGRESS_STEPS)
+
+    def count_steps(self):
+        self.steps += 1
+        return self.budget is not None and self.budget.is_exceeded()
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super(InstrumentedConnection, self).cursor(factory)
+
+    def finish_statements(self):
+        """
+        Records the statements whose rows weren't all fetched.
+        """
+        cursors, self.cursors = self.cursors, []
+        for cursor in cursors:
+            cursor.finish()
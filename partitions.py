@@ -0,0 +1,253 @@
+import atexit
+import calendar
+import os
+import re
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from utils import get_db_name, get_db_setting, get_db_cursor, insert_readings, forget_db, forget_responses, \
+    migrated
+
+
+# Partition keys of each period, they sort like the dates they hold
+PARTITION_FORMATS = {'day': '%Y%m%d', 'month': '%Y%m'}
+PARTITION_KEY_PATTERNS = {'day': re.compile(r'^\d{8}$'), 'month': re.compile(r'^\d{6}$')}
+
+fanout_lock = threading.Lock()
+
+
+class PartialWrite(Exception):
+    """
+    Some database files of a batch failed to commit while others did.
+    failed holds the positions in the batch of the readings that weren't
+    stored, error the first error.
+    """
+
+    def __init__(self, failed, error):
+        super(PartialWrite, self).__init__('{} readings were not stored: {}'.format(len(failed), error))
+        self.failed = failed
+        self.error = error
+
+
+def get_shard(app, device_uuid):
+    """
+    Returns the shard holding a device's readings. crc32 rather than hash()
+    as it's the same in every process.
+    """
+    return (zlib.crc32(device_uuid.encode('utf-8')) & 0xffffffff) % get_db_setting(app, 'DB_SHARDS')
+
+
+def get_shard_db_name(app, shard):
+    """
+    Returns the database file of a shard, database.s3.db for the 4th one,
+    or the app's database file when readings aren't sharded.
+    """
+    if get_db_setting(app, 'DB_SHARDS') == 1:
+        return get_db_name(app)
+    root, ext = os.path.splitext(get_db_name(app))
+    return '{}.s{:d}{}'.format(root, shard, ext)
+
+
+def get_partition_key(period, date):
+    """
+    Returns the key of the partition of a date, raising ValueError when
+    the date has no key list_partitions would find again.
+    """
+    try:
+        key = time.strftime(PARTITION_FORMATS[period], time.gmtime(date))
+    except (OSError, OverflowError, ValueError):
+        key = None
+    if key is None or not PARTITION_KEY_PATTERNS[period].match(key):
+        raise ValueError('date_created {} is outside the dates partitions can hold'.format(date))
+    return key
+
+
+def get_date_error(app, date_created):
+    """
+    Returns the 400 message for a date_created outside the dates the
+    partitions of the app can hold, or None. Without DB_PARTITION every
+    date is stored.
+    """
+    period = get_db_setting(app, 'DB_PARTITION')
+    if not period:
+        return None
+    try:
+        get_partition_key(period, date_created)
+    except ValueError:
+        return 'Invalid date_created field, {} is outside the dates partitions can hold'.format(date_created)
+    return None
+
+
+def get_partition_bounds(period, key):
+    """
+    Returns the first and last dates a partition holds.
+    """
+    year, month = int(key[:4]), int(key[4:6])
+    if period == 'day':
+        first = calendar.timegm((year, month, int(key[6:8]), 0, 0, 0))
+        return first, first + 86400 - 1
+    first = calendar.timegm((year, month, 1, 0, 0, 0))
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return first, calendar.timegm((next_year, next_month, 1, 0, 0, 0)) - 1
+
+
+def get_partition_db_name(app, key, shard=0):
+    """
+    Returns the file of a partition, next to the app's database file:
+    database.202610.db for October 2026, database.s3.202610.db for its
+    readings of the 4th shard.
+    """
+    root, ext = os.path.splitext(get_shard_db_name(app, shard))
+    return '{}.{}{}'.format(root, key, ext)
+
+
+def list_partitions(app, shard=0):
+    """
+    Returns the (key, db_name) of the partition files of a shard, oldest
+    first.
+    """
+    period = get_db_setting(app, 'DB_PARTITION')
+    if not period:
+        return []
+    root, ext = os.path.splitext(get_shard_db_name(app, shard))
+    directory = os.path.dirname(root)
+    pattern = re.compile(r'^{}\.(\d{{{:d}}}){}$'.format(
+        re.escape(os.path.basename(root)), len(get_partition_key(period, 0)), re.escape(ext)))
+    partitions = []
+    for name in os.listdir(directory or '.'):
+        match = pattern.match(name)
+        if match:
+            partitions.append((match.group(1), os.path.join(directory, name)))
+    return sorted(partitions)
+
+
+def get_db_names(app, start=None, end=None, device_uuid=None):
+    """
+    Returns the database files holding the readings from start to end,
+    either of them None when unbounded, shard by shard and oldest first.
+    A device's readings are all in the files of its shard. Without
+    DB_PARTITION a shard is a single file, otherwise only its partitions
+    overlapping the range are read.
+    """
+    if device_uuid is not None:
+        shards = [get_shard(app, device_uuid)]
+    else:
+        shards = range(get_db_setting(app, 'DB_SHARDS'))
+    period = get_db_setting(app, 'DB_PARTITION')
+    if not period:
+        return [get_shard_db_name(app, shard) for shard in shards]
+    db_names = []
+    for shard in shards:
+        for key, db_name in list_partitions(app, shard):
+            first, last = get_partition_bounds(period, key)
+            if (start is None or last >= start) and (end is None or first <= end):
+                db_names.append(db_name)
+    return db_names
+
+
+def fan_out(app, function, items):
+    """
+    Returns [function(item) for item in items], calling function in the
+    DB_FANOUT_THREADS threads when there are several items. Statements run
+    without the GIL, so the database files are worked on in parallel, under
+    the query budget of the calling thread.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    with fanout_lock:
+        pool = app.extensions.get('fanout_pool')
+        if pool is None:
+            pool = ThreadPool(get_db_setting(app, 'DB_FANOUT_THREADS'))
+            atexit.register(pool.terminate)
+            app.extensions['fanout_pool'] = pool
+    budget = app.extensions.get('query_budget')
+    if budget is not None:
+        function = budget.bind(function)
+    return pool.map(function, items)
+
+
+def write_readings(app, readings):
+    """
+    Inserts (device_uuid, type, value, date_created) tuples, in one
+    transaction per database file their device and date fall in. Each
+    file has its own writer, so the files of a batch are written to in
+    parallel. Expired partitions are dropped whenever this process starts
+    writing to another one.
+
+    The files commit independently: when some of them fail PartialWrite
+    is raised with the readings left out, when all of them do the first
+    error is.
+    """
+    period = get_db_setting(app, 'DB_PARTITION')
+    sharded = get_db_setting(app, 'DB_SHARDS') > 1
+    if not period and not sharded:
+        with get_db_cursor(app) as (cur, conn):
+            insert_readings(app, conn, readings)
+        return
+
+    groups = {}
+    for position, reading in enumerate(readings):
+        shard = get_shard(app, reading[0]) if sharded else 0
+        if period:
+            db_name = get_partition_db_name(app, get_partition_key(period, reading[3]), shard)
+        else:
+            db_name = get_shard_db_name(app, shard)
+        groups.setdefault(db_name, []).append(position)
+    new_partition = period and any(db_name not in migrated for db_name in groups)
+
+    def write(db_name):
+        try:
+            with get_db_cursor(app, db_name=db_name) as (cur, conn):
+                insert_readings(app, conn, [readings[position] for position in groups[db_name]], db_name)
+        except Exception as e:
+            return e
+
+    db_names = sorted(groups)
+    errors = [(db_name, error) for db_name, error in zip(db_names, fan_out(app, write, db_names)) if error]
+    if new_partition:
+        drop_expired_partitions(app)
+    if errors and len(errors) == len(db_names):
+        raise errors[0][1]
+    if errors:
+        raise PartialWrite(sorted(position for db_name, error in errors for position in groups[db_name]),
+                           errors[0][1])
+
+
+def drop_partitions(app, before=None):
+    """
+    Deletes the partition files whose readings are all older than before,
+    or all of them when it's None, and returns their names. Old readings
+    go a file at a time, which costs the same however many they are and
+    leaves nothing to vacuum.
+    """
+    period = get_db_setting(app, 'DB_PARTITION')
+    partitions = []
+    for shard in range(get_db_setting(app, 'DB_SHARDS')):
+        partitions.extend(list_partitions(app, shard))
+    dropped = []
+    for key, db_name in partitions:
+        if before is not None and get_partition_bounds(period, key)[1] >= before:
+            continue
+        forget_db(db_name)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(db_name + suffix)
+            except OSError:
+                pass
+        dropped.append(db_name)
+    if dropped:
+        forget_responses(app)
+    return dropped
+
+
+def drop_expired_partitions(app, now=None):
+    """
+    Drops the partitions past DB_PARTITION_RETENTION seconds.
+    """
+    retention = get_db_setting(app, 'DB_PARTITION_RETENTION')
+    if not retention:
+        return []
+    return drop_partitions(app, (int(time.time()) if now is None else now) - retention)
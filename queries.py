@@ -0,0 +1,130 @@
+# Statements reading readings_data and reading_histograms. Filter values
+# are always bound parameters and missing date bounds are bound as the
+# smallest/largest dates, so each function only produces one statement
+# shape per combination of device and type filters. Those stay prepared
+# in the statement cache of the pooled connections across requests.
+
+MIN_DATE = -2 ** 63
+MAX_DATE = 2 ** 63 - 1
+
+
+def get_conditions(filters, fleet_types=False):
+    """
+    Returns the conditions and parameters on the device and type of a
+    filters dict from utils.get_filters. With fleet_types, queries on all
+    devices and types still search the indexes leading with type_id.
+    """
+    conditions = []
+    params = []
+    for column in ('device_id', 'type_id'):
+        if filters[column] is not None:
+            conditions.append('{} = ?'.format(column))
+            params.append(filters[column])
+    if fleet_types and filters['device_id'] is None and filters['type_id'] is None:
+        # There are only a few types, each of them is a search of the index
+        conditions.append('type_id in (select id from sensor_types)')
+    return conditions, params
+
+
+def get_bound(value, default):
+    return default if value is None else value
+
+
+def readings_page(filters, after=None, limit=None):
+    """
+    Rows (rowid, type_id, value, date_created) of a device ordered by
+    date_created and rowid, following the (date_created, rowid) of a
+    keyset cursor.
+    """
+    conditions, params = get_conditions(filters)
+    conditions += ['date_created >= ?', 'date_created <= ?', '(date_created, rowid) > (?, ?)']
+    params += [get_bound(filters['start'], MIN_DATE), get_bound(filters['end'], MAX_DATE)]
+    params += list(after) if after is not None else [MIN_DATE, -1]
+    params.append(-1 if limit is None else limit)
+    query = 'select rowid, type_id, value, date_created from readings_data where {} ' \
+            'order by date_created, rowid limit ?'.format(' and '.join(conditions))
+    return query, params
+
+
+def export_readings(filters, after=None, limit=None):
+    """
+    Rows (device_id, type_id, value, date_created, rowid) of the readings
+    of a device, or of every device, ordered by date_created and rowid,
+    following the (date_created, rowid) of a keyset cursor. Each filter
+    has a covering index ordered by date, so rows are read without
+    sorting more than the readings of a date.
+    """
+    conditions, params = get_conditions(filters)
+    conditions += ['date_created >= ?', 'date_created <= ?', '(date_created, rowid) > (?, ?)']
+    params += [get_bound(filters['start'], MIN_DATE), get_bound(filters['end'], MAX_DATE)]
+    params += list(after) if after is not None else [MIN_DATE, -1]
+    params.append(-1 if limit is None else limit)
+    query = 'select device_id, type_id, value, date_created, rowid from readings_data where {} ' \
+            'order by date_created, rowid limit ?'.format(' and '.join(conditions))
+    return query, params
+
+
+def histogram_buckets(filters, first, last, group_by='value'):
+    """
+    Value counts from reading_histograms for the buckets first to last,
+    either of them None when unbounded, grouped and ordered by group_by.
+    """
+    conditions, params = get_conditions(filters, fleet_types=True)
+    conditions += ['bucket >= ?', 'bucket <= ?']
+    params += [get_bound(first, MIN_DATE), get_bound(last, MAX_DATE)]
+    query = 'select {0}, sum(count) from reading_histograms where {1} group by {0} order by {0}'.format(
+        group_by, ' and '.join(conditions))
+    return query, params
+
+
+def histogram_readings(filters, start, end, group_by='value'):
+    """
+    Value counts from readings_data for the dates start to end, grouped
+    and ordered by group_by.
+    """
+    conditions, params = get_conditions(filters)
+    conditions += ['date_created >= ?', 'date_created <= ?', 'value is not null']
+    params += [start, end]
+    query = 'select {0}, count(*) from readings_data where {1} group by {0} order by {0}'.format(
+        group_by, ' and '.join(conditions))
+    return query, params
+
+
+def rollup_buckets(filters, resolution, first, last):
+    """
+    Rows (bucket, count, sum, min, max) of the reading_rollups table of a
+    resolution for the buckets first to last, merging the types when the
+    filters don't have one.
+    """
+    conditions, params = get_conditions(filters)
+    conditions += ['bucket >= ?', 'bucket <= ?']
+    params += [get_bound(first, MIN_DATE), get_bound(last, MAX_DATE)]
+    query = 'select bucket, sum(count), sum(sum), min(min), max(max) from reading_rollups_{:d} where {} ' \
+            'group by bucket order by bucket'.format(resolution, ' and '.join(conditions))
+    return query, params
+
+
+def rollup_readings(filters, start, end):
+    """
+    Rows (date_created, count, sum, min, max) of the single readings of
+    the dates start to end, in the layout of rollup_buckets.
+    """
+    conditions, params = get_conditions(filters)
+    conditions += ['date_created >= ?', 'date_created <= ?', 'value is not null']
+    params += [start, end]
+    query = 'select date_created, 1, value, value, value from readings_data where {} ' \
+            'order by date_created'.format(' and '.join(conditions))
+    return query, params
+
+
+def latest_readings():
+    """
+    Rows (uuid, type name, value, date_created) of the last reading of
+    every device and type, the one inserted last among those of its
+    date_created. Each is a search of the end of its index range, so the
+    cost grows with the devices rather than the readings.
+    """
+    return 'select devices.uuid, sensor_types.name, readings_data.value, readings_data.date_created ' \
+           'from devices, sensor_types, readings_data where readings_data.rowid = (' \
+           'select rowid from readings_data where device_id = devices.id and type_id = sensor_types.id ' \
+           'order by date_created desc, rowid desc limit 1)', []
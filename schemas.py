@@ -1,18 +1,233 @@
+import csv
+import io
 import json
-from httplib import BAD_REQUEST
+import re
+import struct
+from http.client import UNSUPPORTED_MEDIA_TYPE
 
 from flask_restful import abort
 from marshmallow import Schema, fields, pre_load, post_load, validate
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+CSV_MIMETYPE = 'text/csv'
+# Fixed layout readings of constrained devices: date_created (0 for now),
+# a type code and the value, little-endian, 13 bytes each
+BINARY_MIMETYPE = 'application/x-sensor-readings'
+BINARY_READING = struct.Struct('<qBi')
+BINARY_TYPES = {1: 'temperature', 2: 'humidity'}
+INTEGER_PATTERN = re.compile(r'^[-+]?\d+$')
+
+
+def get_range_error(reading):
+    """
+    Returns the 400 message for a temperature/humidity value outside
+    of 0 - 100, or None when the value is in range. Checks readings once
+    loaded, when their value was converted to an int whatever its type
+    in the body.
+    """
+    value = reading.get('value')
+    if reading.get('type') in ['temperature', 'humidity'] and (value < 0 or value > 100):
+        return 'Invalid {} field, should be between 0 - 100'.format(reading.get('type'))
+    return None
+
 
 class CreateDeviceReading(Schema):
     type = fields.Str(required=True)
     value = fields.Int(required=True)
+    date_created = fields.Int()
 
     @pre_load
     def pre_load(self, data):
-        data = json.loads(data)
-        if data.get('type') in ['temperature', 'humidity'] and (data.get('value') < 0 or data.get('value') > 100):
-            abort(BAD_REQUEST, message='Invalid {} field, should be between 0 - 100'.format(data.get('type')))
+        if not isinstance(data, dict):
+            data = json.loads(data)
+        return data
+
+
+class CreateFleetReading(CreateDeviceReading):
+    device_uuid = fields.Str(required=True)
+
+
+class ItemError(ValueError):
+    """
+    A batch item that couldn't be decoded, reported with its message as is.
+    """
+
+
+def parse_msgpack_readings(data):
+    if msgpack is None:
+        abort(UNSUPPORTED_MEDIA_TYPE, message='MessagePack bodies need the msgpack package')
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise ValueError('Invalid MessagePack: {}'.format(e))
+
+
+def parse_binary_readings(data):
+    """
+    Decodes a body of BINARY_READING records into reading dicts.
+    """
+    if len(data) % BINARY_READING.size:
+        raise ValueError('The body should be made of {} byte readings'.format(BINARY_READING.size))
+    items = []
+    for offset in range(0, len(data), BINARY_READING.size):
+        date_created, type_code, value = BINARY_READING.unpack_from(data, offset)
+        if type_code not in BINARY_TYPES:
+            items.append(ItemError('Invalid type code {}, should be one of {}'.format(
+                type_code, ', '.join(str(code) for code in sorted(BINARY_TYPES)))))
+            continue
+        item = {'type': BINARY_TYPES[type_code], 'value': value}
+        if date_created:
+            item['date_created'] = date_created
+        items.append(item)
+    return items
+
+
+def parse_csv_readings(data):
+    """
+    Decodes a CSV body with a header row naming its columns among type,
+    value, date_created and device_uuid. Empty cells are left out and
+    integer cells converted, so they're validated like JSON fields.
+    """
+    rows = csv.reader(io.StringIO(data.decode('utf-8') if isinstance(data, bytes) else data))
+    header = [name.strip() for name in next(rows, [])]
+    if 'type' not in header or 'value' not in header:
+        raise ValueError('The CSV header should name the type and value columns')
+    items = []
+    for row in rows:
+        if not any(cell.strip() for cell in row):
+            continue
+        if len(row) != len(header):
+            items.append(ItemError('Expected {} columns, got {}'.format(len(header), len(row))))
+            continue
+        item = {}
+        for name, cell in zip(header, row):
+            cell = cell.strip()
+            if cell:
+                item[name] = int(cell) if INTEGER_PATTERN.match(cell) else cell
+        items.append(item)
+    return items
+
+
+def parse_reading(data, content_type=None):
+    """
+    Decodes the body of a single reading POST, a JSON object by default.
+    """
+    if content_type in MSGPACK_MIMETYPES:
+        return parse_msgpack_readings(data)
+    if content_type in (BINARY_MIMETYPE, CSV_MIMETYPE):
+        items = parse_readings_batch(data, content_type)
+        if len(items) != 1:
+            raise ValueError('Expected a single reading, got {}'.format(len(items)))
+        if isinstance(items[0], ValueError):
+            raise items[0]
+        return items[0]
+    return json.loads(data)
+
+
+def parse_readings_batch(data, content_type=None):
+    """
+    Splits a batch body into its items. The body is a JSON array, NDJSON
+    (one reading per line), a MessagePack array, CSV or BINARY_READING
+    records, depending on its content type. Items that can't be decoded
+    are returned as ValueError instances so they can be reported per item.
+    """
+    if content_type in MSGPACK_MIMETYPES:
+        items = parse_msgpack_readings(data)
+        if not isinstance(items, list):
+            raise ValueError('Expected a MessagePack array of readings')
+        return items
+    if content_type == BINARY_MIMETYPE:
+        return parse_binary_readings(data)
+    if content_type == CSV_MIMETYPE:
+        return parse_csv_readings(data)
+
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    data = data.strip()
+    if content_type != 'application/x-ndjson' and data.startswith('['):
+        items = json.loads(data)
+        if not isinstance(items, list):
+            raise ValueError('Expected a JSON array of readings')
+        return items
+
+    items = []
+    for line in data.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            items.append(e)
+    return items
+
+
+def load_reading(item, schema_class=CreateDeviceReading, get_date_error=None):
+    """
+    Validates a decoded reading with the rules of a schema class,
+    returning a tuple (reading, error) where error is the 400 message.
+    The range of the value is checked last, on the int it was loaded as,
+    then the date_created with get_date_error when given, which returns
+    the message for a date the storage can't hold.
+    Readings with a str type and device_uuid and int value and
+    date_created, nearly all of them, are checked by hand without building
+    a schema. Anything else goes through marshmallow, so the messages are
+    always the ones its load gives.
+    """
+    if not isinstance(item, dict):
+        return None, 'Expected a JSON object'
+
+    sensor_type = item.get('type')
+    value = item.get('value')
+    date_created = item.get('date_created')
+    fleet = issubclass(schema_class, CreateFleetReading)
+    if isinstance(sensor_type, str) and type(value) is int \
+            and (type(date_created) is int or 'date_created' not in item) \
+            and (not fleet or isinstance(item.get('device_uuid'), str)):
+        reading = {'type': sensor_type, 'value': value}
+        if date_created is not None:
+            reading['date_created'] = date_created
+        if fleet:
+            reading['device_uuid'] = item['device_uuid']
+    else:
+        unmarshal_result = schema_class().load(item)
+        if unmarshal_result.errors:
+            return None, str(unmarshal_result.errors)
+        reading = unmarshal_result.data
+    range_error = get_range_error(reading)
+    if not range_error and get_date_error is not None and reading.get('date_created') is not None:
+        range_error = get_date_error(reading['date_created'])
+    if range_error:
+        return None, range_error
+    return reading, None
+
+
+def load_readings_batch(items, schema_class, get_date_error=None):
+    """
+    Validates every batch item with the same rules as a single POST.
 
-        return data
\ No newline at end of file
+    Returns a tuple (valid, errors) where valid is a list of the loaded
+    readings and errors a list of {'index', 'message'} dicts for the
+    items that were rejected.
+    """
+    valid = []
+    errors = []
+    for index, item in enumerate(items):
+        if isinstance(item, ItemError):
+            errors.append(dict(index=index, message=str(item)))
+            continue
+        if isinstance(item, ValueError):
+            errors.append(dict(index=index, message='Invalid JSON: {}'.format(item)))
+            continue
+        reading, error = load_reading(item, schema_class, get_date_error)
+        if error:
+            errors.append(dict(index=index, message=error))
+            continue
+        valid.append(reading)
+    return valid, errors
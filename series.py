@@ -0,0 +1,85 @@
+import re
+
+from queries import rollup_buckets, rollup_readings
+from stats import get_full_buckets
+from utils import ROLLUP_RESOLUTIONS
+
+
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_interval(interval):
+    """
+    Returns the seconds of an interval like 5m, 1h or 7d, raising
+    ValueError when it's malformed or not a whole number of minutes.
+    """
+    match = re.match(r'^(\d+)([smhd])$', interval or '')
+    if not match:
+        raise ValueError('Invalid interval {}, should be a number followed by s, m, h or d'.format(interval))
+    seconds = int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+    if not seconds or seconds % ROLLUP_RESOLUTIONS[0]:
+        raise ValueError('Invalid interval {}, should be a whole number of minutes'.format(interval))
+    return seconds
+
+
+def get_rollup_rows(cur, filters, start, end, resolutions):
+    """
+    Returns (date, count, sum, min, max) rows ordered by date covering the
+    readings from start to end, either of them None when unbounded. Full
+    buckets of the coarsest resolution come from its rollup table and the
+    partial ones at both ends from the next finer resolution, down to
+    single readings for the partial minutes.
+    """
+    if not resolutions:
+        cur.execute(*rollup_readings(filters, start, end))
+        return [tuple(row) for row in cur.fetchall()]
+
+    resolution = resolutions[-1]
+    first, last = get_full_buckets(start, end, resolution)
+    if first is not None and last is not None and first > last:
+        return get_rollup_rows(cur, filters, start, end, resolutions[:-1])
+
+    rows = []
+    if first is not None and start < first * resolution:
+        rows.extend(get_rollup_rows(cur, filters, start, first * resolution - 1, resolutions[:-1]))
+    cur.execute(*rollup_buckets(filters, resolution, first, last))
+    rows.extend((bucket * resolution, count, total, minimum, maximum)
+                for bucket, count, total, minimum, maximum in cur.fetchall())
+    if last is not None and end >= (last + 1) * resolution:
+        rows.extend(get_rollup_rows(cur, filters, (last + 1) * resolution, end, resolutions[:-1]))
+    return rows
+
+
+def get_series_rows(cur, filters, interval):
+    """
+    Returns the rollup rows of the readings matching a filters dict for
+    points of interval seconds. Only the rollups whose resolution divides
+    the interval are read, so a rollup bucket never straddles two points.
+    """
+    resolutions = [resolution for resolution in ROLLUP_RESOLUTIONS if interval % resolution == 0]
+    return get_rollup_rows(cur, filters, filters['start'], filters['end'], resolutions)
+
+
+def get_series(rows, interval):
+    """
+    Returns the points of rollup rows ordered by date, one per interval
+    (in seconds) with readings, each with its start date,
+    number_of_readings, min, max and mean. The rows of consecutive
+    partitions can be chained, a point spanning both is merged.
+    """
+    points = []
+    totals = []
+    for date, count, total, minimum, maximum in rows:
+        point_start = date // interval * interval
+        if points and points[-1]['start'] == point_start:
+            point = points[-1]
+            point['number_of_readings'] += count
+            point['min'] = min(point['min'], minimum)
+            point['max'] = max(point['max'], maximum)
+            totals[-1] += total
+        else:
+            points.append(dict(start=point_start, number_of_readings=count, min=minimum, max=maximum))
+            totals.append(total)
+    for point, total in zip(points, totals):
+        point['mean'] = float(total) / point['number_of_readings']
+    return points
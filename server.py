@@ -0,0 +1,347 @@
+"""
+Serves the API on an asyncio event loop with aiohttp:
+
+    python server.py --port 5000
+
+A connection only costs the event loop a coroutine while it waits, so a
+process holds many keep-alive device connections. The Flask routes run on
+SERVER_DB_THREADS executor threads through WSGI, which keeps the routes
+and JSON contracts those of app.py, and their streamed bodies are pulled
+a chunk at a time. Single reading POSTs are validated on the loop and
+coalesced into batches, written by a writer thread of their own so slow
+reads never hold up ingestion. Streams of readings wait on the loop too.
+"""
+import argparse
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from multidict import CIMultiDict
+from werkzeug.exceptions import HTTPException, TooManyRequests, ServiceUnavailable
+from werkzeug.http import parse_options_header
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from app import app as flask_app, app_metrics, store_readings, reading_hub, get_stream_params, iter_backfill
+from ingest import BufferFull
+from partitions import get_date_error
+from schemas import CreateDeviceReading, parse_reading, load_reading
+from stream import STREAM_HEADERS, HEARTBEAT, format_events
+
+
+# Headers of a connection rather than of a response, aiohttp sets its own
+HOP_BY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'transfer-encoding'])
+
+# Flask route of the readings POSTs answered on the loop, their label in metrics
+READING_ROUTE = '/devices/<string:device_uuid>/readings/'
+
+
+class ReadingCoalescer(object):
+    """
+    Gathers the readings of concurrent POSTs on the event loop and writes
+    them with one write call (one transaction) per batch. A batch is
+    written once batch_size readings are waiting or flush_interval seconds
+    after its first one, and never while the previous one is still being
+    written: readings arriving meanwhile make up the next batch.
+    """
+
+    def __init__(self, write, executor, max_size=10000, batch_size=1000, flush_interval=0.005, on_error=None):
+        self.write = write
+        self.executor = executor
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.pending = []
+        self.timer = None
+        self.task = None
+        self.batches = 0
+
+    def put(self, reading, wait=True):
+        """
+        Queues a reading, raising BufferFull when max_size readings are
+        already waiting. With wait=True a future is returned, done once the
+        batch holding the reading is written.
+        """
+        if len(self.pending) >= self.max_size:
+            raise BufferFull('The write buffer is full')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait else None
+        self.pending.append((reading, future))
+        if self.task is None:
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+            elif self.timer is None:
+                self.timer = loop.call_later(self.flush_interval, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.task is not None or not self.pending:
+            return
+        batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+        self.task = asyncio.get_running_loop().create_task(self._write(batch))
+
+    async def drain(self):
+        """
+        Waits until every queued reading is written.
+        """
+        while self.task is not None or self.pending:
+            self.flush()
+            await self.task
+
+    async def _write(self, batch):
+        error = None
+        # Positions of the readings not written, all of them unless the error has its failed ones
+        failed = ()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.write, [reading for reading, future in batch])
+        except Exception as e:
+            error = e
+            failed = set(getattr(e, 'failed', range(len(batch))))
+            if self.on_error:
+                self.on_error(e, len(failed))
+        self.batches += 1
+        for position, (reading, future) in enumerate(batch):
+            if future is None or future.done():
+                continue
+            if position not in failed:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        self.task = None
+        # The readings queued during the write waited long enough already
+        if self.pending:
+            self.flush()
+
+
+def get_environ(request, body):
+    """
+    Returns the WSGI environ of an aiohttp request.
+    """
+    headers = [(name, value) for name, value in request.headers.items()
+               if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'content-length']
+    environ_overrides = {'REMOTE_ADDR': request.remote} if request.remote else None
+    builder = EnvironBuilder(
+        path=request.path,
+        base_url='{}://{}'.format(request.scheme, request.host),
+        query_string=request.query_string,
+        method=request.method,
+        headers=headers,
+        data=body,
+        environ_overrides=environ_overrides
+    )
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def call_flask(environ):
+    """
+    Runs the Flask app on a WSGI environ. Returns its status, headers and
+    either the whole body, when the response is already materialized and
+    has a Content-Length, or the app_iter to stream it from.
+    """
+    app_iter, status, headers = run_wsgi_app(flask_app.wsgi_app, environ)
+    if 'Content-Length' not in headers:
+        return status, headers, None, app_iter
+    try:
+        return status, headers, b''.join(app_iter), None
+    finally:
+        close_app_iter(app_iter)
+
+
+def get_response_headers(headers):
+    """
+    Returns the headers of a Flask response to send with aiohttp, which
+    sets the Content-Length itself.
+    """
+    return CIMultiDict((name, value) for name, value in headers.items()
+                       if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'content-length')
+
+
+def make_response(status, headers, body):
+    code, reason = status.split(' ', 1)
+    return web.Response(status=int(code), reason=reason, body=body, headers=get_response_headers(headers))
+
+
+def close_app_iter(app_iter):
+    close = getattr(app_iter, 'close', None)
+    if close is not None:
+        close()
+
+
+async def handle_wsgi(request):
+    """
+    Answers a request with the Flask app on the executor. Streamed bodies
+    are read a chunk at a time, so a pooled connection is only held by a
+    thread while a chunk is fetched.
+    """
+    loop = asyncio.get_running_loop()
+    executor = request.app['db_executor']
+    environ = get_environ(request, await request.read())
+    status, headers, body, app_iter = await loop.run_in_executor(executor, call_flask, environ)
+    if app_iter is None:
+        return make_response(status, headers, body)
+
+    code, reason = status.split(' ', 1)
+    response = web.StreamResponse(status=int(code), reason=reason, headers=get_response_headers(headers))
+    iterator = iter(app_iter)
+    try:
+        await response.prepare(request)
+        while True:
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await response.write(chunk)
+        await response.write_eof()
+    finally:
+        await loop.run_in_executor(executor, close_app_iter, app_iter)
+    return response
+
+
+async def handle_reading_post(request):
+    """
+    Stores a single reading like request_device_readings_post does. The
+    reading is validated on the loop and queued in the coalescer, anything
+    invalid is handed to the Flask route to answer with its own error.
+    Readings stored here are recorded in metrics under the Flask route.
+    """
+    started = time.time()
+    body = await request.read()
+    mimetype = parse_options_header(request.headers.get('Content-Type', ''))[0].lower()
+    try:
+        post_data, error = load_reading(parse_reading(body, mimetype), CreateDeviceReading,
+                                        functools.partial(get_date_error, flask_app))
+    except (ValueError, HTTPException):
+        error = True
+    if error:
+        status, headers, body, app_iter = await asyncio.get_running_loop().run_in_executor(
+            request.app['db_executor'], call_flask, get_environ(request, body))
+        return make_response(status, headers, body)
+
+    reading = (request.match_info['device_uuid'], post_data.get('type'), post_data.get('value'),
+               post_data.get('date_created', int(time.time())))
+    durable = flask_app.config['INGEST_DURABILITY'] == 'flush'
+    error = None
+    try:
+        future = request.app['coalescer'].put(reading, wait=durable)
+    except BufferFull:
+        error = TooManyRequests('Too many readings queued, retry later')
+    else:
+        if durable:
+            try:
+                # Shielded, a reading not written in time is still written with its batch
+                await asyncio.wait_for(asyncio.shield(future), flask_app.config['INGEST_WAIT_TIMEOUT'])
+            except asyncio.TimeoutError:
+                error = ServiceUnavailable('The reading was not written in time, it may still be')
+            else:
+                response = web.Response(status=201, text='success', content_type='text/html')
+        else:
+            response = web.Response(status=202, text='accepted', content_type='text/html')
+    if error is not None:
+        response = web.Response(status=error.code, body=error.get_body(), content_type='text/html', charset='utf-8')
+    if app_metrics.enabled:
+        app_metrics.observe_request(request.method, READING_ROUTE, response.status, time.time() - started)
+    return response
+
+
+async def handle_stream(request):
+    """
+    Serves the Server-Sent Events of open_stream on the loop, so a
+    subscriber waiting for readings holds no thread. Only the stored
+    readings sent first are read on the executor. Invalid requests are
+    answered by the Flask route.
+    """
+    try:
+        device_uuids, sensor_type, since, until = get_stream_params(
+            request.query, request.headers.get('Last-Event-ID'), request.match_info.get('device_uuid'))
+    except ValueError:
+        return await handle_wsgi(request)
+
+    loop = asyncio.get_running_loop()
+    executor = request.app['db_executor']
+    wake = asyncio.Event()
+
+    def notify():
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            # The loop is closed, the subscription is about to be
+            pass
+
+    subscription = reading_hub.subscribe(device_uuids, sensor_type, flask_app.config['STREAM_BUFFER_SIZE'], notify)
+    try:
+        response = web.StreamResponse(headers=STREAM_HEADERS)
+        response.content_type = 'text/event-stream'
+        await response.prepare(request)
+        if since is not None and device_uuids:
+            backfill = iter_backfill(device_uuids, sensor_type, since, until)
+            try:
+                while True:
+                    events = await loop.run_in_executor(executor, next, backfill, None)
+                    if events is None:
+                        break
+                    await response.write(events.encode('utf-8'))
+            finally:
+                await loop.run_in_executor(executor, backfill.close)
+        while True:
+            readings, dropped = subscription.get(0)
+            if readings or dropped:
+                await response.write(format_events(readings, dropped).encode('utf-8'))
+                continue
+            try:
+                await asyncio.wait_for(wake.wait(), flask_app.config['STREAM_HEARTBEAT'])
+            except asyncio.TimeoutError:
+                await response.write(HEARTBEAT.encode('utf-8'))
+            wake.clear()
+    finally:
+        subscription.close()
+
+
+def log_write_error(error, count):
+    flask_app.logger.error('Failed to write %s coalesced readings: %s', count, error)
+
+
+async def shutdown(app):
+    await app['coalescer'].drain()
+    app['db_executor'].shutdown()
+    app['write_executor'].shutdown()
+
+
+def make_app():
+    """
+    Returns the aiohttp application serving the API.
+    """
+    app = web.Application(client_max_size=flask_app.config['SERVER_MAX_BODY_SIZE'])
+    app['db_executor'] = ThreadPoolExecutor(flask_app.config['SERVER_DB_THREADS'], thread_name_prefix='db')
+    # SQLite has a single writer, one thread keeps a batch always being written
+    app['write_executor'] = ThreadPoolExecutor(1, thread_name_prefix='readings-writer')
+    app['coalescer'] = ReadingCoalescer(
+        store_readings,
+        app['write_executor'],
+        max_size=flask_app.config['INGEST_QUEUE_SIZE'],
+        batch_size=flask_app.config['INGEST_BATCH_SIZE'],
+        flush_interval=flask_app.config['INGEST_FLUSH_INTERVAL'],
+        on_error=log_write_error
+    )
+    app.router.add_post('/devices/{device_uuid}/readings/', handle_reading_post)
+    app.router.add_get('/devices/{device_uuid}/readings/stream/', handle_stream)
+    app.router.add_get('/readings/stream/', handle_stream)
+    app.router.add_route('*', '/{path:.*}', handle_wsgi)
+    app.on_cleanup.append(shutdown)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves the API on an asyncio event loop.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
+    args = parser.parse_args()
+    web.run_app(make_app(), host=args.host, port=args.port)
@@ -0,0 +1,148 @@
+import heapq
+from itertools import groupby
+
+from queries import histogram_buckets, histogram_readings
+from utils import HISTOGRAM_BUCKET_SECONDS
+
+
+METRICS = ['min', 'max', 'mean', 'median', 'mode', 'quartile_1', 'quartile_3']
+SUMMARY_METRICS = ['number_of_readings'] + METRICS
+# What /devices/<uuid>/readings/stats/ accepts, quartiles stands for both quartiles
+STATS_METRICS = ['number_of_readings', 'min', 'max', 'mean', 'median', 'mode', 'quartiles']
+
+
+def get_full_buckets(start, end, size=HISTOGRAM_BUCKET_SECONDS):
+    """
+    Returns the first and last buckets of size seconds lying entirely
+    within start and end, either of them None when unbounded.
+    """
+    first = None if start is None else -(-start // size)
+    last = None if end is None else (end + 1) // size - 1
+    return first, last
+
+
+def get_histogram_queries(filters, group_by='value'):
+    """
+    Plans how to count the values of the readings matching a filters dict
+    from utils.get_filters: returns (query, params) pairs whose rows are
+    the group_by columns and a count, ordered by the group_by columns.
+
+    Hours entirely within start and end are read from reading_histograms,
+    only the readings of the partial hours at both ends of the range come
+    from readings_data, so the cost depends on the number of hours rather
+    than the number of readings.
+    """
+    start, end = filters['start'], filters['end']
+    first, last = get_full_buckets(start, end)
+    if first is not None and last is not None and first > last:
+        # No full hour in the range
+        return [histogram_readings(filters, start, end, group_by)]
+
+    queries = [histogram_buckets(filters, first, last, group_by)]
+    if first is not None and start < first * HISTOGRAM_BUCKET_SECONDS:
+        queries.append(histogram_readings(filters, start, first * HISTOGRAM_BUCKET_SECONDS - 1, group_by))
+    if last is not None and end >= (last + 1) * HISTOGRAM_BUCKET_SECONDS:
+        queries.append(histogram_readings(filters, (last + 1) * HISTOGRAM_BUCKET_SECONDS, end, group_by))
+    return queries
+
+
+def get_histogram(cur, filters):
+    """
+    Returns the sorted (value, count) pairs of the readings matching a
+    filters dict from utils.get_filters.
+    """
+    counts = {}
+    for query, params in get_histogram_queries(filters):
+        cur.execute(query, params)
+        for value, count in cur.fetchall():
+            counts[value] = counts.get(value, 0) + count
+    return sorted((value, count) for value, count in counts.items() if value is not None and count)
+
+
+def merge_histograms(histograms):
+    """
+    Returns the histogram of the readings of several sorted (value, count)
+    histograms, like those of the partitions a range spans.
+    """
+    if len(histograms) == 1:
+        return histograms[0]
+    return [
+        (value, sum(count for _value, count in rows))
+        for value, rows in groupby(heapq.merge(*histograms), key=lambda row: row[0])
+    ]
+
+
+def get_device_histograms(conn, filters):
+    """
+    Yields (device_id, histogram) for every device with readings matching
+    a filters dict, in a single pass over the histogram rows ordered by
+    device and value. The partial hours at the ends of the range are
+    merged in as they stream by, so memory holds one device at a time.
+    """
+    streams = []
+    for query, params in get_histogram_queries(filters, group_by='device_id, value'):
+        cur = conn.cursor()
+        cur.execute(query, params)
+        streams.append(tuple(row) for row in cur)
+
+    rows = heapq.merge(*streams) if len(streams) > 1 else streams[0]
+    for device_id, device_rows in groupby(rows, key=lambda row: row[0]):
+        histogram = []
+        for value, value_rows in groupby(device_rows, key=lambda row: row[1]):
+            count = sum(row[2] for row in value_rows)
+            if value is not None and count:
+                histogram.append((value, count))
+        if histogram:
+            yield device_id, histogram
+
+
+def get_value_at(histogram, position):
+    """
+    Returns the value at a 1-indexed position of the sorted readings.
+    """
+    seen = 0
+    for value, count in histogram:
+        seen += count
+        if seen >= position:
+            return value
+    return None
+
+
+def summarize(histogram, metrics=METRICS):
+    """
+    Computes metrics from (value, count) pairs sorted by value, with the
+    same results as the SQL aggregates: mean and median are floats, the
+    mode is the smallest of the most frequent values and the quartiles
+    are the last values of the 1st and 3rd NTILE(4) groups, left out when
+    those groups are empty. Everything but the quartiles is None when
+    there are no readings.
+    """
+    total = sum(count for value, count in histogram)
+    data = {}
+    for metric in metrics:
+        if metric == 'number_of_readings':
+            data[metric] = total
+        elif metric == 'min':
+            data[metric] = histogram[0][0] if total else None
+        elif metric == 'max':
+            data[metric] = histogram[-1][0] if total else None
+        elif metric == 'mean':
+            data[metric] = float(sum(value * count for value, count in histogram)) / total if total else None
+        elif metric == 'median':
+            if total:
+                lower = get_value_at(histogram, (total + 1) // 2)
+                upper = get_value_at(histogram, (total + 2) // 2)
+                data[metric] = (lower + upper) / 2.0
+            else:
+                data[metric] = None
+        elif metric == 'mode':
+            data[metric] = max(histogram, key=lambda item: (item[1], -item[0]))[0] if total else None
+        elif metric in ('quartile_1', 'quartile_3'):
+            # NTILE(4) hands the remainder of total / 4 out to the first groups
+            sizes = [total // 4 + (1 if group < total % 4 else 0) for group in range(4)]
+            group = 0 if metric == 'quartile_1' else 2
+            if sizes[group]:
+                data[metric] = get_value_at(histogram, sum(sizes[:group + 1]))
+        else:
+            raise ValueError('Unknown metric {}'.format(metric))
+    return data
@@ -0,0 +1,128 @@
+import json
+import threading
+from collections import deque
+
+
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Sent when a subscriber has nothing to read, so proxies keep the stream open and gone clients are noticed
+HEARTBEAT = ': keep-alive\n\n'
+
+
+def format_reading_event(reading, with_id=True):
+    """
+    Returns the Server-Sent Event of a (device_uuid, type, value,
+    date_created) reading. Its id is the date_created, so a client
+    reconnecting with the Last-Event-ID header resumes from it.
+    """
+    device_uuid, sensor_type, value, date_created = reading
+    data = json.dumps(dict(device_uuid=device_uuid, type=sensor_type, value=value, date_created=date_created),
+                      sort_keys=True)
+    if not with_id:
+        return 'event: reading\ndata: {}\n\n'.format(data)
+    return 'id: {}\nevent: reading\ndata: {}\n\n'.format(date_created, data)
+
+
+def format_events(readings, dropped=0):
+    """
+    Returns the events of readings taken from a subscription, after a
+    dropped event telling how many readings it lost since the last ones.
+    """
+    events = ''.join(format_reading_event(reading) for reading in readings)
+    if dropped:
+        events = 'event: dropped\ndata: {}\n\n'.format(json.dumps(dict(dropped=dropped))) + events
+    return events
+
+
+class Subscription(object):
+    """
+    Readings published for a subscriber, waiting for it to read them. At
+    most max_size are kept: a subscriber too slow to keep up loses the
+    oldest ones rather than holding up the writers or growing without
+    bound. notify is called, from the publishing thread, whenever readings
+    are added.
+    """
+
+    def __init__(self, hub, device_uuids=None, sensor_type=None, max_size=1000, notify=None):
+        self.hub = hub
+        self.device_uuids = device_uuids
+        self.sensor_type = sensor_type
+        self.notify = notify
+        self.buffer = deque(maxlen=max_size)
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def push(self, readings):
+        readings = [reading for reading in readings if self.sensor_type is None or reading[1] == self.sensor_type]
+        if not readings:
+            return
+        with self.condition:
+            self.dropped += max(0, len(self.buffer) + len(readings) - self.buffer.maxlen)
+            self.buffer.extend(readings)
+            self.condition.notify()
+        if self.notify is not None:
+            self.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the readings waiting and how many were dropped since the
+        last call, waiting up to timeout seconds for some.
+        """
+        with self.condition:
+            if not self.buffer and timeout != 0:
+                self.condition.wait(timeout)
+            readings = list(self.buffer)
+            self.buffer.clear()
+            dropped, self.dropped = self.dropped, 0
+        return readings, dropped
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class ReadingHub(object):
+    """
+    In-process publish/subscribe of the readings written, to subscribers
+    of a list of devices or of the whole fleet.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.device_subscriptions = {}
+        self.fleet_subscriptions = set()
+
+    def subscribe(self, device_uuids=None, sensor_type=None, max_size=1000, notify=None):
+        subscription = Subscription(self, device_uuids, sensor_type, max_size, notify)
+        with self.lock:
+            if device_uuids is None:
+                self.fleet_subscriptions.add(subscription)
+            for device_uuid in device_uuids or []:
+                self.device_subscriptions.setdefault(device_uuid, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.fleet_subscriptions.discard(subscription)
+            for device_uuid in subscription.device_uuids or []:
+                subscriptions = self.device_subscriptions.get(device_uuid)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self.device_subscriptions[device_uuid]
+
+    def publish(self, readings):
+        """
+        Hands (device_uuid, type, value, date_created) readings to the
+        subscriptions of their devices and of the fleet.
+        """
+        if not self.device_subscriptions and not self.fleet_subscriptions:
+            return
+        groups = {}
+        with self.lock:
+            for reading in readings:
+                for subscription in self.device_subscriptions.get(reading[0], ()):
+                    groups.setdefault(subscription, []).append(reading)
+            for subscription in self.fleet_subscriptions:
+                groups[subscription] = readings
+        for subscription, subscription_readings in groups.items():
+            subscription.push(subscription_readings)
@@ -0,0 +1,55 @@
+import random
+import unittest
+
+from app import app
+from benchmarks.__main__ import get_regressions
+from benchmarks.fleet import generate_fleet, get_device_uuids, load_fleet
+from benchmarks.load import ClientTarget, run_open_loop, get_percentile, device_query_scenario
+from utils import reset_db
+
+
+class FleetTestCases(unittest.TestCase):
+
+    def test_generate_fleet(self):
+        readings = list(generate_fleet(20, 2000, 1000, 5000, seed=3))
+        self.assertEqual(readings, list(generate_fleet(20, 2000, 1000, 5000, seed=3)))
+        self.assertEqual([reading['date_created'] for reading in readings],
+                         sorted(reading['date_created'] for reading in readings))
+        self.assertTrue(all(0 <= reading['value'] <= 100 for reading in readings))
+        self.assertTrue(all(1000 <= reading['date_created'] < 5000 for reading in readings))
+        counts = [sum(1 for reading in readings if reading['device_uuid'] == device_uuid)
+                  for device_uuid in get_device_uuids(20)]
+        # Devices report at skewed rates
+        self.assertGreater(counts[0], 3 * counts[-1])
+
+
+class LoadTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_db(app)
+
+    def test_get_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([get_percentile(values, percent) for percent in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertIsNone(get_percentile([], 50))
+
+    def test_open_loop_on_test_client(self):
+        target = ClientTarget(app)
+        self.assertEqual(load_fleet(target, generate_fleet(5, 500, 1000, 90000), batch_size=200)[0], 500)
+        result = run_open_loop(target, device_query_scenario(get_device_uuids(5), 1000, 90000, 3600),
+                               rate=100, duration=0.2, workers=4, rand=random.Random(0))
+        self.assertEqual((result['requests'], result['errors']), (20, 0))
+        latencies = result['latency_ms']
+        self.assertTrue(latencies['p50'] <= latencies['p95'] <= latencies['p99'] <= latencies['max'])
+
+    def test_get_regressions(self):
+        before = dict(scenarios=dict(summary=dict(throughput=100, latency_ms=dict(p50=10, p95=20, p99=30))),
+                      load=dict(readings_per_second=1000))
+        after = dict(scenarios=dict(summary=dict(throughput=70, latency_ms=dict(p50=11, p95=20, p99=50))),
+                     load=dict(readings_per_second=950))
+        self.assertEqual(get_regressions(before, after, 0.2), [
+            'summary p99: 30ms -> 50ms',
+            'summary throughput: 100 -> 70 req/s',
+        ])
+        self.assertEqual(get_regressions(before, before, 0.2), [])
@@ -0,0 +1,131 @@
+import json
+import time
+import unittest
+
+from app import app, response_cache, get_cache_now
+from cache import ResponseCache, WriteVersions
+from utils import reset_db
+
+
+def get_cache_now_of(path):
+    with app.test_request_context(path):
+        return get_cache_now()
+
+
+class ResponseCacheTestCases(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_bytes=100)
+        cache.put('a', 1, b'x' * 40, 'application/json', [])
+        cache.put('b', 1, b'x' * 40, 'application/json', [])
+        self.assertIsNotNone(cache.get('a', 1))
+        cache.put('c', 1, b'x' * 40, 'application/json', [])
+        self.assertIsNone(cache.get('b', 1))
+        self.assertIsNotNone(cache.get('a', 1))
+        self.assertIsNotNone(cache.get('c', 1))
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (3, 1, 1))
+        self.assertLessEqual(stats['bytes'], 100)
+
+    def test_stale_versions(self):
+        cache = ResponseCache(max_bytes=100)
+        cache.put('a', 1, b'[]', 'application/json', [])
+        self.assertIsNone(cache.get('a', 2))
+        self.assertNotEqual(cache.get_etag('a', 1), cache.get_etag('a', 2))
+        self.assertNotEqual(cache.get_etag('a', 1), cache.get_etag('b', 1))
+
+    def test_write_versions(self):
+        versions = WriteVersions()
+        versions.bump(['a'])
+        a, fleet = versions.get('a'), versions.get()
+        versions.bump(['b'])
+        self.assertEqual(versions.get('a'), a)
+        self.assertNotEqual(versions.get(), fleet)
+        versions.clear()
+        self.assertNotIn(versions.get('a'), (a, 0))
+        self.assertNotIn(versions.get('c'), (a, 0))
+
+
+class CachedRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['RESPONSE_CACHE_SIZE'] = response_cache.max_bytes = 1024 * 1024
+        self.windows = app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW']
+        reset_db(app)
+        self.client = app.test_client
+        self.post_reading('a', 10)
+        self.post_reading('b', 20)
+
+    def tearDown(self):
+        app.config['RESPONSE_CACHE_SIZE'] = response_cache.max_bytes = 0
+        app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW'] = self.windows
+
+    def post_reading(self, device_uuid, value):
+        request = self.client().post('/devices/{}/readings/'.format(device_uuid), data=json.dumps({
+            'type': 'temperature',
+            'value': value,
+            'date_created': 1000 + value
+        }), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+
+    def get(self, path, **kwargs):
+        return self.client().get(path + '?start=1&end=2000', **kwargs)
+
+    def get_stats(self):
+        return json.loads(self.client().get('/cache/stats/').data)
+
+    def test_hits_until_a_write(self):
+        before = self.get_stats()
+        first = self.get('/devices/a/readings/max/')
+        second = self.get('/devices/a/readings/max/')
+        self.assertEqual(json.loads(second.data), {'value': 10})
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        after = self.get_stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+        # Readings of another device leave the entry valid, not those of the device
+        self.post_reading('b', 30)
+        self.assertEqual(self.get('/devices/a/readings/max/').headers['ETag'], first.headers['ETag'])
+        self.post_reading('a', 40)
+        third = self.get('/devices/a/readings/max/')
+        self.assertEqual(json.loads(third.data), {'value': 40})
+        self.assertNotEqual(third.headers['ETag'], first.headers['ETag'])
+
+    def test_not_modified(self):
+        etag = self.get('/readings/summary/').headers['ETag']
+        request = self.get('/readings/summary/', headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 304)
+        self.assertEqual(request.data, b'')
+
+        self.post_reading('b', 30)
+        request = self.get('/readings/summary/', headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual([summary['number_of_readings'] for summary in json.loads(request.data)], [2, 1])
+
+    def test_query_parameters_are_keys(self):
+        self.assertEqual(json.loads(self.get('/devices/a/readings/quartiles/').data)['quartile_1'], 10)
+        request = self.client().get('/devices/a/readings/quartiles/?start=1&end=1005')
+        self.assertEqual(json.loads(request.data), {})
+        request = self.client().get('/devices/a/readings/quartiles/?start=1&end=2000&type=humidity')
+        self.assertEqual(json.loads(request.data), {})
+
+    def test_default_window_polls_hit(self):
+        app.config['QUERY_DEFAULT_WINDOW'] = app.config['QUERY_MAX_WINDOW'] = 6000
+        now = get_cache_now_of('/devices/a/readings/max/')
+        self.assertEqual(now % 100, 0)
+        self.assertGreaterEqual(now, int(time.time()))
+        before = self.get_stats()
+        for i in range(3):
+            request = self.client().get('/devices/a/readings/max/')
+            self.assertEqual(request.status_code, 200)
+        after = self.get_stats()
+        # Unless the clock crossed a step boundary in between
+        self.assertGreaterEqual(after['hits'] - before['hits'], 1)
+
+    def test_disabled(self):
+        app.config['RESPONSE_CACHE_SIZE'] = 0
+        request = self.get('/devices/a/readings/max/')
+        self.assertNotIn('ETag', request.headers)
+        self.assertEqual(json.loads(request.data), {'value': 10})
@@ -0,0 +1,177 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import columnar
+from app import app, load_latest
+from columnar import ColumnStore, convert_database
+from tests.test_partitions import make_readings, post_readings, get_responses
+from utils import reset_db
+
+
+class ColumnStoreTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = ColumnStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_series_stay_sorted(self):
+        self.store.append([('a', 'temperature', 10, 100), ('a', 'temperature', 20, 300)])
+        self.store.append([('a', 'temperature', 30, 400)])
+        series = self.store.get_series('a', 'temperature')
+        self.assertEqual(series.get_generation(), 0)
+
+        # Late readings are kept apart from the series and merged into it when read
+        self.store.append([('a', 'temperature', 40, 200), ('a', 'temperature', 50, 500)])
+        timestamps, values = series.read()
+        self.assertEqual(timestamps.tolist(), [100, 200, 300, 400, 500])
+        self.assertEqual(values.tolist(), [10, 40, 20, 30, 50])
+        self.assertEqual(series.get_generation(), 0)
+        self.assertEqual(os.path.getsize(series.get_files(0)[0]), 32)
+        self.assertEqual(ColumnStore(self.path).get_series('a', 'temperature').read()[0].tolist(),
+                         [100, 200, 300, 400, 500])
+
+        # Until there are LATE_READINGS of them, then the series is rewritten with them
+        late_readings, columnar.LATE_READINGS = columnar.LATE_READINGS, 3
+        try:
+            self.store.append([('a', 'temperature', 60, 100), ('a', 'temperature', 70, 600)])
+            self.assertEqual(series.get_generation(), 0)
+            self.store.append([('a', 'temperature', 80, 450)])
+        finally:
+            columnar.LATE_READINGS = late_readings
+        timestamps, values = series.read()
+        self.assertEqual(timestamps.tolist(), [100, 100, 200, 300, 400, 450, 500, 600])
+        self.assertEqual(values.tolist(), [10, 60, 40, 20, 30, 80, 50, 70])
+        self.assertEqual(series.get_generation(), 1)
+        self.assertEqual(sorted(os.listdir(series.path)), ['1.ts', '1.val', 'CURRENT', 'LOCK'])
+
+    def test_long_names_are_hashed(self):
+        device_uuid, sensor_type = 'd' * 200, 'tÿpe' * 100
+        self.store.append([(device_uuid, sensor_type, 10, 100), ('a', 'temperature', 20, 100)])
+        self.assertEqual(self.store.list_devices(), ['a', device_uuid])
+        self.assertEqual(self.store.list_types(device_uuid), [sensor_type])
+        self.assertEqual(ColumnStore(self.path).get_histogram(device_uuid), [(10, 1)])
+        self.assertTrue(all(len(name) <= 255 for root, names, files in os.walk(self.path) for name in names))
+
+    def test_torn_append_is_cut(self):
+        self.store.append([('a', 'humidity', 10, 100), ('a', 'humidity', 20, 200)])
+        series = self.store.get_series('a', 'humidity')
+        ts_file, val_file = series.get_files(0)
+        # A crash after the value of a third reading and half of its timestamp
+        with open(val_file, 'ab') as f:
+            f.write(b'\x1e')
+        with open(ts_file, 'ab') as f:
+            f.write(b'\x2c\x01\x00\x00')
+        self.assertEqual(series.read()[0].tolist(), [100, 200])
+
+        self.store.append([('a', 'humidity', 40, 400)])
+        timestamps, values = series.read()
+        self.assertEqual(timestamps.tolist(), [100, 200, 400])
+        self.assertEqual(values.tolist(), [10, 20, 40])
+        self.assertEqual(os.path.getsize(ts_file), 24)
+
+    def test_reading_rows_follow_cursor(self):
+        self.store.append([
+            ('a', 'temperature', 1, 100), ('a', 'humidity', 2, 100), ('a', 'temperature', 3, 100),
+            ('a', 'humidity', 4, 50), ('a', 'other', 5000, 100), ('a', 'temperature', 6, 150),
+        ])
+        rows = sum([chunk for type_names, chunk in self.store.iter_reading_rows('a')], [])
+        self.assertEqual([row[3] for row in rows], [50, 100, 100, 100, 100, 150])
+
+        seen = []
+        after = None
+        while True:
+            page = sum([chunk for type_names, chunk in self.store.iter_reading_rows('a', after=after, limit=1)], [])
+            if not page:
+                break
+            seen.extend(page)
+            after = (page[-1][3], page[-1][0])
+        self.assertEqual(seen, rows)
+        self.assertEqual(self.store.get_histogram('a', start=100, end=100), [(1, 1), (2, 1), (3, 1), (5000, 1)])
+
+    def test_reading_rows_page_reads_a_window(self):
+        self.store.append([('a', sensor_type, i % 100, i) for i in range(5000)
+                           for sensor_type in ('temperature', 'humidity')])
+        read = []
+        iter_series_rows = columnar.iter_series_rows
+
+        def counted(*args):
+            for row in iter_series_rows(*args):
+                read.append(row)
+                yield row
+        columnar.iter_series_rows = counted
+        try:
+            chunks = [chunk for type_names, chunk in self.store.iter_reading_rows('a', after=(100, 0), limit=5,
+                                                                                chunk_size=2)]
+        finally:
+            columnar.iter_series_rows = iter_series_rows
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([row[3] for chunk in chunks for row in chunk], [100, 100, 101, 101, 102])
+        self.assertLessEqual(len(read), 8)
+
+
+class ColumnarRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.windows = app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW']
+        app.config['QUERY_DEFAULT_WINDOW'] = None
+        app.config['QUERY_MAX_WINDOW'] = None
+        reset_db(app)
+        self.path = tempfile.mkdtemp()
+        app.config['COLUMNAR_PATH'] = self.path
+        self.client = app.test_client
+        self.readings = make_readings(['a', 'b', 'c'])
+
+    def tearDown(self):
+        app.config['STORAGE_ENGINE'] = 'sqlite'
+        app.config['COLUMNAR_PATH'] = 'columnar'
+        app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW'] = self.windows
+        shutil.rmtree(self.path)
+
+    def test_columnar_matches_sqlite(self):
+        post_readings(self, self.readings)
+        expected = get_responses(self, ['a', 'b'])
+
+        app.config['STORAGE_ENGINE'] = 'columnar'
+        post_readings(self, self.readings)
+        self.assertEqual(get_responses(self, ['a', 'b']), expected)
+
+        request = self.client().get('/devices/a/readings/?limit=7')
+        data = json.loads(request.data)
+        cursor = request.headers['X-Next-Cursor']
+        data += json.loads(self.client().get('/devices/a/readings/?cursor={}'.format(cursor)).data)
+        self.assertEqual(data, expected[2])
+
+    def test_export_matches_sqlite(self):
+        post_readings(self, self.readings)
+        paths = ['/readings/export/', '/readings/export/?devices=a,c&type=humidity']
+        # Both storages order readings by date within a series only
+        expected = [sorted(self.client().get(path).get_data(as_text=True).splitlines()) for path in paths]
+        self.assertTrue(all(expected))
+
+        app.config['STORAGE_ENGINE'] = 'columnar'
+        post_readings(self, self.readings)
+        self.assertEqual([sorted(self.client().get(path).get_data(as_text=True).splitlines()) for path in paths],
+                         expected)
+
+    def test_convert_database(self):
+        post_readings(self, self.readings)
+        expected = get_responses(self, ['a', 'c'])
+
+        self.assertEqual(convert_database('test_database.db', ColumnStore(self.path)), len(self.readings))
+        app.config['STORAGE_ENGINE'] = 'columnar'
+        self.assertEqual(get_responses(self, ['a', 'c']), expected)
+        latest = self.client().get('/readings/latest/').data
+        load_latest()
+        self.assertEqual(self.client().get('/readings/latest/').data, latest)
+        timestamps, values = ColumnStore(self.path).get_series('a', 'humidity').read()
+        self.assertEqual(values.dtype, np.uint8)
+        self.assertTrue((np.diff(timestamps) >= 0).all())
@@ -0,0 +1,156 @@
+import csv
+import io
+import json
+import unittest
+
+import pyarrow
+import pyarrow.ipc
+
+import export
+from app import app
+from utils import reset_db, close_db_pools
+
+
+class ExportWriterTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = [
+            ({1: 'a', 2: 'b'}, {1: 'temperature'}, ((1, 2), (1, 1), (10, None), (100, 200))),
+            ({1: 'a'}, {1: 'temperature', 2: 'humidity'}, ((1,), (2,), (30,), (300,))),
+        ]
+
+    def test_ndjson(self):
+        lines = ''.join(export.write_ndjson(self.chunks)).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            dict(device_uuid='a', type='temperature', value=10, date_created=100),
+            dict(device_uuid='b', type='temperature', value=None, date_created=200),
+            dict(device_uuid='a', type='humidity', value=30, date_created=300),
+        ])
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(''.join(export.write_csv(self.chunks)))))
+        self.assertEqual(rows, [
+            ['device_uuid', 'type', 'value', 'date_created'],
+            ['a', 'temperature', '10', '100'],
+            ['b', 'temperature', '', '200'],
+            ['a', 'humidity', '30', '300'],
+        ])
+
+    def test_arrow(self):
+        reader = pyarrow.ipc.open_stream(b''.join(export.write_arrow(self.chunks)))
+        batches = list(reader)
+        self.assertEqual([batch.num_rows for batch in batches], [2, 1])
+        self.assertEqual(pyarrow.Table.from_batches(batches).to_pydict(), dict(
+            device_uuid=['a', 'b', 'a'],
+            type=['temperature', 'temperature', 'humidity'],
+            value=[10, None, 30],
+            date_created=[100, 200, 300],
+        ))
+
+
+class ExportRouteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_db(app)
+        self.client = app.test_client
+        readings = [
+            dict(device_uuid='a', type='temperature', value=10, date_created=100),
+            dict(device_uuid='b', type='humidity', value=20, date_created=150),
+            dict(device_uuid='a', type='humidity', value=30, date_created=200),
+            dict(device_uuid='c', type='temperature', value=40, date_created=300),
+        ]
+        request = self.client().post('/readings/batch/', data=json.dumps(readings), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+
+    def export(self, query_string, **kwargs):
+        if 'start=' not in query_string:
+            query_string += '&start=1&end=1000'
+        request = self.client().get('/readings/export/?' + query_string, **kwargs)
+        self.assertEqual(request.status_code, 200)
+        return request
+
+    def get_readings(self, query_string):
+        request = self.export(query_string)
+        self.assertEqual(request.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in request.get_data(as_text=True).splitlines()]
+
+    def test_ndjson(self):
+        self.assertEqual([(r['device_uuid'], r['value']) for r in self.get_readings('')],
+                         [('a', 10), ('b', 20), ('a', 30), ('c', 40)])
+        self.assertEqual([r['value'] for r in self.get_readings('devices=c,a')], [10, 30, 40])
+        self.assertEqual([r['value'] for r in self.get_readings('devices=a&type=humidity')], [30])
+        self.assertEqual([r['value'] for r in self.get_readings('type=temperature&start=200&end=1000')], [40])
+        self.assertEqual(self.get_readings('devices=unknown'), [])
+
+    def test_csv(self):
+        request = self.export('format=csv&type=humidity')
+        self.assertEqual(request.mimetype, 'text/csv')
+        self.assertEqual(request.get_data(as_text=True),
+                         'device_uuid,type,value,date_created\nb,humidity,20,150\na,humidity,30,200\n')
+
+    def test_arrow(self):
+        request = self.export('', headers={'Accept': 'application/vnd.apache.arrow.stream'})
+        self.assertEqual(request.mimetype, 'application/vnd.apache.arrow.stream')
+        table = pyarrow.ipc.open_stream(request.get_data()).read_all()
+        self.assertEqual(table.column('value').to_pylist(), [10, 20, 30, 40])
+        self.assertEqual(table.column('device_uuid').to_pylist(), ['a', 'b', 'a', 'c'])
+
+    def test_chunks(self):
+        chunk_size = app.config['EXPORT_CHUNK_SIZE']
+        app.config['EXPORT_CHUNK_SIZE'] = 3
+        try:
+            reader = pyarrow.ipc.open_stream(self.export('format=arrow').get_data())
+            self.assertEqual([batch.num_rows for batch in reader], [3, 1])
+        finally:
+            app.config['EXPORT_CHUNK_SIZE'] = chunk_size
+
+    def test_chunks_read_the_names_they_add(self):
+        readings = [dict(device_uuid='device_{}'.format(i), type='temperature', value=1, date_created=400 + i)
+                    for i in range(300)]
+        request = self.client().post('/readings/batch/', data=json.dumps(readings), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+        chunk_size = app.config['EXPORT_CHUNK_SIZE']
+        app.config['EXPORT_CHUNK_SIZE'] = 100
+        statements = []
+        app.config['DB_TRACE'] = statements.append
+        close_db_pools()
+        try:
+            device_uuids = [r['device_uuid'] for r in self.get_readings('start=400&end=1000')]
+        finally:
+            app.config['EXPORT_CHUNK_SIZE'] = chunk_size
+            app.config.pop('DB_TRACE', None)
+            close_db_pools()
+        self.assertEqual(device_uuids, [reading['device_uuid'] for reading in readings])
+        lookups = [statement for statement in statements if 'from devices' in statement]
+        self.assertEqual(len(lookups), 3)
+        self.assertTrue(all('where id in' in statement for statement in lookups))
+
+    def test_stalled_exports_hold_no_connection(self):
+        chunk_size = app.config['EXPORT_CHUNK_SIZE']
+        app.config['EXPORT_CHUNK_SIZE'] = 1
+        app.config['DB_READ_POOL_SIZE'] = 2
+        app.config['DB_ACQUIRE_TIMEOUT'] = 0.5
+        close_db_pools()
+        try:
+            responses = [self.client().get('/readings/export/?start=1&end=1000', buffered=False) for i in range(4)]
+            bodies = [iter(response.response) for response in responses]
+            for body in bodies:
+                self.assertEqual(json.loads(next(body))['value'], 10)
+
+            request = self.client().get('/devices/a/readings/stats/?start=1&end=1000')
+            self.assertEqual(request.status_code, 200)
+
+            for body in bodies:
+                self.assertEqual([json.loads(line)['value'] for line in b''.join(body).splitlines()], [20, 30, 40])
+            for response in responses:
+                response.close()
+        finally:
+            app.config['EXPORT_CHUNK_SIZE'] = chunk_size
+            app.config.pop('DB_READ_POOL_SIZE', None)
+            app.config.pop('DB_ACQUIRE_TIMEOUT', None)
+            close_db_pools()
+
+    def test_invalid_format(self):
+        request = self.client().get('/readings/export/?format=xml')
+        self.assertEqual(request.status_code, 400)
@@ -0,0 +1,163 @@
+import json
+import sqlite3
+import time
+import unittest
+
+from app import app, heavy_queries
+from guard import QueryBudget, QueryLimiter
+from metrics import PROGRESS_STEPS
+from utils import reset_db
+
+READINGS_ROUTE = '/devices/<string:device_uuid>/readings/'
+
+
+class QueryBudgetTestCases(unittest.TestCase):
+
+    def test_interrupts_past_deadline(self):
+        budget = QueryBudget()
+        conn = sqlite3.connect(':memory:')
+        conn.set_progress_handler(budget.is_exceeded, PROGRESS_STEPS)
+        query = 'with recursive n(i) as (select 1 union all select i + 1 from n where i < 100000000) ' \
+                'select count(*) from n'
+        budget.start(0.05)
+        started = time.time()
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute(query).fetchall()
+        self.assertLess(time.time() - started, 5)
+
+        budget.clear()
+        self.assertEqual(conn.execute('select 1').fetchall(), [(1,)])
+
+    def test_bind(self):
+        budget = QueryBudget()
+        budget.start(10)
+        deadline = budget.get_deadline()
+        bound = budget.bind(budget.get_deadline)
+        budget.clear()
+        self.assertEqual(bound(), deadline)
+        self.assertIsNone(budget.get_deadline())
+
+    def test_bind_iterator(self):
+        budget = QueryBudget()
+        budget.start(10)
+        deadline = budget.get_deadline()
+        iterator = budget.bind_iterator(budget.get_deadline() for i in range(2))
+        budget.clear()
+        self.assertAlmostEqual(next(iterator), deadline, delta=0.01)
+        # The time the client takes between two items isn't counted
+        time.sleep(0.05)
+        self.assertGreater(next(iterator), deadline)
+        self.assertIsNone(budget.get_deadline())
+        self.assertEqual(budget.bind_iterator([1]), [1])
+
+    def test_limiter(self):
+        limiter = QueryLimiter(1, 0.01)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+
+    def test_limiter_hold(self):
+        limiter = QueryLimiter(1, 0.01)
+        self.assertTrue(limiter.acquire())
+        release, iterator = limiter.hold(iter([1, 2]))
+        self.assertEqual(next(iterator), 1)
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(list(iterator), [2])
+        release()
+        self.assertTrue(limiter.acquire())
+        limiter.release()
+
+        self.assertTrue(limiter.acquire())
+        release, iterator = limiter.hold(iter([1, 2]))
+        release()
+        self.assertTrue(limiter.acquire())
+
+
+class QueryLimitsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.time_budget = app.config['QUERY_TIME_BUDGET']
+        reset_db(app)
+        self.client = app.test_client
+        readings = [dict(device_uuid='device_{}'.format(i % 3), type='temperature', value=i % 100,
+                         date_created=1000 + i) for i in range(3000)]
+        request = self.client().post('/readings/batch/', data=json.dumps(readings), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+
+    def tearDown(self):
+        app.config['QUERY_LIMITS'] = {}
+        app.config['QUERY_TIME_BUDGET'] = self.time_budget
+
+    def test_max_rows(self):
+        app.config['QUERY_LIMITS'] = {READINGS_ROUTE: dict(max_rows=2), '/readings/summary/': dict(max_rows=1)}
+        request = self.client().get('/devices/device_0/readings/?start=1000&end=5000')
+        self.assertEqual(len(json.loads(request.data)), 2)
+        self.assertIn('X-Next-Cursor', request.headers)
+        request = self.client().get('/devices/device_0/readings/?start=1000&end=5000&limit=1')
+        self.assertEqual(len(json.loads(request.data)), 1)
+        request = self.client().get('/readings/summary/?start=1000&end=5000&limit=3')
+        self.assertEqual(len(json.loads(request.data)), 1)
+
+    def test_max_window(self):
+        app.config['QUERY_LIMITS'] = {'/readings/summary/': dict(max_window=1000)}
+        self.assertEqual(self.client().get('/readings/summary/?start=1000&end=5000').status_code, 400)
+        self.assertEqual(self.client().get('/readings/summary/?start=1000&end=2000').status_code, 200)
+        self.assertEqual(self.client().get('/devices/device_0/readings/stats/?start=1000&end=5000').status_code, 200)
+
+    def test_time_budget(self):
+        app.config['QUERY_LIMITS'] = {READINGS_ROUTE: dict(max_seconds=1e-9)}
+        request = self.client().get('/devices/device_0/readings/?start=1000&end=5000&limit=5000')
+        self.assertEqual(request.status_code, 503)
+        self.assertIn('time budget', json.loads(request.data)['message'])
+
+        # Writes are never interrupted
+        request = self.client().post('/devices/device_0/readings/', data=json.dumps({
+            'type': 'temperature',
+            'value': 10
+        }), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+
+    def test_heavy_query_slots(self):
+        wait, heavy_queries.wait = heavy_queries.wait, 0.01
+        acquired = 0
+        try:
+            while heavy_queries.acquire():
+                acquired += 1
+            request = self.client().get('/readings/summary/?start=1000&end=5000')
+            self.assertEqual(request.status_code, 503)
+        finally:
+            for i in range(acquired):
+                heavy_queries.release()
+            heavy_queries.wait = wait
+        self.assertEqual(acquired, app.config['HEAVY_QUERY_CONCURRENCY'])
+        self.assertEqual(self.client().get('/readings/summary/?start=1000&end=5000').status_code, 200)
+
+    def test_exports_have_no_time_budget(self):
+        app.config['QUERY_TIME_BUDGET'] = 1e-9
+        request = self.client().get('/devices/device_0/readings/?start=1000&end=5000&limit=5000')
+        self.assertEqual(request.status_code, 503)
+        request = self.client().get('/readings/export/?start=1000&end=5000&format=csv')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(len(request.data.splitlines()), 3001)
+
+    def test_exports_hold_heavy_query_slots(self):
+        wait, heavy_queries.wait = heavy_queries.wait, 0.01
+        try:
+            responses = [self.client().get('/readings/export/?start=1000&end=5000', buffered=False)
+                         for i in range(app.config['HEAVY_QUERY_CONCURRENCY'])]
+            self.assertEqual([response.status_code for response in responses],
+                             [200] * app.config['HEAVY_QUERY_CONCURRENCY'])
+            self.assertEqual(self.client().get('/readings/summary/?start=1000&end=5000').status_code, 503)
+            self.assertEqual(len(responses[0].get_data().splitlines()), 3000)
+            responses[0].close()
+            self.assertEqual(self.client().get('/readings/summary/?start=1000&end=5000').status_code, 200)
+            # Bodies never read free their slot once closed
+            for response in responses[1:]:
+                response.close()
+        finally:
+            heavy_queries.wait = wait
+        request = self.client().get('/readings/summary/?start=1000&end=5000')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(heavy_queries.semaphore._value, app.config['HEAVY_QUERY_CONCURRENCY'])
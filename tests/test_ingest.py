@@ -0,0 +1,177 @@
+import json
+import sqlite3
+import threading
+import unittest
+
+from app import app, stop_write_buffer, get_write_buffer
+from ingest import WriteBuffer, BufferFull, BufferStopped, WriteTimeout
+from partitions import PartialWrite
+from utils import reset_db
+
+
+class WriteBufferTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.flushed = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def flush(self, readings):
+        self.release.wait()
+        self.flushed.append(list(readings))
+
+    def test_group_commit_on_size(self):
+        write_buffer = WriteBuffer(self.flush, batch_size=3, flush_interval=10)
+        self.release.clear()
+        write_buffer.start()
+        for i in range(6):
+            write_buffer.put(i)
+        self.release.set()
+        write_buffer.stop()
+
+        self.assertEqual(sum(self.flushed, []), list(range(6)))
+        self.assertTrue(all(len(batch) <= 3 for batch in self.flushed))
+
+    def test_group_commit_on_deadline(self):
+        write_buffer = WriteBuffer(self.flush, batch_size=100, flush_interval=0.01)
+        write_buffer.start()
+        pending = write_buffer.put('reading', wait=True)
+        pending.wait(timeout=5)
+        self.assertEqual(self.flushed, [['reading']])
+        write_buffer.stop()
+
+    def test_backpressure_when_full(self):
+        write_buffer = WriteBuffer(self.flush, max_size=2)
+        write_buffer.put(1)
+        write_buffer.put(2)
+        with self.assertRaises(BufferFull):
+            write_buffer.put(3)
+
+    def test_flush_error_reaches_waiting_producer(self):
+        errors = []
+
+        def flush(readings):
+            raise sqlite3.OperationalError('disk I/O error')
+
+        write_buffer = WriteBuffer(flush, flush_interval=0, on_error=lambda e, count: errors.append(count))
+        write_buffer.start()
+        pending = write_buffer.put('reading', wait=True)
+        with self.assertRaises(sqlite3.OperationalError):
+            pending.wait(timeout=5)
+        write_buffer.stop()
+        self.assertEqual(errors, [1])
+
+    def test_partial_write_reaches_failed_readings_only(self):
+        def flush(readings):
+            raise PartialWrite([1], sqlite3.OperationalError('disk I/O error'))
+
+        errors = []
+        write_buffer = WriteBuffer(flush, flush_interval=0.05, on_error=lambda e, count: errors.append(count))
+        write_buffer.start()
+        pendings = [write_buffer.put(i, wait=True) for i in range(3)]
+        pendings[0].wait(timeout=5)
+        with self.assertRaises(PartialWrite):
+            pendings[1].wait(timeout=5)
+        pendings[2].wait(timeout=5)
+        write_buffer.stop()
+        self.assertEqual(errors, [1])
+
+    def test_stop_drains_queue(self):
+        write_buffer = WriteBuffer(self.flush, batch_size=1000, flush_interval=10)
+        self.release.clear()
+        write_buffer.start()
+        for i in range(50):
+            write_buffer.put(i)
+        self.release.set()
+        write_buffer.stop()
+        self.assertEqual(sum(self.flushed, []), list(range(50)))
+        with self.assertRaises(BufferFull):
+            write_buffer.put(51)
+        with self.assertRaises(BufferStopped):
+            write_buffer.put(52)
+
+        # Nothing would ever write the readings of a buffer stopped before it started
+        unstarted = WriteBuffer(self.flush)
+        unstarted.stop()
+        with self.assertRaises(BufferStopped):
+            unstarted.put(1)
+
+    def test_wait_times_out(self):
+        write_buffer = WriteBuffer(self.flush, flush_interval=0)
+        self.release.clear()
+        write_buffer.start()
+        pending = write_buffer.put(1, wait=True)
+        with self.assertRaises(WriteTimeout):
+            pending.wait(timeout=0.05)
+        self.release.set()
+        pending.wait(timeout=5)
+        write_buffer.stop()
+
+
+class BufferedIngestTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_db(app)
+        app.config['INGEST_MODE'] = 'buffered'
+        self.client = app.test_client
+
+    def tearDown(self):
+        stop_write_buffer()
+        app.config['INGEST_MODE'] = 'direct'
+        app.config['INGEST_DURABILITY'] = 'flush'
+
+    def post_reading(self, value):
+        return self.client().post('/devices/buffered/readings/', data=json.dumps({
+            'type': 'temperature',
+            'value': value
+        }), content_type='application/json')
+
+    def count_readings(self):
+        conn = sqlite3.connect('test_database.db')
+        total = conn.execute('select count(*) from readings where device_uuid = ?', ('buffered',)).fetchone()[0]
+        conn.close()
+        return total
+
+    def test_buffered_post_waits_for_flush(self):
+        request = self.post_reading(20)
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(self.count_readings(), 1)
+
+        request = self.post_reading(101)
+        self.assertEqual(request.status_code, 400)
+
+    def test_buffered_post_acknowledged_immediately(self):
+        app.config['INGEST_DURABILITY'] = 'ack'
+        for value in range(10):
+            self.assertEqual(self.post_reading(value).status_code, 202)
+        stop_write_buffer()
+        self.assertEqual(self.count_readings(), 10)
+
+    def test_buffered_post_full_queue(self):
+        app.config['INGEST_DURABILITY'] = 'ack'
+        app.config['INGEST_QUEUE_SIZE'] = 1
+        app.config['INGEST_FLUSH_INTERVAL'] = 10
+        try:
+            statuses = [self.post_reading(value).status_code for value in range(5)]
+        finally:
+            app.config['INGEST_QUEUE_SIZE'] = 10000
+            app.config['INGEST_FLUSH_INTERVAL'] = 0.005
+        self.assertIn(429, statuses)
+
+    def test_buffered_post_times_out(self):
+        app.config['INGEST_WAIT_TIMEOUT'] = 0.05
+        app.config['INGEST_FLUSH_INTERVAL'] = 10
+        try:
+            self.assertEqual(self.post_reading(20).status_code, 503)
+        finally:
+            app.config['INGEST_WAIT_TIMEOUT'] = 10
+            app.config['INGEST_FLUSH_INTERVAL'] = 0.005
+        # The reading is still written with its group
+        stop_write_buffer()
+        self.assertEqual(self.count_readings(), 1)
+
+    def test_buffered_post_after_stop(self):
+        write_buffer = get_write_buffer()
+        write_buffer.stop()
+        self.assertEqual(self.post_reading(20).status_code, 503)
@@ -0,0 +1,75 @@
+import json
+import unittest
+
+from app import app, load_latest
+from latest import LatestReadings
+from utils import reset_db
+
+
+class LatestReadingsTestCases(unittest.TestCase):
+
+    def test_update(self):
+        latest = LatestReadings()
+        latest.update([('a', 'temperature', 10, 100), ('a', 'temperature', 20, 50), ('a', 'humidity', 30, 100)])
+        latest.update([('a', 'temperature', 40, 100)])
+        self.assertEqual(latest.get('a'), [
+            dict(device_uuid='a', type='humidity', value=30, date_created=100),
+            dict(device_uuid='a', type='temperature', value=40, date_created=100),
+        ])
+        self.assertEqual(latest.get('a', 'humidity'), [dict(device_uuid='a', type='humidity', value=30, date_created=100)])
+        self.assertEqual(latest.get('b'), [])
+
+
+class LatestRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_db(app)
+        self.client = app.test_client
+        readings = [
+            dict(device_uuid='a', type='temperature', value=10, date_created=100),
+            dict(device_uuid='a', type='temperature', value=20, date_created=300),
+            dict(device_uuid='a', type='humidity', value=30, date_created=200),
+            dict(device_uuid='b', type='temperature', value=40, date_created=100),
+            dict(device_uuid='c', type='humidity', value=50, date_created=100),
+        ]
+        request = self.client().post('/readings/batch/', data=json.dumps(readings), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+
+    def get(self, path):
+        request = self.client().get(path)
+        self.assertEqual(request.status_code, 200)
+        return json.loads(request.data)
+
+    def test_device_latest(self):
+        self.assertEqual(self.get('/devices/a/readings/latest/'), [
+            dict(device_uuid='a', type='humidity', value=30, date_created=200),
+            dict(device_uuid='a', type='temperature', value=20, date_created=300),
+        ])
+        self.assertEqual([reading['value'] for reading in self.get('/devices/a/readings/latest/?type=humidity')], [30])
+        self.assertEqual(self.get('/devices/unknown/readings/latest/'), [])
+
+    def test_single_posts_update_latest(self):
+        for value, date_created in ((60, 400), (70, 250)):
+            request = self.client().post('/devices/a/readings/', data=json.dumps({
+                'type': 'temperature',
+                'value': value,
+                'date_created': date_created
+            }), content_type='application/json')
+            self.assertEqual(request.status_code, 201)
+        # An older reading arriving late doesn't replace the latest one
+        self.assertEqual([reading['value'] for reading in self.get('/devices/a/readings/latest/?type=temperature')],
+                         [60])
+
+    def test_fleet_latest(self):
+        self.assertEqual([(reading['device_uuid'], reading['value']) for reading in self.get('/readings/latest/')],
+                         [('a', 30), ('a', 20), ('b', 40), ('c', 50)])
+        readings = self.get('/readings/latest/?devices=c,b,unknown&type=temperature')
+        self.assertEqual([(reading['device_uuid'], reading['value']) for reading in readings], [('b', 40)])
+
+    def test_rebuilt_from_database(self):
+        expected = self.get('/readings/latest/')
+        app.extensions['latest_readings'].clear()
+        self.assertEqual(self.get('/readings/latest/'), [])
+        load_latest()
+        self.assertEqual(self.get('/readings/latest/'), expected)
@@ -0,0 +1,113 @@
+import json
+import math
+import sqlite3
+import unittest
+
+from app import app, app_metrics
+from metrics import Metrics, InstrumentedConnection, ITERATION_ROWS, get_shape
+from utils import reset_db
+
+
+class MetricsTestCases(unittest.TestCase):
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.inc('sensor_api_requests_total', [('method', 'GET'), ('route', '/a/"b"/')])
+        metrics.observe('sensor_api_request_seconds', [('method', 'GET'), ('route', '/a/')], 0.003)
+        output = metrics.render()
+        self.assertIn('# TYPE sensor_api_requests_total counter', output)
+        self.assertIn('sensor_api_requests_total{method="GET",route="/a/\\"b\\"/"} 1', output)
+        self.assertIn('sensor_api_request_seconds_bucket{method="GET",route="/a/",le="0.0025"} 0', output)
+        self.assertIn('sensor_api_request_seconds_bucket{method="GET",route="/a/",le="0.005"} 1', output)
+        self.assertIn('sensor_api_request_seconds_bucket{method="GET",route="/a/",le="+Inf"} 1', output)
+        self.assertIn('sensor_api_request_seconds_count{method="GET",route="/a/"} 1', output)
+
+    def test_statements(self):
+        slow = []
+        metrics = Metrics(slow_query_seconds=1e-9, on_slow_query=lambda *args: slow.append(args))
+        conn = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+        conn.metrics = metrics
+        conn.execute('create table readings (device_uuid text, value integer)')
+        conn.executemany('insert into readings values (?, ?)', [('a', i) for i in range(10)])
+        cur = conn.cursor()
+        cur.execute('select value from readings where device_uuid = ?', ('a',))
+        self.assertEqual(len(cur.fetchmany(4)), 4)
+        conn.finish_statements()
+
+        shape, statement = get_shape('select value from readings where device_uuid = ?')
+        self.assertIn(('sensor_api_sql_rows_returned_total', (('shape', shape),)), metrics.counters)
+        self.assertEqual(metrics.counters[('sensor_api_sql_rows_returned_total', (('shape', shape),))], 4)
+        self.assertEqual(sum(metrics.histograms[('sensor_api_sql_seconds', (('shape', shape),))].counts), 1)
+        self.assertIn(statement, [args[0] for args in slow])
+        plan = [args[3] for args in slow if args[0] == statement][0]
+        self.assertTrue(any('SCAN' in line for line in plan))
+
+    def test_iteration_is_timed_per_batch(self):
+        conn = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+        conn.metrics = Metrics()
+        conn.execute('create table readings (device_uuid text, value integer)')
+        conn.executemany('insert into readings values (?, ?)', [('a', i) for i in range(1000)])
+
+        timed = []
+        cursor = conn.cursor()
+        run = cursor.run
+        cursor.run = lambda method, *args: timed.append(method) or run(method, *args)
+        rows = sum(1 for row in cursor.execute('select device_uuid, value from readings'))
+        self.assertEqual(rows, 1000)
+        # A timing per batch rather than per row, the last fetch finding none
+        batches = int(math.ceil(1000.0 / ITERATION_ROWS))
+        self.assertEqual(timed, [sqlite3.Cursor.execute] + [sqlite3.Cursor.fetchmany] * (batches + 1))
+        shape = get_shape('select device_uuid, value from readings')[0]
+        self.assertEqual(conn.metrics.counters[('sensor_api_sql_rows_returned_total', (('shape', shape),))], 1000)
+
+    def test_disabled(self):
+        metrics = Metrics(enabled=False)
+        with metrics.timed('validation'):
+            pass
+        self.assertEqual(metrics.histograms, {})
+
+
+class MetricsRouteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        reset_db(app)
+        self.client = app.test_client
+
+    def get(self, path):
+        # Requests are recorded once their response is closed, as a WSGI server does
+        request = self.client().get(path)
+        request.get_data()
+        request.close()
+        return request
+
+    def test_metrics(self):
+        request = self.client().post('/devices/test_device/readings/', data=json.dumps({
+            'type': 'temperature',
+            'value': 10
+        }), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+        request.close()
+        self.assertEqual(self.get('/devices/test_device/readings/').status_code, 200)
+
+        request = self.client().get('/metrics')
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.content_type.startswith('text/plain; version=0.0.4'))
+        output = request.get_data(as_text=True)
+        self.assertIn('sensor_api_requests_total{method="POST",route="/devices/<string:device_uuid>/readings/",'
+                      'status="201"}', output)
+        for phase in ('connection', 'sql', 'validation', 'serialization'):
+            self.assertIn('phase="{}"'.format(phase), output)
+        self.assertIn('sensor_api_sql_shape_info{shape="', output)
+        self.assertIn('sensor_api_response_cache_total{result="hits"}', output)
+
+    def test_slow_query_log(self):
+        slow = []
+        on_slow_query, slow_query_seconds = app_metrics.on_slow_query, app_metrics.slow_query_seconds
+        app_metrics.on_slow_query, app_metrics.slow_query_seconds = lambda *args: slow.append(args), 1e-9
+        try:
+            self.assertEqual(self.get('/devices/test_device/readings/').status_code, 200)
+        finally:
+            app_metrics.on_slow_query, app_metrics.slow_query_seconds = on_slow_query, slow_query_seconds
+        self.assertTrue(slow)
+        self.assertTrue(all(plan for statement, seconds, rows, plan in slow))
@@ -0,0 +1,253 @@
+import calendar
+import json
+import os
+import random
+import sqlite3
+import unittest
+
+from app import app, load_latest
+from partitions import get_db_names, drop_partitions, drop_expired_partitions, get_partition_bounds, \
+    get_partition_key, get_shard
+from utils import reset_db, forget_db, pools
+
+FIRST_DAY = calendar.timegm((2026, 10, 1, 0, 0, 0))
+
+
+def make_readings(device_uuids, count=300):
+    rand = random.Random(12)
+    return [
+        dict(device_uuid=rand.choice(device_uuids), type=rand.choice(['temperature', 'humidity']),
+             value=rand.randint(0, 100), date_created=FIRST_DAY + rand.randint(0, 3 * 86400 - 1))
+        for i in range(count)
+    ]
+
+
+def post_readings(test, readings):
+    request = test.client().post('/readings/batch/', data=json.dumps(readings), content_type='application/json')
+    test.assertEqual(request.status_code, 201)
+
+
+def get_responses(test, device_uuids):
+    paths = [
+        '/readings/summary/',
+        '/readings/summary/?type=humidity&start={}'.format(FIRST_DAY + 100000),
+    ]
+    for device_uuid in device_uuids:
+        paths.extend([
+            '/devices/{}/readings/'.format(device_uuid),
+            '/devices/{}/readings/stats/?type=humidity'.format(device_uuid),
+            '/devices/{}/readings/stats/?start={}&end={}'.format(device_uuid, FIRST_DAY + 40000, FIRST_DAY + 200000),
+            '/devices/{}/readings/series/?interval=2d'.format(device_uuid),
+            '/devices/{}/readings/series/?interval=5m&type=temperature'.format(device_uuid),
+        ])
+    return [json.loads(test.client().get(path).data) for path in paths]
+
+
+class PartitionTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.windows = app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW']
+        app.config['QUERY_DEFAULT_WINDOW'] = None
+        app.config['QUERY_MAX_WINDOW'] = None
+        reset_db(app)
+        app.config['DB_PARTITION'] = 'day'
+        drop_partitions(app)
+        self.client = app.test_client
+        self.first_day = FIRST_DAY
+        self.readings = make_readings(['a', 'b'])
+
+    def tearDown(self):
+        drop_partitions(app)
+        app.config['DB_PARTITION'] = None
+        app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW'] = self.windows
+
+    def test_readings_are_routed_to_partitions(self):
+        post_readings(self, self.readings)
+        db_names = get_db_names(app)
+        self.assertEqual(db_names, [
+            'test_database.20261001.db', 'test_database.20261002.db', 'test_database.20261003.db'
+        ])
+        self.assertEqual(get_db_names(app, self.first_day + 86400, self.first_day + 86400 + 10), db_names[1:2])
+        self.assertEqual(get_db_names(app, start=self.first_day + 86400 * 2), db_names[2:])
+
+        seen = []
+        cursor = ''
+        while True:
+            request = self.client().get('/devices/a/readings/?limit=40&cursor={}'.format(cursor))
+            seen.extend(json.loads(request.data))
+            cursor = request.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        expected = sorted(
+            (reading['date_created'], reading['type'], reading['value'])
+            for reading in self.readings if reading['device_uuid'] == 'a'
+        )
+        self.assertEqual(sorted((row['date_created'], row['type'], row['value']) for row in seen), expected)
+        self.assertEqual([row['date_created'] for row in seen], [row[0] for row in expected])
+
+    def test_partitions_match_single_file(self):
+        post_readings(self, self.readings)
+        partitioned = get_responses(self, ['a', 'b'])
+
+        app.config['DB_PARTITION'] = None
+        post_readings(self, self.readings)
+        self.assertEqual(get_responses(self, ['a', 'b']), partitioned)
+
+    def test_retention_drops_partitions(self):
+        post_readings(self, self.readings)
+        first, last = get_partition_bounds('day', '20261002')
+        app.config['DB_PARTITION_RETENTION'] = 86400
+        try:
+            dropped = drop_expired_partitions(app, now=last + 86400)
+        finally:
+            app.config['DB_PARTITION_RETENTION'] = None
+        self.assertEqual(dropped, ['test_database.20261001.db'])
+        self.assertFalse(os.path.exists('test_database.20261001.db'))
+
+        request = self.client().get('/devices/a/readings/stats/?metrics=number_of_readings')
+        self.assertEqual(json.loads(request.data)['number_of_readings'], len([
+            reading for reading in self.readings
+            if reading['device_uuid'] == 'a' and reading['date_created'] >= first
+        ]))
+
+
+    def test_dates_outside_partitions_are_rejected(self):
+        for date_created in (2 ** 40, 2 ** 62, -2 ** 40):
+            request = self.client().post('/devices/a/readings/', data=json.dumps({
+                'type': 'temperature', 'value': 10, 'date_created': date_created
+            }), content_type='application/json')
+            self.assertEqual(request.status_code, 400, date_created)
+        request = self.client().post('/readings/batch/', data=json.dumps([
+            dict(device_uuid='a', type='temperature', value=10, date_created=2 ** 40),
+            dict(device_uuid='a', type='temperature', value=10, date_created=-1),
+        ]), content_type='application/json')
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual([error['index'] for error in json.loads(request.data)['errors']], [0])
+        self.assertEqual(get_db_names(app), ['test_database.19691231.db'])
+        for date_created in (2 ** 40, 2 ** 62):
+            with self.assertRaises(ValueError):
+                get_partition_key('day', date_created)
+
+        # Without partitions any date is stored
+        app.config['DB_PARTITION'] = None
+        for date_created in (2 ** 40, -2 ** 40):
+            request = self.client().post('/devices/a/readings/', data=json.dumps({
+                'type': 'temperature', 'value': 10, 'date_created': date_created
+            }), content_type='application/json')
+            self.assertEqual(request.status_code, 201, date_created)
+        app.config['DB_PARTITION'] = 'day'
+
+    def test_pools_are_bounded(self):
+        readings = [dict(device_uuid='a', type='temperature', value=day % 100, date_created=FIRST_DAY + day * 86400)
+                    for day in range(30)]
+        app.config['DB_MAX_POOLS'] = 8
+        try:
+            post_readings(self, readings)
+            self.assertLessEqual(len(pools), 8)
+            request = self.client().get('/devices/a/readings/stats/?metrics=number_of_readings')
+            self.assertEqual(json.loads(request.data)['number_of_readings'], 30)
+            self.assertLessEqual(len(pools), 8)
+        finally:
+            app.config.pop('DB_MAX_POOLS')
+
+
+class ShardTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.windows = app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW']
+        app.config['QUERY_DEFAULT_WINDOW'] = None
+        app.config['QUERY_MAX_WINDOW'] = None
+        reset_db(app)
+        app.config['DB_SHARDS'] = 3
+        self.remove_shards()
+        self.client = app.test_client
+        self.device_uuids = ['device-{}'.format(i) for i in range(12)]
+        self.readings = make_readings(self.device_uuids, 600)
+
+    def tearDown(self):
+        self.remove_shards()
+        app.config['DB_SHARDS'] = 1
+        app.config['DB_PARTITION'] = None
+        app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW'] = self.windows
+
+    def remove_shards(self):
+        period = app.config['DB_PARTITION']
+        app.config['DB_PARTITION'] = 'day'
+        drop_partitions(app)
+        app.config['DB_PARTITION'] = period
+        for shard in range(app.config['DB_SHARDS']):
+            db_name = 'test_database.s{}.db'.format(shard)
+            forget_db(db_name)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_name + suffix):
+                    os.remove(db_name + suffix)
+
+    def test_latest_rebuilt_from_shards_and_partitions(self):
+        app.config['DB_PARTITION'] = 'day'
+        post_readings(self, self.readings)
+        expected = {}
+        for reading in sorted(self.readings, key=lambda reading: reading['date_created']):
+            expected[(reading['device_uuid'], reading['type'])] = (reading['value'], reading['date_created'])
+
+        load_latest()
+        latest = json.loads(self.client().get('/readings/latest/').data)
+        self.assertEqual(dict(((reading['device_uuid'], reading['type']), (reading['value'], reading['date_created']))
+                              for reading in latest), expected)
+
+    def test_devices_stay_in_one_shard(self):
+        post_readings(self, self.readings)
+        self.assertEqual(get_db_names(app), ['test_database.s0.db', 'test_database.s1.db', 'test_database.s2.db'])
+
+        shards = {}
+        for db_name in get_db_names(app):
+            conn = sqlite3.connect(db_name)
+            for device_uuid, count in conn.execute('select device_uuid, count(*) from readings group by device_uuid'):
+                shards.setdefault(device_uuid, []).append((db_name, count))
+            conn.close()
+        self.assertEqual(len(set(db_name for places in shards.values() for db_name, count in places)), 3)
+        for device_uuid in self.device_uuids:
+            self.assertEqual([db_name for db_name, count in shards[device_uuid]],
+                             get_db_names(app, device_uuid=device_uuid))
+            self.assertEqual(shards[device_uuid][0][1],
+                             len([r for r in self.readings if r['device_uuid'] == device_uuid]))
+
+    def test_failed_shard_is_reported_per_reading(self):
+        post_readings(self, self.readings[:30])
+        conn = sqlite3.connect('test_database.s1.db')
+        conn.execute("create trigger fail before insert on readings_data begin select raise(abort, 'disk full'); end")
+        conn.close()
+
+        request = self.client().post('/readings/batch/', data=json.dumps(self.readings),
+                                     content_type='application/json')
+        self.assertEqual(request.status_code, 207)
+        data = json.loads(request.data)
+        failed = [index for index, reading in enumerate(self.readings) if get_shard(app, reading['device_uuid']) == 1]
+        self.assertTrue(failed)
+        self.assertEqual([error['index'] for error in data['errors']], failed)
+        self.assertEqual(data['inserted'], len(self.readings) - len(failed))
+
+        stored = 0
+        for db_name in get_db_names(app):
+            conn = sqlite3.connect(db_name)
+            stored += conn.execute('select count(*) from readings').fetchone()[0]
+            conn.close()
+        self.assertEqual(stored, 30 + data['inserted'])
+
+    def test_shards_match_single_file(self):
+        post_readings(self, self.readings)
+        sharded = get_responses(self, self.device_uuids[:3])
+
+        app.config['DB_PARTITION'] = 'day'
+        post_readings(self, self.readings)
+        self.assertEqual(len(get_db_names(app)), 9)
+        self.assertEqual(get_responses(self, self.device_uuids[:3]), sharded)
+
+        app.config['DB_PARTITION'] = None
+        app.config['DB_SHARDS'] = 1
+        try:
+            post_readings(self, self.readings)
+            self.assertEqual(get_responses(self, self.device_uuids[:3]), sharded)
+        finally:
+            app.config['DB_SHARDS'] = 3
@@ -0,0 +1,26 @@
+import unittest
+
+from queries import readings_page, histogram_buckets, histogram_readings
+
+
+class QueriesTestCases(unittest.TestCase):
+
+    def test_statement_shape_only_depends_on_device_and_type(self):
+        shapes = set()
+        for start, end in [(None, None), (10, None), (None, 20), (10, 20)]:
+            for type_id in [None, 3]:
+                filters = dict(device_id=7, type_id=type_id, start=start, end=end)
+                shapes.add(readings_page(filters)[0])
+                shapes.add(readings_page(filters, after=(15, 2), limit=10)[0])
+                shapes.add(histogram_buckets(filters, start, end)[0])
+                shapes.add(histogram_readings(filters, 0, 100)[0])
+        self.assertEqual(len(shapes), 6)
+
+    def test_values_are_bound(self):
+        filters = dict(device_id=7, type_id=None, start=10, end=None)
+        query, params = readings_page(filters, after=(15, 2), limit=10)
+        self.assertNotIn('7', query)
+        self.assertEqual(query.count('?'), len(params))
+        self.assertEqual(params[0], 7)
+        self.assertEqual(params[1], 10)
+        self.assertEqual(params[3:], [15, 2, 10])
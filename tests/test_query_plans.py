@@ -0,0 +1,112 @@
+import itertools
+import json
+import sqlite3
+import time
+import unittest
+
+from app import app
+from utils import init_db, clear_db, close_db_pools, explain_query_plan, get_full_scans, id_caches, MIGRATIONS, \
+    encode_cursor
+
+
+class QueryPlanTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Start from a database file created before the schema was versioned
+        conn = sqlite3.connect('test_database.db')
+        clear_db(conn)
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            ('plan_device', 'temperature', 10, int(time.time()) - 60),
+            ('plan_device', 'humidity', 20, int(time.time())),
+            ('other_device', 'temperature', 30, int(time.time())),
+        ])
+        conn.commit()
+        conn.close()
+
+        app.config['TESTING'] = True
+        close_db_pools()
+        id_caches.clear()
+        init_db(app)
+        self.client = app.test_client
+
+    def tearDown(self):
+        app.config.pop('DB_TRACE', None)
+        close_db_pools()
+
+    def test_migration_upgrades_in_place(self):
+        conn = sqlite3.connect('test_database.db')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        indexes = [row[0] for row in conn.execute("select name from sqlite_master where type = 'index'")]
+        total = conn.execute('select count(*) from readings').fetchone()[0]
+        conn.close()
+
+        self.assertEqual(version, len(MIGRATIONS))
+        self.assertIn('readings_device_type_date', indexes)
+        self.assertIn('readings_date_device', indexes)
+        self.assertEqual(total, 3)
+
+    def test_migration_keeps_readings(self):
+        request = self.client().get('/devices/plan_device/readings/?type=humidity')
+        data = json.loads(request.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['type'], 'humidity')
+        self.assertEqual(data[0]['value'], 20)
+
+    def test_no_full_table_scans(self):
+        statements = []
+        app.config['DB_TRACE'] = statements.append
+        close_db_pools()
+
+        filters = [('type', 'temperature'), ('start', int(time.time()) - 3600), ('end', int(time.time()))]
+        query_strings = []
+        for size in range(len(filters) + 1):
+            for combination in itertools.combinations(filters, size):
+                query_strings.append('&'.join('{}={}'.format(*f) for f in combination))
+
+        paths = [
+            '/devices/plan_device/readings/',
+            '/devices/plan_device/readings/?limit=1&cursor={}'.format(encode_cursor([0, 0])),
+            '/devices/plan_device/readings/quartiles/',
+            '/devices/plan_device/readings/min/',
+            '/devices/plan_device/readings/max/',
+            '/devices/plan_device/readings/mean/',
+            '/devices/plan_device/readings/median/',
+            '/devices/plan_device/readings/mode/',
+            '/readings/summary/',
+            '/readings/export/',
+            '/readings/export/?devices=plan_device,other_device',
+            '/devices/plan_device/readings/series/?interval=1m',
+            '/devices/plan_device/readings/series/?interval=1h',
+            '/devices/plan_device/readings/series/?interval=2d',
+        ]
+        for path in paths:
+            for query_string in query_strings:
+                request = self.client().get('{}{}{}'.format(path, '&' if '?' in path else '?', query_string))
+                self.assertEqual(request.status_code, 200)
+
+        queries = set(s for s in statements if s.strip().lower().startswith('select'))
+        self.assertTrue(queries)
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        for query in queries:
+            if ' where ' not in query.lower():
+                # Like loading the device uuids, unfiltered statements read everything anyway
+                continue
+            plan = explain_query_plan(cur, query)
+            self.assertEqual(get_full_scans(plan), [], '{}\n{}'.format(query, '\n'.join(plan)))
+        conn.close()
+
+
+class FullScanDetectionTestCases(unittest.TestCase):
+
+    def test_get_full_scans(self):
+        plan = [
+            'SCAN main_readings USING COVERING INDEX readings_device_type_date',
+            'CO-ROUTINE q1',
+            'SCAN (subquery-8)',
+            'SEARCH readings USING COVERING INDEX readings_device_type_date (device_uuid=?)',
+            'SCAN q1',
+            'SCAN readings',
+        ]
+        self.assertEqual(get_full_scans(plan), ['SCAN readings'])
@@ -0,0 +1,77 @@
+import itertools
+import struct
+import unittest
+
+from schemas import CreateDeviceReading, CreateFleetReading, get_range_error, load_reading, \
+    parse_readings_batch, parse_reading, msgpack, BINARY_MIMETYPE, BINARY_READING
+
+
+class LoadReadingTestCases(unittest.TestCase):
+
+    def test_fast_path_matches_marshmallow(self):
+        samples = {
+            'type': [None, 'temperature', 'humidity', 'pressure', 7, ''],
+            'value': [None, 0, 50, 100, 101, -1, 5000, '20', '150', 'abc', 2.5, 150.7, -5.5, True],
+            'date_created': [None, 1600000000, -5, '17', 'yesterday'],
+            'device_uuid': [None, 'device', 3],
+        }
+        missing = object()
+        for schema_class in (CreateDeviceReading, CreateFleetReading):
+            for values in itertools.product(*[[missing] + sample for sample in samples.values()]):
+                item = dict((name, value) for name, value in zip(samples, values) if value is not missing)
+
+                unmarshal_result = schema_class().load(item)
+                if unmarshal_result.errors:
+                    expected = (None, str(unmarshal_result.errors))
+                elif get_range_error(unmarshal_result.data):
+                    expected = (None, get_range_error(unmarshal_result.data))
+                else:
+                    expected = (unmarshal_result.data, None)
+                self.assertEqual(load_reading(item, schema_class), expected, item)
+
+    def test_range_after_conversion(self):
+        for value in ['150', 150.7, '-1', -5.5, '999']:
+            self.assertEqual(load_reading({'type': 'humidity', 'value': value}),
+                             (None, 'Invalid humidity field, should be between 0 - 100'), value)
+        self.assertEqual(load_reading({'type': 'humidity', 'value': '100'}), ({'type': 'humidity', 'value': 100}, None))
+        self.assertEqual(load_reading({'type': 'pressure', 'value': '1013'}), ({'type': 'pressure', 'value': 1013}, None))
+
+    def test_binary_readings(self):
+        body = BINARY_READING.pack(1600000000, 1, 20) + BINARY_READING.pack(0, 2, 101) + \
+            BINARY_READING.pack(5, 9, 1)
+        items = parse_readings_batch(body, BINARY_MIMETYPE)
+        self.assertEqual(items[:2], [
+            {'type': 'temperature', 'value': 20, 'date_created': 1600000000},
+            {'type': 'humidity', 'value': 101},
+        ])
+        self.assertEqual(str(items[2]), 'Invalid type code 9, should be one of 1, 2')
+        self.assertEqual(load_reading(items[1]), (None, 'Invalid humidity field, should be between 0 - 100'))
+        with self.assertRaises(ValueError):
+            parse_readings_batch(body[:-1], BINARY_MIMETYPE)
+        self.assertEqual(parse_reading(struct.pack('<qBi', 0, 1, 3), BINARY_MIMETYPE),
+                         {'type': 'temperature', 'value': 3})
+
+    def test_csv_readings(self):
+        body = b'device_uuid,type,value,date_created\n' \
+               b'a,temperature,20,1600000000\n' \
+               b'b,humidity, abc ,\n' \
+               b'\n' \
+               b'c,humidity\n'
+        items = parse_readings_batch(body, 'text/csv')
+        self.assertEqual(items[:2], [
+            {'device_uuid': 'a', 'type': 'temperature', 'value': 20, 'date_created': 1600000000},
+            {'device_uuid': 'b', 'type': 'humidity', 'value': 'abc'},
+        ])
+        self.assertEqual(str(items[2]), 'Expected 4 columns, got 2')
+        self.assertEqual(load_reading(items[1], CreateFleetReading),
+                         (None, "{'value': ['Not a valid integer.']}"))
+        with self.assertRaises(ValueError):
+            parse_readings_batch(b'a,b\n1,2\n', 'text/csv')
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_readings(self):
+        readings = [{'type': 'temperature', 'value': 20}, {'type': 'humidity', 'value': 30, 'date_created': 5}]
+        self.assertEqual(parse_readings_batch(msgpack.packb(readings), 'application/msgpack'), readings)
+        self.assertEqual(parse_reading(msgpack.packb(readings[1]), 'application/x-msgpack'), readings[1])
+        with self.assertRaises(ValueError):
+            parse_readings_batch(msgpack.packb(readings[0]), 'application/msgpack')
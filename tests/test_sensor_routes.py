@@ -7,6 +7,8 @@ import statistics
 import numpy as np
 
 from app import app
+from schemas import BINARY_MIMETYPE, BINARY_READING, msgpack
+from utils import reset_db, close_db_pools, encode_cursor
 
 
 def quartiles(dataPoints):
@@ -31,9 +33,9 @@ class SensorRoutesTestCases(unittest.TestCase):
 
     def setUp(self):
         # Setup the SQLite DB
+        app.config['TESTING'] = True
+        reset_db(app)
         conn = sqlite3.connect('test_database.db')
-        conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
         
         self.device_uuid = 'test_device'
         self.device_uuid2 = 'test_device2'
@@ -61,9 +63,16 @@ class SensorRoutesTestCases(unittest.TestCase):
         conn.commit()
 
         app.config['TESTING'] = True
+        # The readings span 20 hours, longer than the default query window
+        self.windows = app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW']
+        app.config['QUERY_DEFAULT_WINDOW'] = None
+        app.config['QUERY_MAX_WINDOW'] = None
 
         self.client = app.test_client
 
+    def tearDown(self):
+        app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW'] = self.windows
+
     def test_device_readings_get(self):
         # Given a device UUID
         # When we make a request with the given UUID
@@ -291,3 +300,265 @@ class SensorRoutesTestCases(unittest.TestCase):
             self.assertIn('quartile_3', row)
             self.assertIn('median', row)
             self.assertIn('mode', row)
+
+    def test_device_readings_batch_post(self):
+        readings = [
+            {'type': 'temperature', 'value': 30, 'date_created': 1000},
+            {'type': 'humidity', 'value': 40, 'date_created': 1001},
+        ]
+        request = self.client().post(
+            '/devices/{}/readings/batch/'.format(self.device_uuid),
+            data=json.dumps(readings),
+            content_type='application/json'
+        )
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(json.loads(request.data), {'inserted': 2, 'errors': []})
+
+        request = self.client().get('/devices/{}/readings/?end=1001'.format(self.device_uuid))
+        data = json.loads(request.data)
+        self.assertEqual(sorted(row['date_created'] for row in data), [1000, 1001])
+
+    def test_readings_batch_post_ndjson_partial(self):
+        body = '\n'.join([
+            json.dumps({'device_uuid': 'batch_a', 'type': 'temperature', 'value': 10}),
+            json.dumps({'device_uuid': 'batch_b', 'type': 'temperature', 'value': 101}),
+            '{not json',
+            json.dumps({'type': 'humidity', 'value': 10}),
+            json.dumps({'device_uuid': 'batch_b', 'type': 'humidity', 'value': 55}),
+        ])
+        request = self.client().post('/readings/batch/', data=body, content_type='application/x-ndjson')
+        self.assertEqual(request.status_code, 207)
+        data = json.loads(request.data)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual([error['index'] for error in data['errors']], [1, 2, 3])
+        self.assertEqual(data['errors'][0]['message'], 'Invalid temperature field, should be between 0 - 100')
+
+        request = self.client().get('/devices/batch_b/readings/')
+        self.assertEqual(len(json.loads(request.data)), 1)
+
+    def test_out_of_range_values_after_conversion(self):
+        path = '/devices/{}/readings/'.format(self.device_uuid)
+        for reading in [{'type': 'temperature', 'value': '150'}, {'type': 'temperature', 'value': 150.7},
+                        {'type': 'humidity', 'value': -5.5}]:
+            request = self.client().post(path, data=json.dumps(reading), content_type='application/json')
+            self.assertEqual(request.status_code, 400, reading)
+
+        request = self.client().post(path + 'batch/', data=json.dumps([
+            {'type': 'humidity', 'value': '999'},
+            {'type': 'humidity', 'value': '99'},
+        ]), content_type='application/json')
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual(json.loads(request.data)['errors'], [
+            {'index': 0, 'message': 'Invalid humidity field, should be between 0 - 100'}
+        ])
+
+        request = self.client().get(path + '?type=humidity')
+        self.assertEqual([row['value'] for row in json.loads(request.data)], [99])
+
+    def test_readings_batch_post_all_invalid(self):
+        request = self.client().post('/readings/batch/', data=json.dumps([{'value': 1}]),
+                                     content_type='application/json')
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(json.loads(request.data)['inserted'], 0)
+
+        request = self.client().post('/readings/batch/', data='{"a": 1}', content_type='application/json')
+        self.assertEqual(request.status_code, 400)
+
+    def test_readings_summary_sorted_and_paginated(self):
+        request = self.client().get('/readings/summary/')
+        data = json.loads(request.data)
+        self.assertEqual([row['device_uuid'] for row in data], [self.device_uuid, self.device_uuid2, 'other_uuid'])
+        self.assertEqual([row['number_of_readings'] for row in data], [4, 2, 1])
+        self.assertEqual(data[0]['median'], 36)
+        self.assertEqual(data[0]['quartile_1'], 22)
+        self.assertEqual(data[0]['quartile_3'], 50)
+        self.assertEqual(data[2]['quartile_3'], None)
+
+        request = self.client().get('/readings/summary/?limit=2')
+        self.assertEqual([row['device_uuid'] for row in json.loads(request.data)], [self.device_uuid, self.device_uuid2])
+        cursor = request.headers['X-Next-Cursor']
+
+        request = self.client().get('/readings/summary/?limit=2&cursor={}'.format(cursor))
+        self.assertEqual([row['device_uuid'] for row in json.loads(request.data)], ['other_uuid'])
+        self.assertNotIn('X-Next-Cursor', request.headers)
+
+        request = self.client().get('/readings/summary/?type=humidity')
+        self.assertEqual([row['device_uuid'] for row in json.loads(request.data)], [self.device_uuid2])
+
+        request = self.client().get('/readings/summary/?cursor=garbage')
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_get_pages(self):
+        seen = []
+        cursor = None
+        while True:
+            url = '/devices/{}/readings/?limit=3'.format(self.device_uuid)
+            if cursor:
+                url += '&cursor={}'.format(cursor)
+            request = self.client().get(url)
+            self.assertEqual(request.status_code, 200)
+            data = json.loads(request.data)
+            self.assertTrue(len(data) <= 3)
+            seen.extend(data)
+            cursor = request.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+        self.assertEqual(seen, json.loads(request.data))
+        self.assertEqual(len(seen), 4)
+        dates = [row['date_created'] for row in seen]
+        self.assertEqual(dates, sorted(dates))
+
+        request = self.client().get('/devices/{}/readings/?cursor=abc'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 400)
+
+    def test_invalid_cursors(self):
+        for values in [['a', 'b'], [1], [1, 'a', 2], ['1', 'a'], [1.5, 'a'], [True, 'a'], [1, 2], {'a': 1}]:
+            request = self.client().get('/readings/summary/?cursor={}'.format(encode_cursor(values)))
+            self.assertEqual(request.status_code, 400)
+        for values in [['a', 'b'], [1], [1, 2, 3], ['1', '2'], [1.5, 2], [1, None], [2 ** 63, 1], {'a': 1}]:
+            request = self.client().get('/devices/{}/readings/?cursor={}'.format(
+                self.device_uuid, encode_cursor(values)))
+            self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_get_streams_hold_no_connection(self):
+        chunk_size = app.config['READINGS_CHUNK_SIZE']
+        app.config['READINGS_CHUNK_SIZE'] = 1
+        app.config['DB_READ_POOL_SIZE'] = 2
+        app.config['DB_ACQUIRE_TIMEOUT'] = 0.5
+        close_db_pools()
+        try:
+            # More clients than connections stall after their first reading
+            responses = [self.client().get('/devices/{}/readings/?format=ndjson'.format(self.device_uuid),
+                                           buffered=False) for i in range(4)]
+            bodies = [iter(response.response) for response in responses]
+            for body in bodies:
+                self.assertEqual(len(next(body).splitlines()), 1)
+
+            request = self.client().get('/devices/{}/readings/stats/'.format(self.device_uuid))
+            self.assertEqual(request.status_code, 200)
+
+            for body in bodies:
+                self.assertEqual(len(b''.join(body).splitlines()), 3)
+            for response in responses:
+                response.close()
+        finally:
+            app.config['READINGS_CHUNK_SIZE'] = chunk_size
+            app.config.pop('DB_READ_POOL_SIZE', None)
+            app.config.pop('DB_ACQUIRE_TIMEOUT', None)
+            close_db_pools()
+
+    def test_device_readings_get_ndjson(self):
+        request = self.client().get('/devices/{}/readings/?format=ndjson'.format(self.device_uuid2))
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in request.data.decode('utf-8').splitlines()]
+        self.assertEqual(sorted(row['type'] for row in rows), ['humidity', 'temperature'])
+        self.assertEqual(rows[0]['device_uuid'], self.device_uuid2)
+
+        request = self.client().get('/devices/unknown/readings/')
+        self.assertEqual(json.loads(request.data), [])
+
+    def test_device_readings_stats(self):
+        request = self.client().get('/devices/{}/readings/stats/'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 200)
+        data = json.loads(request.data)
+        self.assertEqual(data, {
+            'number_of_readings': 4,
+            'min': 22,
+            'max': 100,
+            'mean': 48.5,
+            'median': 36,
+            'mode': 22,
+            'quartile_1': 22,
+            'quartile_3': 50,
+        })
+        for metric in ['min', 'max', 'mean', 'median', 'mode']:
+            request = self.client().get('/devices/{}/readings/{}/'.format(self.device_uuid, metric))
+            self.assertEqual(json.loads(request.data)['value'], data[metric])
+
+        request = self.client().get('/devices/{}/readings/stats/?metrics=max,quartiles&type=humidity'.format(
+            self.device_uuid2))
+        self.assertEqual(json.loads(request.data), {'max': 22, 'quartile_1': 22, 'quartile_3': None})
+
+        request = self.client().get('/devices/{}/readings/stats/?metrics=max,p99'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_series(self):
+        request = self.client().get('/devices/{}/readings/series/?interval=1d'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 200)
+        data = json.loads(request.data)
+        self.assertEqual(sum(point['number_of_readings'] for point in data), 4)
+        self.assertEqual(min(point['min'] for point in data), 22)
+        self.assertEqual(max(point['max'] for point in data), 100)
+        self.assertTrue(all(point['start'] % 86400 == 0 for point in data))
+
+        request = self.client().get('/devices/{}/readings/series/?interval=1h&start={}'.format(
+            self.device_uuid, int(time.time()) - 200))
+        data = json.loads(request.data)
+        self.assertEqual(sum(point['number_of_readings'] for point in data), 3)
+        self.assertEqual(sum(point['mean'] * point['number_of_readings'] for point in data), 172)
+
+        request = self.client().get('/devices/unknown/readings/series/')
+        self.assertEqual(json.loads(request.data), [])
+
+        request = self.client().get('/devices/{}/readings/series/?interval=10s'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 400)
+        request = self.client().get('/devices/{}/readings/series/?interval=1m&start=1&end={}'.format(
+            self.device_uuid, int(time.time())))
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_post_compact_formats(self):
+        body = BINARY_READING.pack(int(time.time()), 2, 40) + BINARY_READING.pack(0, 1, 101)
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid2), data=body,
+                                     content_type=BINARY_MIMETYPE)
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual(json.loads(request.data)['errors'], [
+            {'index': 1, 'message': 'Invalid temperature field, should be between 0 - 100'}
+        ])
+
+        body = 'device_uuid,type,value\n{},humidity,41\n{},humidity,42\n'.format(self.device_uuid2, self.device_uuid2)
+        request = self.client().post('/readings/batch/', data=body, content_type='text/csv')
+        self.assertEqual(request.status_code, 201)
+
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid2), data='type,value\nhumidity,43\n',
+                                     content_type='text/csv')
+        self.assertEqual(request.status_code, 201)
+
+        request = self.client().get('/devices/{}/readings/?type=humidity'.format(self.device_uuid2))
+        self.assertEqual(sorted(row['value'] for row in json.loads(request.data)), [22, 40, 41, 42, 43])
+
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid2), data=b'\x01\x02',
+                                     content_type=BINARY_MIMETYPE)
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_post_compact_formats_out_of_range(self):
+        path = '/devices/{}/readings/'.format(self.device_uuid2)
+        request = self.client().post(path, data='type,value\nhumidity,+500\n', content_type='text/csv')
+        self.assertEqual(request.status_code, 400)
+        request = self.client().post(path, data=BINARY_READING.pack(0, 2, -5), content_type=BINARY_MIMETYPE)
+        self.assertEqual(request.status_code, 400)
+
+        body = 'device_uuid,type,value\n{0},humidity,+500\n{0},humidity,-5.5\n{0},humidity,+44\n'.format(
+            self.device_uuid2)
+        request = self.client().post('/readings/batch/', data=body, content_type='text/csv')
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual([error['index'] for error in json.loads(request.data)['errors']], [0, 1])
+
+        body = BINARY_READING.pack(0, 1, 150) + BINARY_READING.pack(0, 2, -1) + BINARY_READING.pack(0, 2, 45)
+        request = self.client().post(path + 'batch/', data=body, content_type=BINARY_MIMETYPE)
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual(json.loads(request.data)['inserted'], 1)
+
+        if msgpack is not None:
+            request = self.client().post(path, data=msgpack.packb({'type': 'temperature', 'value': 150.5}),
+                                         content_type='application/msgpack')
+            self.assertEqual(request.status_code, 400)
+            request = self.client().post(path + 'batch/', data=msgpack.packb([
+                {'type': 'humidity', 'value': -5.5}, {'type': 'humidity', 'value': '999'}]),
+                content_type='application/msgpack')
+            self.assertEqual(request.status_code, 400)
+
+        request = self.client().get(path + '?type=humidity')
+        self.assertEqual(sorted(row['value'] for row in json.loads(request.data)), [22, 44, 45])
@@ -0,0 +1,61 @@
+import random
+import sqlite3
+import unittest
+
+from series import parse_interval, get_series, get_series_rows
+from utils import migrate_db
+
+
+class SeriesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        migrate_db(self.conn)
+        self.random = random.Random(11)
+        self.readings = []
+        for i in range(800):
+            sensor_type = self.random.choice(['temperature', 'humidity'])
+            value = self.random.randint(0, 100)
+            date_created = self.random.randint(-100000, 300000)
+            self.readings.append(('a', sensor_type, value, date_created))
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              self.readings)
+        self.cur = self.conn.cursor()
+
+    def get_expected(self, sensor_type, start, end, interval):
+        points = {}
+        for _device_uuid, _type, value, date_created in self.readings:
+            if (sensor_type is None or _type == sensor_type) and (start is None or date_created >= start) \
+                    and (end is None or date_created <= end):
+                points.setdefault(date_created // interval * interval, []).append(value)
+        return [
+            dict(start=point_start, number_of_readings=len(values), min=min(values), max=max(values),
+                 mean=float(sum(values)) / len(values))
+            for point_start, values in sorted(points.items())
+        ]
+
+    def test_series_matches_readings(self):
+        device_id = self.conn.execute('select id from devices where uuid = ?', ('a',)).fetchone()[0]
+        type_ids = dict(self.conn.execute('select name, id from sensor_types').fetchall())
+        for i in range(100):
+            start = self.random.choice([None, self.random.randint(-110000, 310000)])
+            end = self.random.choice([None, self.random.randint(-110000, 310000)])
+            sensor_type = self.random.choice([None, 'temperature', 'humidity'])
+            interval = self.random.choice([60, 300, 3600, 7200, 86400, 172800])
+            filters = dict(device_id=device_id, type_id=type_ids.get(sensor_type), start=start, end=end)
+
+            series = get_series(get_series_rows(self.cur, filters, interval), interval)
+            expected = self.get_expected(sensor_type, start, end, interval)
+            self.assertEqual(len(series), len(expected), (filters, interval))
+            for point, expected_point in zip(series, expected):
+                self.assertAlmostEqual(point.pop('mean'), expected_point.pop('mean'))
+                self.assertEqual(point, expected_point)
+
+    def test_parse_interval(self):
+        self.assertEqual(parse_interval('1h'), 3600)
+        self.assertEqual(parse_interval('5m'), 300)
+        self.assertEqual(parse_interval('120s'), 120)
+        self.assertEqual(parse_interval('7d'), 604800)
+        for interval in ['', 'h', '1w', '90s', '0m', '-1h']:
+            with self.assertRaises(ValueError):
+                parse_interval(interval)
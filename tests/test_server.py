@@ -0,0 +1,127 @@
+import asyncio
+import json
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from app import app
+from ingest import BufferFull
+from server import ReadingCoalescer, make_app
+from tests.test_partitions import FIRST_DAY, make_readings, post_readings
+from utils import reset_db
+
+
+class ReadingCoalescerTestCases(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.written = []
+
+    def write(self, readings):
+        self.written.append(list(readings))
+
+    async def test_concurrent_readings_share_batches(self):
+        coalescer = ReadingCoalescer(self.write, None, batch_size=10, flush_interval=0.01)
+        await asyncio.gather(*[coalescer.put(i) for i in range(25)])
+        self.assertEqual(sum(self.written, []), list(range(25)))
+        self.assertEqual([len(batch) for batch in self.written], [10, 10, 5])
+        self.assertEqual(coalescer.batches, 3)
+
+    async def test_write_errors_reach_every_reading(self):
+        def write(readings):
+            raise RuntimeError('disk full')
+
+        errors = []
+        coalescer = ReadingCoalescer(write, None, on_error=lambda error, count: errors.append(count))
+        futures = [coalescer.put(i) for i in range(3)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                await future
+        self.assertEqual(errors, [3])
+
+    async def test_full(self):
+        coalescer = ReadingCoalescer(self.write, None, max_size=2)
+        coalescer.put(1, wait=False)
+        coalescer.put(2, wait=False)
+        with self.assertRaises(BufferFull):
+            coalescer.put(3)
+        await coalescer.drain()
+        self.assertEqual(self.written, [[1, 2]])
+
+
+class ServerTestCases(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app.config['TESTING'] = True
+        self.windows = app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW']
+        app.config['QUERY_DEFAULT_WINDOW'] = None
+        app.config['QUERY_MAX_WINDOW'] = None
+        reset_db(app)
+        self.server = TestClient(TestServer(make_app()))
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        app.config['QUERY_DEFAULT_WINDOW'], app.config['QUERY_MAX_WINDOW'] = self.windows
+
+    async def test_posts_are_coalesced(self):
+        responses = await asyncio.gather(*[
+            self.server.post('/devices/async/readings/', json={'type': 'temperature', 'value': i, 'date_created': 100 + i})
+            for i in range(50)
+        ])
+        self.assertEqual([response.status for response in responses], [201] * 50)
+        self.assertEqual(set([await response.text() for response in responses]), set(['success']))
+        self.assertLess(self.server.app['coalescer'].batches, 50)
+
+        response = await self.server.get('/devices/async/readings/?start=1&end=1000')
+        readings = json.loads(await response.text())
+        self.assertEqual([reading['value'] for reading in readings], list(range(50)))
+
+    async def test_post_times_out(self):
+        self.server.app['coalescer'].flush_interval = 10
+        app.config['INGEST_WAIT_TIMEOUT'] = 0.05
+        try:
+            response = await self.server.post('/devices/async/readings/', json={'type': 'temperature', 'value': 1})
+        finally:
+            app.config['INGEST_WAIT_TIMEOUT'] = 10
+        self.assertEqual(response.status, 503)
+        await self.server.app['coalescer'].drain()
+        response = await self.server.get('/devices/async/readings/?start=1')
+        self.assertEqual(len(json.loads(await response.text())), 1)
+
+    async def test_same_responses_as_flask(self):
+        self.client = app.test_client
+        post_readings(self, make_readings(['a', 'b']))
+        paths = [
+            '/readings/summary/?limit=1',
+            '/devices/a/readings/?limit=5',
+            '/devices/a/readings/?format=ndjson',
+            '/devices/a/readings/stats/?type=humidity',
+            '/devices/b/readings/series/?interval=1d&start={}'.format(FIRST_DAY),
+            '/devices/b/readings/quartiles/',
+            '/devices/b/readings/mode/',
+            '/devices/b/readings/unknown/',
+            '/devices/b/readings/stats/?metrics=unknown',
+            '/devices/b/readings/?limit=0',
+            '/unknown/',
+        ]
+        for path in paths:
+            expected = app.test_client().get(path)
+            response = await self.server.get(path, allow_redirects=False)
+            self.assertEqual(response.status, expected.status_code, path)
+            self.assertEqual(await response.read(), expected.data, path)
+            for header in ('Content-Type', 'X-Next-Cursor'):
+                self.assertEqual(response.headers.get(header), expected.headers.get(header), path)
+
+    async def test_invalid_posts_get_flask_errors(self):
+        for body in ('{"type": "temperature", "value": 101}', '{"type": "temperature"', '[]'):
+            expected = app.test_client().post('/devices/a/readings/', data=body, content_type='application/json')
+            response = await self.server.post('/devices/a/readings/', data=body,
+                                              headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.status, expected.status_code, body)
+            self.assertEqual(await response.read(), expected.data, body)
+
+    async def test_batches(self):
+        readings = make_readings(['a'], 20)
+        response = await self.server.post('/readings/batch/', json=readings)
+        self.assertEqual(response.status, 201)
+        self.assertEqual(json.loads(await response.text()), dict(inserted=20, errors=[]))
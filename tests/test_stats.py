@@ -0,0 +1,89 @@
+import random
+import sqlite3
+import statistics
+import unittest
+
+from stats import get_histogram, get_device_histograms, summarize
+from utils import migrate_db
+
+
+class StatsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        migrate_db(self.conn)
+        self.random = random.Random(4)
+        self.readings = []
+        for i in range(600):
+            device_uuid = self.random.choice(['a', 'b'])
+            sensor_type = self.random.choice(['temperature', 'humidity'])
+            value = self.random.randint(0, 100)
+            date_created = self.random.randint(-5000, 40000)
+            self.readings.append((device_uuid, sensor_type, value, date_created))
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              self.readings)
+        self.cur = self.conn.cursor()
+
+    def get_values(self, device_uuid, sensor_type, start, end):
+        return sorted(
+            value for _device_uuid, _type, value, date_created in self.readings
+            if _device_uuid == device_uuid and (sensor_type is None or _type == sensor_type)
+            and (start is None or date_created >= start) and (end is None or date_created <= end)
+        )
+
+    def test_histogram_matches_readings(self):
+        ids = dict(self.conn.execute('select uuid, id from devices').fetchall())
+        type_ids = dict(self.conn.execute('select name, id from sensor_types').fetchall())
+        for i in range(200):
+            start = self.random.choice([None, self.random.randint(-6000, 41000)])
+            end = self.random.choice([None, self.random.randint(-6000, 41000)])
+            sensor_type = self.random.choice([None, 'temperature', 'humidity'])
+            filters = dict(device_id=ids['a'], type_id=type_ids.get(sensor_type), start=start, end=end)
+
+            values = self.get_values('a', sensor_type, start, end)
+            histogram = get_histogram(self.cur, filters)
+            expanded = sum([[value] * count for value, count in histogram], [])
+            self.assertEqual(expanded, values, filters)
+
+    def test_device_histograms_match_histogram(self):
+        ids = dict(self.conn.execute('select uuid, id from devices').fetchall())
+        type_ids = dict(self.conn.execute('select name, id from sensor_types').fetchall())
+        for i in range(50):
+            start = self.random.choice([None, self.random.randint(-6000, 41000)])
+            end = self.random.choice([None, self.random.randint(-6000, 41000)])
+            type_id = type_ids.get(self.random.choice([None, 'temperature', 'humidity']))
+            filters = dict(device_id=None, type_id=type_id, start=start, end=end)
+
+            expected = []
+            for device_uuid in sorted(ids, key=ids.get):
+                histogram = get_histogram(self.cur, dict(filters, device_id=ids[device_uuid]))
+                if histogram:
+                    expected.append((ids[device_uuid], histogram))
+            self.assertEqual(list(get_device_histograms(self.conn, filters)), expected)
+
+    def test_summarize_matches_sql(self):
+        for size in list(range(0, 9)) + [51, 100]:
+            values = [self.random.randint(0, 100) for i in range(size)]
+            histogram = sorted((value, values.count(value)) for value in set(values))
+            data = summarize(histogram, ['min', 'max', 'mean', 'median', 'mode', 'quartile_1', 'quartile_3'])
+
+            conn = sqlite3.connect(':memory:')
+            conn.execute('create table t (value INTEGER)')
+            conn.executemany('insert into t values (?)', [(value,) for value in values])
+            quartiles = {}
+            for value, quartile in conn.execute('select value, ntile(4) over (order by value) from t'):
+                if quartile in (1, 3):
+                    quartiles['quartile_{}'.format(quartile)] = value
+            conn.close()
+
+            self.assertEqual(data.get('quartile_1'), quartiles.get('quartile_1'))
+            self.assertEqual(data.get('quartile_3'), quartiles.get('quartile_3'))
+            if not values:
+                self.assertEqual(data['median'], None)
+                self.assertEqual(data['mean'], None)
+                continue
+            self.assertEqual(data['min'], min(values))
+            self.assertEqual(data['max'], max(values))
+            self.assertAlmostEqual(data['mean'], statistics.mean(values))
+            self.assertEqual(data['median'], statistics.median(values))
+            self.assertIn(data['mode'], statistics.multimode(values))
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import time
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from app import app, reading_hub
+from server import make_app
+from stream import ReadingHub, HEARTBEAT
+from utils import reset_db
+
+
+def parse_events(data):
+    """
+    Returns the (event, data) pairs of a Server-Sent Events body, without
+    heartbeats and id-only events.
+    """
+    events = []
+    for block in data.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if line and not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+class ReadingHubTestCases(unittest.TestCase):
+
+    def test_routing(self):
+        hub = ReadingHub()
+        device = hub.subscribe(['a'])
+        humidity = hub.subscribe(sensor_type='humidity')
+        hub.publish([('a', 'temperature', 1, 100), ('b', 'humidity', 2, 100), ('a', 'humidity', 3, 100)])
+        self.assertEqual(device.get(0), ([('a', 'temperature', 1, 100), ('a', 'humidity', 3, 100)], 0))
+        self.assertEqual(humidity.get(0), ([('b', 'humidity', 2, 100), ('a', 'humidity', 3, 100)], 0))
+
+        device.close()
+        humidity.close()
+        self.assertEqual((hub.device_subscriptions, hub.fleet_subscriptions), ({}, set()))
+
+    def test_slow_subscribers_drop_oldest(self):
+        hub = ReadingHub()
+        subscription = hub.subscribe(max_size=3)
+        for value in range(5):
+            hub.publish([('a', 'temperature', value, 100)])
+        readings, dropped = subscription.get(0)
+        self.assertEqual([reading[2] for reading in readings], [2, 3, 4])
+        self.assertEqual(dropped, 2)
+        self.assertEqual(subscription.get(0), ([], 0))
+
+
+class StreamRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['STREAM_HEARTBEAT'] = 0.01
+        reset_db(app)
+        self.client = app.test_client
+        self.now = int(time.time())
+        self.post_reading('a', 10, self.now - 200)
+        self.post_reading('a', 20, self.now - 100)
+
+    def tearDown(self):
+        app.config['STREAM_HEARTBEAT'] = 15
+
+    def post_reading(self, device_uuid, value, date_created):
+        request = self.client().post('/devices/{}/readings/'.format(device_uuid), data=json.dumps({
+            'type': 'temperature',
+            'value': value,
+            'date_created': date_created
+        }), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+
+    def read(self, response):
+        """
+        Returns the events sent until the stream is idle.
+        """
+        data = ''
+        for chunk in response.response:
+            chunk = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+            if chunk == HEARTBEAT:
+                break
+            data += chunk
+        return data
+
+    def test_live_readings(self):
+        response = self.client().get('/devices/a/readings/stream/', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(self.read(response), '')
+        self.post_reading('b', 30, self.now)
+        self.post_reading('a', 40, self.now)
+        data = self.read(response)
+        self.assertEqual(parse_events(data), [
+            ('reading', dict(device_uuid='a', type='temperature', value=40, date_created=self.now))
+        ])
+        self.assertIn('id: {}\n'.format(self.now), data)
+        response.close()
+        self.assertEqual((reading_hub.device_subscriptions, reading_hub.fleet_subscriptions), ({}, set()))
+
+    def test_resume(self):
+        since = self.now - 150
+        response = self.client().get('/readings/stream/?devices=a,b&since={}'.format(since), buffered=False)
+        data = self.read(response)
+        self.assertEqual(parse_events(data), [
+            ('reading', dict(device_uuid='a', type='temperature', value=20, date_created=self.now - 100))
+        ])
+        # The stored readings carry no id, the client resumes from when they were read
+        self.assertNotIn('id: {}\n'.format(self.now - 100), data)
+        self.assertRegex(data, r'\nid: \d+\n\n$')
+        response.close()
+
+        response = self.client().get('/devices/a/readings/stream/?since=1', headers={'Last-Event-ID': str(since)},
+                                     buffered=False)
+        self.assertEqual([event[1]['value'] for event in parse_events(self.read(response))], [20])
+        response.close()
+
+    def test_fleet_filters(self):
+        response = self.client().get('/readings/stream/?type=humidity', buffered=False)
+        self.read(response)
+        self.post_reading('b', 30, self.now)
+        request = self.client().post('/readings/batch/', data=json.dumps([
+            dict(device_uuid='c', type='humidity', value=50, date_created=self.now)
+        ]), content_type='application/json')
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual([event[1]['device_uuid'] for event in parse_events(self.read(response))], ['c'])
+        response.close()
+
+    def test_invalid_since(self):
+        request = self.client().get('/devices/a/readings/stream/?since=yesterday')
+        self.assertEqual(request.status_code, 400)
+
+
+class ServerStreamTestCases(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app.config['TESTING'] = True
+        reset_db(app)
+        self.server = TestClient(TestServer(make_app()))
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def test_live_readings(self):
+        response = await self.server.get('/devices/a/readings/stream/?since={}'.format(int(time.time()) - 60))
+        self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+        self.assertRegex((await response.content.readuntil(b'\n\n')).decode('utf-8'), r'^id: \d+\n\n$')
+
+        request = await self.server.post('/devices/a/readings/', json={'type': 'humidity', 'value': 5})
+        self.assertEqual(request.status, 201)
+        event = (await asyncio.wait_for(response.content.readuntil(b'\n\n'), 5)).decode('utf-8')
+        self.assertEqual(parse_events(event)[0][1]['value'], 5)
+        response.close()
+
+    async def test_invalid_since(self):
+        response = await self.server.get('/readings/stream/?since=yesterday')
+        self.assertEqual(response.status, 400)
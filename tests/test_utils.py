@@ -0,0 +1,103 @@
+import sqlite3
+import unittest
+from contextlib import ExitStack
+
+from app import app
+from utils import init_db, get_db_cursor, get_pool, close_db_pools, get_window, PoolTimeout
+
+
+class ConnectionPoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        close_db_pools()
+        init_db(app)
+
+    def tearDown(self):
+        app.config.pop('DB_READ_POOL_SIZE', None)
+        app.config.pop('DB_ACQUIRE_TIMEOUT', None)
+        close_db_pools()
+
+    def test_connections_are_reused(self):
+        with get_db_cursor(app, readonly=True) as (cur, conn):
+            first = conn
+        with get_db_cursor(app, readonly=True) as (cur, conn):
+            self.assertIs(conn, first)
+
+    def test_read_and_write_connections_are_separate(self):
+        with get_db_cursor(app) as (cur, write_conn):
+            journal_mode = cur.execute('PRAGMA journal_mode').fetchone()[0]
+            with get_db_cursor(app, readonly=True) as (cur, read_conn):
+                self.assertIsNot(read_conn, write_conn)
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_read_connections_are_query_only(self):
+        with get_db_cursor(app, readonly=True) as (cur, conn):
+            with self.assertRaises(sqlite3.OperationalError):
+                cur.execute('CREATE TABLE IF NOT EXISTS pool_test (id INTEGER)')
+
+    def test_uncommitted_writes_are_rolled_back(self):
+        with get_db_cursor(app) as (cur, conn):
+            cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                        ('pool_device', 'temperature', 1, 1))
+        with get_db_cursor(app, readonly=True) as (cur, conn):
+            cur.execute('select count(*) from readings where device_uuid = ?', ('pool_device',))
+            self.assertEqual(cur.fetchone()[0], 0)
+
+    def test_acquire_times_out(self):
+        app.config['DB_READ_POOL_SIZE'] = 2
+        app.config['DB_ACQUIRE_TIMEOUT'] = 0.05
+        close_db_pools()
+        with ExitStack() as stack:
+            for i in range(2):
+                stack.enter_context(get_db_cursor(app, readonly=True))
+            with self.assertRaises(PoolTimeout):
+                with get_db_cursor(app, readonly=True):
+                    pass
+            request = app.test_client().get('/devices/a/readings/stats/')
+            self.assertEqual(request.status_code, 503)
+        with get_db_cursor(app, readonly=True) as (cur, conn):
+            self.assertEqual(cur.execute('select 1').fetchone()[0], 1)
+
+    def test_closed_pool_still_lends_connections(self):
+        app.config['DB_READ_POOL_SIZE'] = 1
+        app.config['DB_ACQUIRE_TIMEOUT'] = 0.05
+        close_db_pools()
+        pool = get_pool(app, readonly=True)
+        pool.release(pool.acquire())
+        pool.close()
+        conn = pool.acquire()
+        pool.close()
+        pool.release(conn)
+        conn = pool.acquire()
+        self.assertEqual(conn.execute('select 1').fetchone()[0], 1)
+        pool.release(conn)
+        self.assertEqual(pool.created, 0)
+
+
+class QueryWindowTestCases(unittest.TestCase):
+
+    def setUp(self):
+        app.config['QUERY_DEFAULT_WINDOW'] = 3600
+        app.config['QUERY_MAX_WINDOW'] = 86400
+
+    def tearDown(self):
+        app.config['QUERY_DEFAULT_WINDOW'] = 3600
+        app.config['QUERY_MAX_WINDOW'] = 183 * 86400
+
+    def test_default_window(self):
+        self.assertEqual(get_window(app, now=10000), (6400, 10000))
+        self.assertEqual(get_window(app, end=5000, now=10000), (1400, 5000))
+        self.assertEqual(get_window(app, start=9000, now=10000), (9000, 10000))
+        self.assertEqual(get_window(app, 100, 200, now=10000), (100, 200))
+
+    def test_max_window(self):
+        with self.assertRaises(ValueError):
+            get_window(app, 0, 86401)
+        with self.assertRaises(ValueError):
+            get_window(app, start=0, now=100000)
+        app.config['QUERY_DEFAULT_WINDOW'] = None
+        with self.assertRaises(ValueError):
+            get_window(app, end=100)
+        app.config['QUERY_MAX_WINDOW'] = None
+        self.assertEqual(get_window(app), (None, None))
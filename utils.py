@@ -1,43 +1,638 @@
+import base64
+import json
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from queue import LifoQueue, Empty
+
+from metrics import InstrumentedConnection, PROGRESS_STEPS
+
+
+DEFAULT_DB_SETTINGS = {
+    'DB_JOURNAL_MODE': 'wal',
+    'DB_SYNCHRONOUS': 'normal',
+    # Negative values are KiB rather than pages
+    'DB_CACHE_SIZE': -64000,
+    'DB_MMAP_SIZE': 256 * 1024 * 1024,
+    'DB_BUSY_TIMEOUT': 5.0,
+    # Seconds a request waits for a pooled connection before PoolTimeout
+    'DB_ACQUIRE_TIMEOUT': 5.0,
+    'DB_READ_POOL_SIZE': 8,
+    # Prepared statements kept per connection, queries.py only emits a few shapes
+    'DB_CACHED_STATEMENTS': 256,
+    # None keeps every reading in one file, 'day' or 'month' in a file per period
+    'DB_PARTITION': None,
+    # Seconds of partitions kept, None keeps them forever
+    'DB_PARTITION_RETENTION': None,
+    # Database files readings are spread over by a hash of their device
+    'DB_SHARDS': 1,
+    # Threads reading or writing several database files at once
+    'DB_FANOUT_THREADS': 8,
+    # Pools kept open, the least recently used one is closed past it
+    'DB_MAX_POOLS': 64,
+}
+
+# Pools by (db_name, readonly), least recently used first
+pools = OrderedDict()
+pools_lock = threading.Lock()
+# Database files already brought up to the latest schema by this process
+migrated = set()
 
 
 def get_db_name(app):
+    if app.config.get('DB_NAME'):
+        return app.config['DB_NAME']
     return 'database.db' if not app.config['TESTING'] else 'test_database.db'
 
 
-def init_db(app):
+def get_db_setting(app, name):
+    return app.config.get(name, DEFAULT_DB_SETTINGS[name])
+
+
+# Width of the time buckets of reading_histograms, changing it needs a
+# migration rebuilding the table
+HISTOGRAM_BUCKET_SECONDS = 3600
+# Widths of the reading_rollups_<seconds> tables, finest first. Changing
+# them needs a migration too
+ROLLUP_RESOLUTIONS = [60, 3600, 86400]
+# Bucket of a date, a floor division which SQLite's integer division only
+# is for positive dates
+BUCKET_SQL = '(CASE WHEN {0} >= 0 THEN {0} / {1} ELSE ({0} - {1} + 1) / {1} END)'
+
+# Every entry upgrades the schema by one version, PRAGMA user_version
+# records how many of them a database file already went through.
+MIGRATIONS = [
+    [
+        'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)',
+    ],
+    [
+        # Per device queries, with or without a type and date range
+        'CREATE INDEX IF NOT EXISTS readings_device_type_date ON readings (device_uuid, type, date_created, value)',
+        # Fleet wide queries over a date range
+        'CREATE INDEX IF NOT EXISTS readings_date_device ON readings (date_created, device_uuid, type, value)',
+    ],
+    [
+        # Store device uuids and sensor types once and readings as integers
+        'CREATE TABLE devices (id INTEGER PRIMARY KEY, uuid TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE sensor_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE readings_data (device_id INTEGER NOT NULL, type_id INTEGER NOT NULL, value INTEGER, date_created INTEGER)',
+        'INSERT INTO devices (uuid) SELECT DISTINCT device_uuid FROM readings WHERE device_uuid IS NOT NULL',
+        'INSERT INTO sensor_types (name) SELECT DISTINCT type FROM readings WHERE type IS NOT NULL',
+        '''INSERT INTO readings_data (device_id, type_id, value, date_created)
+            SELECT d.id, t.id, r.value, r.date_created FROM readings r
+            JOIN devices d ON d.uuid = r.device_uuid
+            JOIN sensor_types t ON t.name = r.type
+            ORDER BY d.id, t.id, r.date_created''',
+        'DROP TABLE readings',
+        'CREATE INDEX readings_device_type_date ON readings_data (device_id, type_id, date_created, value)',
+        'CREATE INDEX readings_date_device ON readings_data (date_created, device_id, type_id, value)',
+        # Keeps the original readings layout available for ad-hoc queries and inserts
+        '''CREATE VIEW readings AS
+            SELECT d.uuid AS device_uuid, t.name AS type, r.value AS value, r.date_created AS date_created
+            FROM readings_data r
+            JOIN devices d ON d.id = r.device_id
+            JOIN sensor_types t ON t.id = r.type_id''',
+        '''CREATE TRIGGER readings_insert INSTEAD OF INSERT ON readings
+        BEGIN
+            INSERT OR IGNORE INTO devices (uuid) VALUES (NEW.device_uuid);
+            INSERT OR IGNORE INTO sensor_types (name) VALUES (NEW.type);
+            INSERT INTO readings_data (device_id, type_id, value, date_created) VALUES (
+                (SELECT id FROM devices WHERE uuid = NEW.device_uuid),
+                (SELECT id FROM sensor_types WHERE name = NEW.type),
+                NEW.value,
+                NEW.date_created
+            );
+        END''',
+    ],
+    [
+        # Value counts per device, type and hour, the state stats.py computes metrics from
+        '''CREATE TABLE reading_histograms (
+            device_id INTEGER NOT NULL,
+            type_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (device_id, type_id, bucket, value)
+        ) WITHOUT ROWID''',
+        '''INSERT INTO reading_histograms (device_id, type_id, bucket, value, count)
+            SELECT device_id, type_id, {bucket}, value, count(*) FROM readings_data
+            WHERE value IS NOT NULL AND date_created IS NOT NULL
+            GROUP BY 1, 2, 3, 4'''.format(bucket=BUCKET_SQL.format('date_created', HISTOGRAM_BUCKET_SECONDS)),
+        '''CREATE TRIGGER readings_histogram AFTER INSERT ON readings_data
+        WHEN NEW.value IS NOT NULL AND NEW.date_created IS NOT NULL
+        BEGIN
+            INSERT INTO reading_histograms (device_id, type_id, bucket, value, count)
+            VALUES (NEW.device_id, NEW.type_id, {bucket}, NEW.value, 1)
+            ON CONFLICT (device_id, type_id, bucket, value) DO UPDATE SET count = count + 1;
+        END'''.format(bucket=BUCKET_SQL.format('NEW.date_created', HISTOGRAM_BUCKET_SECONDS)),
+    ],
+    [
+        # Fleet wide summaries over a type and date range
+        'CREATE INDEX reading_histograms_type_bucket ON reading_histograms (type_id, bucket, device_id, value, count)',
+    ],
+    [
+        # A device's readings of every type in date order, for paging through its history
+        'CREATE INDEX readings_device_date ON readings_data (device_id, date_created, type_id, value)',
+    ],
+    # Count, sum, min and max per device, type and minute, hour and day, for series
+    sum([[
+        '''CREATE TABLE reading_rollups_{0:d} (
+            device_id INTEGER NOT NULL,
+            type_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum INTEGER NOT NULL,
+            min INTEGER NOT NULL,
+            max INTEGER NOT NULL,
+            PRIMARY KEY (device_id, type_id, bucket)
+        ) WITHOUT ROWID'''.format(resolution),
+        '''INSERT INTO reading_rollups_{0:d} (device_id, type_id, bucket, count, sum, min, max)
+            SELECT device_id, type_id, {1}, count(*), sum(value), min(value), max(value) FROM readings_data
+            WHERE value IS NOT NULL AND date_created IS NOT NULL
+            GROUP BY 1, 2, 3'''.format(resolution, BUCKET_SQL.format('date_created', resolution)),
+        '''CREATE TRIGGER readings_rollup_{0:d} AFTER INSERT ON readings_data
+        WHEN NEW.value IS NOT NULL AND NEW.date_created IS NOT NULL
+        BEGIN
+            INSERT INTO reading_rollups_{0:d} (device_id, type_id, bucket, count, sum, min, max)
+            VALUES (NEW.device_id, NEW.type_id, {1}, 1, NEW.value, NEW.value, NEW.value)
+            ON CONFLICT (device_id, type_id, bucket) DO UPDATE SET
+                count = count + 1,
+                sum = sum + excluded.sum,
+                min = min(min, excluded.min),
+                max = max(max, excluded.max);
+        END'''.format(resolution, BUCKET_SQL.format('NEW.date_created', resolution)),
+    ] for resolution in ROLLUP_RESOLUTIONS], []),
+]
+
+
+def migrate_db(conn):
+    """
+    Brings a database file up to the latest schema version in place.
+    Each migration runs in its own transaction together with the bump of
+    user_version, so an interrupted upgrade resumes where it stopped.
+    """
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, statements in enumerate(MIGRATIONS[version:], version + 1):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute('PRAGMA user_version = {:d}'.format(version))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def init_db(app, db_name=None):
     # Setup the SQLite DB
-    db_name = get_db_name(app)
+    db_name = db_name or get_db_name(app)
     conn = sqlite3.connect(db_name)
-    conn.execute(
-        'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+    conn.execute('PRAGMA journal_mode = {}'.format(get_db_setting(app, 'DB_JOURNAL_MODE')))
+    migrate_db(conn)
     conn.close()
+    migrated.add(db_name)
+
 
+def clear_db(conn):
+    """
+    Drops every table and view of a database and resets its schema version.
+    """
+    objects = conn.execute(
+        "SELECT type, name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'").fetchall()
+    for _type, name in objects:
+        conn.execute('DROP {} IF EXISTS "{}"'.format(_type.upper(), name))
+    conn.execute('PRAGMA user_version = 0')
+    conn.commit()
 
-def get_db_cursor(app):
+
+def reset_db(app):
+    """
+    Recreates the app's database empty with the latest schema and drops
+    what the process cached about it. Meant for tests.
+    """
     db_name = get_db_name(app)
     conn = sqlite3.connect(db_name)
-    conn.row_factory = sqlite3.Row
-    return conn.cursor(), conn
+    clear_db(conn)
+    conn.close()
+    id_caches.pop(db_name, None)
+    forget_responses(app)
+    latest_readings = app.extensions.get('latest_readings')
+    if latest_readings is not None:
+        latest_readings.clear()
+    init_db(app)
 
 
-def get_where_statement(device_uuid=None, args={}):
-    filters = {'type': str, 'start': int, 'end': int}
-    map_fields = {'start': 'date_created', 'end': 'date_created'}
+def forget_responses(app):
+    """
+    Invalidates the responses cached from readings that were just deleted.
+    """
+    write_versions = app.extensions.get('write_versions')
+    if write_versions is not None:
+        write_versions.clear()
 
-    if device_uuid:
-        where_statements = ['device_uuid = "{}"'.format(device_uuid)]
+
+def explain_query_plan(cur, query, params=()):
+    """
+    Returns the EXPLAIN QUERY PLAN details of a statement, one per step.
+    """
+    cur.execute('EXPLAIN QUERY PLAN {}'.format(query), params)
+    return [row[-1] for row in cur.fetchall()]
+
+
+def get_full_scans(plan):
+    """
+    Returns the steps of a query plan that walk a whole table rather than
+    searching or covering-scanning an index. Scans over the rows of a
+    subquery (co-routines and materialized views) are not table scans.
+    """
+    subqueries = set()
+    for detail in plan:
+        words = detail.split()
+        if words[0] in ('CO-ROUTINE', 'MATERIALIZE'):
+            subqueries.add(words[1])
+
+    scans = []
+    for detail in plan:
+        words = detail.split()
+        if words[0] != 'SCAN' or 'INDEX' in words:
+            continue
+        if words[1].startswith('(') or words[1] in subqueries or words[1:3] == ['CONSTANT', 'ROW']:
+            continue
+        scans.append(detail)
+    return scans
+
+
+class PoolTimeout(Exception):
+    """
+    Every connection of a pool stayed lent for the acquire timeout.
+    """
+
+
+class ConnectionPool(object):
+    """
+    Bounded LIFO pool of SQLite connections to one database file.
+
+    Connections are opened lazily up to size and reused across requests
+    and threads, so the file open, schema parse and pragma setup are paid
+    once per connection instead of once per request.
+    """
+
+    def __init__(self, db_name, size, pragmas, timeout, cached_statements, trace=None, metrics=None, budget=None,
+                 acquire_timeout=None):
+        self.db_name = db_name
+        self.size = size
+        self.pragmas = pragmas
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.cached_statements = cached_statements
+        self.trace = trace
+        self.metrics = metrics
+        self.budget = budget
+        self.available = LifoQueue(maxsize=size)
+        self.created = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=self.cached_statements,
+                               factory=sqlite3.Connection if self.metrics is None else InstrumentedConnection)
+        conn.row_factory = sqlite3.Row
+        if self.metrics is not None:
+            conn.metrics = self.metrics
+            conn.budget = self.budget
+        elif self.budget is not None:
+            conn.set_progress_handler(self.budget.is_exceeded, PROGRESS_STEPS)
+        for pragma in self.pragmas:
+            conn.execute('PRAGMA {}'.format(pragma))
+        if self.trace is not None:
+            conn.set_trace_callback(self.trace)
+        return conn
+
+    def acquire(self):
+        try:
+            return self.available.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                try:
+                    return self.connect()
+                except Exception:
+                    self.created -= 1
+                    raise
+        try:
+            return self.available.get(timeout=self.acquire_timeout)
+        except Empty:
+            raise PoolTimeout('No connection to {} was free within {} seconds'.format(
+                self.db_name, self.acquire_timeout))
+
+    def release(self, conn):
+        if self.metrics is not None:
+            conn.finish_statements()
+        conn.rollback()
+        if self.closed:
+            self.discard(conn)
+            return
+        self.available.put_nowait(conn)
+
+    def discard(self, conn):
+        conn.close()
+        with self.lock:
+            self.created -= 1
+
+    def close(self):
+        """
+        Closes the idle connections, and those lent once they're returned.
+        Callers still holding the pool open a connection per acquire.
+        """
+        self.closed = True
+        while True:
+            try:
+                self.discard(self.available.get_nowait())
+            except Empty:
+                break
+
+
+def get_pool(app, readonly=False, db_name=None):
+    """
+    Returns the pool for the app's current database, or for the partition
+    file db_name. Writes go through a
+    single connection, as SQLite only has one writer at a time anyway,
+    while reads get their own pool of query_only connections. With WAL
+    journaling readers and the writer don't block each other, so long
+    summary scans never stall ingestion.
+
+    A callable in DB_TRACE receives every statement the pool's
+    connections execute, e.g. to check the query plans the app emits.
+    With a metrics.Metrics in app.extensions['metrics'] the statements
+    are timed and counted. With a guard.QueryBudget in
+    app.extensions['query_budget'] the statements of read connections are
+    interrupted past the deadline of their thread.
+
+    A connection is waited for at most DB_ACQUIRE_TIMEOUT seconds, then
+    PoolTimeout is raised. At most DB_MAX_POOLS pools stay open, so reads
+    and writes spanning many partitions don't keep a pool of every file
+    they touched.
+    """
+    db_name = db_name or get_db_name(app)
+    key = (db_name, readonly)
+    pool = pools.get(key)
+    if pool is not None:
+        try:
+            pools.move_to_end(key)
+        except KeyError:
+            # Closed meanwhile, still usable by this caller
+            pass
+        return pool
+
+    pragmas = [
+        'synchronous = {}'.format(get_db_setting(app, 'DB_SYNCHRONOUS')),
+        'cache_size = {:d}'.format(get_db_setting(app, 'DB_CACHE_SIZE')),
+        'mmap_size = {:d}'.format(get_db_setting(app, 'DB_MMAP_SIZE')),
+    ]
+    if readonly:
+        pragmas.append('query_only = 1')
+        size = get_db_setting(app, 'DB_READ_POOL_SIZE')
     else:
-        where_statements = []
-
-    for _filter, _type in filters.items():
-        if args.get(_filter, type=_type):
-            _filter_value = args.get(_filter, type=_type)
-            _field = _filter if not map_fields.get(_filter) else map_fields.get(_filter)
-            if _field == 'date_created':
-                _comparator = '>=' if _filter == 'start' else '<='
-                where_statements.append('{} {} {}'.format(_field, _comparator, _filter_value))
-            else:
-                where_statements.append('{} = "{}"'.format(_field, _filter_value))
-
-    return '{}'.format(' and '.join(where_statements)) if len(where_statements) else ''
+        pragmas.insert(0, 'journal_mode = {}'.format(get_db_setting(app, 'DB_JOURNAL_MODE')))
+        size = 1
+
+    with pools_lock:
+        if db_name not in migrated:
+            init_db(app, db_name)
+        if key not in pools:
+            pools[key] = ConnectionPool(db_name, size, pragmas, get_db_setting(app, 'DB_BUSY_TIMEOUT'),
+                                        get_db_setting(app, 'DB_CACHED_STATEMENTS'), trace=app.config.get('DB_TRACE'),
+                                        metrics=app.extensions.get('metrics'),
+                                        budget=app.extensions.get('query_budget') if readonly else None,
+                                        acquire_timeout=get_db_setting(app, 'DB_ACQUIRE_TIMEOUT'))
+        pool = pools[key]
+        while len(pools) > get_db_setting(app, 'DB_MAX_POOLS'):
+            pools.popitem(last=False)[1].close()
+        return pool
+
+
+@contextmanager
+def get_db_cursor(app, readonly=False, db_name=None):
+    """
+    Lends a pooled connection and a cursor on it for the duration of the
+    with block. Uncommitted changes are rolled back when it's returned.
+
+        with get_db_cursor(app, readonly=True) as (cur, conn):
+            cur.execute(...)
+    """
+    pool = get_pool(app, readonly, db_name)
+    if pool.metrics is None:
+        conn = pool.acquire()
+    else:
+        with pool.metrics.timed('connection'):
+            conn = pool.acquire()
+    try:
+        yield conn.cursor(), conn
+    finally:
+        pool.release(conn)
+
+
+def close_db_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
+
+
+def forget_db(db_name):
+    """
+    Closes the pools of a database file and drops what the process cached
+    about it, before the file is deleted.
+    """
+    with pools_lock:
+        for readonly in (False, True):
+            pool = pools.pop((db_name, readonly), None)
+            if pool is not None:
+                pool.close()
+        migrated.discard(db_name)
+    id_caches.pop(db_name, None)
+
+
+class IdCache(object):
+    """
+    In-process map of device uuids and sensor type names to the integer
+    ids readings are stored with, for one database file. Ids are never
+    reassigned, so entries stay valid for the lifetime of the file.
+    """
+
+    def __init__(self):
+        self.ids = {'devices': {}, 'sensor_types': {}}
+        self.names = {'devices': {}, 'sensor_types': {}}
+
+    def add(self, table, name, _id):
+        self.ids[table][name] = _id
+        self.names[table][_id] = name
+
+    def forget(self, table, name):
+        _id = self.ids[table].pop(name, None)
+        self.names[table].pop(_id, None)
+
+
+id_caches = {}
+# The column holding the name of each dictionary table
+DICTIONARY_COLUMNS = {'devices': 'uuid', 'sensor_types': 'name'}
+
+
+def get_id_cache(app, db_name=None):
+    db_name = db_name or get_db_name(app)
+    id_cache = id_caches.get(db_name)
+    if id_cache is None:
+        id_cache = id_caches.setdefault(db_name, IdCache())
+    return id_cache
+
+
+def get_id(app, cur, table, name, create=False, db_name=None):
+    """
+    Returns the id of a device uuid or sensor type name, or None when it
+    was never stored. With create=True missing names are inserted, which
+    needs a cursor of the writer connection. Every partition file has its
+    own ids, db_name is the one the cursor is on.
+    """
+    id_cache = get_id_cache(app, db_name)
+    _id = id_cache.ids[table].get(name)
+    if _id is not None:
+        return _id
+
+    column = DICTIONARY_COLUMNS[table]
+    if create:
+        cur.execute('INSERT OR IGNORE INTO {} ({}) VALUES (?)'.format(table, column), (name,))
+    cur.execute('SELECT id FROM {} WHERE {} = ?'.format(table, column), (name,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    id_cache.add(table, name, row[0])
+    return row[0]
+
+
+def get_name(app, cur, table, _id, db_name=None):
+    """
+    Returns the device uuid or sensor type name stored under an id.
+    """
+    id_cache = get_id_cache(app, db_name)
+    name = id_cache.names[table].get(_id)
+    if name is not None:
+        return name
+
+    cur.execute('SELECT {} FROM {} WHERE id = ?'.format(DICTIONARY_COLUMNS[table], table), (_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    id_cache.add(table, row[0], _id)
+    return row[0]
+
+
+def insert_readings(app, conn, readings, db_name=None):
+    """
+    Inserts (device_uuid, type, value, date_created) tuples with a single
+    executemany and commits them as one transaction, creating the ids of
+    devices and sensor types seen for the first time.
+    """
+    id_cache = get_id_cache(app, db_name)
+    created = []
+    cur = conn.cursor()
+    try:
+        rows = []
+        for device_uuid, sensor_type, value, date_created in readings:
+            ids = []
+            for table, name in (('devices', device_uuid), ('sensor_types', sensor_type)):
+                if name not in id_cache.ids[table]:
+                    created.append((table, name))
+                ids.append(get_id(app, cur, table, name, create=True, db_name=db_name))
+            rows.append((ids[0], ids[1], value, date_created))
+        cur.executemany('insert into readings_data (device_id,type_id,value,date_created) VALUES (?,?,?,?)', rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Ids inserted by the rolled back transaction don't exist anymore
+        for table, name in created:
+            id_cache.forget(table, name)
+        raise
+
+
+def get_window(app, start=None, end=None, now=None, limits=None):
+    """
+    Returns the start and end dates a query reads. With a
+    QUERY_DEFAULT_WINDOW a missing end is now and a missing start that
+    many seconds before end, so a request without dates only reads the
+    latest readings. Raises ValueError when the range is unbounded or
+    longer than QUERY_MAX_WINDOW seconds. The default_window and
+    max_window of a route's limits take precedence over both.
+    """
+    limits = limits or {}
+    default_window = limits.get('default_window', app.config.get('QUERY_DEFAULT_WINDOW'))
+    max_window = limits.get('max_window', app.config.get('QUERY_MAX_WINDOW'))
+    if default_window:
+        if end is None:
+            end = int(time.time()) if now is None else now
+        if start is None:
+            start = end - default_window
+    if max_window:
+        if start is None or end is None:
+            raise ValueError('start and end are required')
+        if end - start > max_window:
+            raise ValueError('The range from start to end should be at most {} seconds'.format(max_window))
+    return start, end
+
+
+def get_filters(app, cur, device_uuid=None, sensor_type=None, start=None, end=None, db_name=None):
+    """
+    Resolves a device and sensor type into the device_id and type_id of
+    the database file of the cursor and returns them with the start and
+    end dates, as the filters a query on readings_data uses, None meaning
+    no filter. Returns None when the device or type was never stored
+    there, as no reading can match then.
+    """
+    filters = dict(device_id=None, type_id=None, start=start, end=end)
+    if device_uuid:
+        filters['device_id'] = get_id(app, cur, 'devices', device_uuid, db_name=db_name)
+        if filters['device_id'] is None:
+            return None
+    if sensor_type:
+        filters['type_id'] = get_id(app, cur, 'sensor_types', sensor_type, db_name=db_name)
+        if filters['type_id'] is None:
+            return None
+    return filters
+
+
+def encode_cursor(values):
+    """
+    Returns an opaque pagination cursor holding a list of values.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, types):
+    """
+    Returns the list of values of a cursor from encode_cursor, raising
+    ValueError when it wasn't made by it or its values aren't of types,
+    integers being those SQLite stores.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError('Invalid cursor')
+    for value, value_type in zip(values, types):
+        if not isinstance(value, value_type) or isinstance(value, bool):
+            raise ValueError('Invalid cursor')
+        if value_type is int and not -2 ** 63 <= value < 2 ** 63:
+            raise ValueError('Invalid cursor')
+    return values